@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+    Token batching of text datasets over length-sorted examples
+"""
+from __future__ import division
+
+import random
+
+import torch
+import torchtext
+
+from onmt.inputters.numericalized_dataset import NumericalizedTextDataset, \
+    NumericalizedBatch
+from onmt.utils.logging import logger
+
+
+class LengthIndex(object):
+    """
+    Source and target lengths (without special tokens) of the examples of
+    a text dataset.
+
+    Args:
+        src_lengths (LongTensor): source length of every example.
+        tgt_lengths (LongTensor): target length of every example.
+    """
+
+    def __init__(self, src_lengths, tgt_lengths):
+        self.src_lengths = src_lengths
+        self.tgt_lengths = tgt_lengths
+
+    def __len__(self):
+        return self.src_lengths.size(0)
+
+    @classmethod
+    def of(cls, dataset):
+        """
+        The index of `dataset`, built on first use and then kept with the
+        dataset, which may be iterated over again in the next epoch.
+        """
+        index = getattr(dataset, 'length_index', None)
+        if index is not None:
+            return index
+
+        if isinstance(dataset, NumericalizedTextDataset):
+            # Stored targets include <s> and </s>, examples do not.
+            index = cls(dataset.lengths('src'), dataset.lengths('tgt') - 2)
+        else:
+            index = cls(
+                torch.LongTensor([len(ex.src) for ex in dataset.examples]),
+                torch.LongTensor([len(ex.tgt) for ex in dataset.examples]))
+        dataset.length_index = index
+        return index
+
+
+def token_bucket_batches(index, max_tokens):
+    """
+    Split the examples of `index` into batches of at most `max_tokens`
+    padded source or target tokens, counted as the `batch_size_fn` of
+    `build_dataset_iter` does.
+
+    Examples are sorted by padded length (ties in random order), so that
+    each batch gathers examples of about the same length, and the batches
+    are cut greedily along the sorted lengths, then shuffled.
+
+    Args:
+        index (LengthIndex): the lengths of the examples.
+        max_tokens (int): token budget of a batch.
+
+    Returns:
+        The list of batches (`LongTensor`s of example ids) and the list
+        of their padding ratios, i.e. the fraction of padding in their
+        source and target tensors.
+    """
+    n = len(index)
+    # Src: <bos> w1 ... wN <eos>, Tgt: w1 ... wN <eos>
+    padded_lengths = torch.max(index.src_lengths + 2, index.tgt_lengths + 1)
+
+    # Seeded from `random`, like the other shuffles of the training data.
+    generator = torch.Generator()
+    generator.manual_seed(random.getrandbits(32))
+    order = torch.randperm(n, generator=generator)
+    max_src = index.src_lengths.max().item() + 1
+    keys = (padded_lengths[order] * max_src + index.src_lengths[order]) * n \
+        + torch.arange(0, n).long()
+    ids = order[keys.sort()[1]]
+
+    lengths = padded_lengths[ids].tolist()
+    src_lengths = index.src_lengths[ids].tolist()
+    tgt_lengths = index.tgt_lengths[ids].tolist()
+
+    batches = []
+    padding_ratios = []
+    start = 0
+    while start < n:
+        # `lengths` is sorted: the last example of a batch is the longest.
+        end = min(n, start + max(1, max_tokens // lengths[start]))
+        while end - start > 1 \
+                and (end - start) * lengths[end - 1] > max_tokens:
+            end = start + max(1, max_tokens // lengths[end - 1])
+        batches.append(ids[start:end])
+
+        count = end - start
+        src = src_lengths[start:end]
+        tgt = tgt_lengths[start:end]
+        # The target tensor has <s> and </s>.
+        padded = count * (max(src) + max(tgt) + 2)
+        padding_ratios.append(1 - (sum(src) + sum(tgt) + 2 * count) / padded)
+        start = end
+
+    shuffled = list(range(len(batches)))
+    random.shuffle(shuffled)
+    return [batches[i] for i in shuffled], \
+        [padding_ratios[i] for i in shuffled]
+
+
+class TokenBucketIterator(object):
+    """
+    Training iterator over a text dataset, with batches built by
+    `token_bucket_batches`. Each batch is sorted by decreasing source
+    length and has a `padding_ratio` attribute.
+
+    Args:
+        dataset (TextDataset or NumericalizedTextDataset): the dataset.
+        fields (dict): fields of the dataset.
+        batch_size (int): token budget of a batch.
+        device: the device batches are moved to.
+    """
+
+    def __init__(self, dataset, fields, batch_size, device):
+        self.dataset = dataset
+        self.fields = fields
+        self.batch_size = batch_size
+        self.device = device
+        self.index = LengthIndex.of(dataset)
+        self.batches = None
+
+    def _make_batch(self, ids):
+        order = self.index.src_lengths[ids].sort(descending=True)[1]
+        ids = ids[order]
+        if isinstance(self.dataset, NumericalizedTextDataset):
+            return NumericalizedBatch(self.dataset, ids, self.fields,
+                                      self.device)
+        examples = [self.dataset.examples[i] for i in ids.tolist()]
+        return torchtext.data.Batch(examples, self.dataset, self.device)
+
+    def __iter__(self):
+        batches, padding_ratios = token_bucket_batches(self.index,
+                                                       self.batch_size)
+        self.batches = batches
+        logger.info('%d examples in %d batches, padding ratio: %.3f'
+                    % (len(self.index), len(batches),
+                       sum(padding_ratios) / max(len(batches), 1)))
+        for ids, padding_ratio in zip(batches, padding_ratios):
+            batch = self._make_batch(ids)
+            batch.padding_ratio = padding_ratio
+            yield batch
+
+    def __len__(self):
+        if self.batches is None:
+            self.batches = token_bucket_batches(self.index,
+                                                self.batch_size)[0]
+        return len(self.batches)
@@ -4,6 +4,7 @@
 """
 import glob
 import os
+import random
 from collections import Counter, defaultdict, OrderedDict
 from itertools import count
 
@@ -15,7 +16,11 @@ from onmt.inputters.dataset_base import UNK_WORD, PAD_WORD, BOS_WORD, EOS_WORD
 from onmt.inputters.text_dataset import TextDataset
 from onmt.inputters.image_dataset import ImageDataset
 from onmt.inputters.audio_dataset import AudioDataset
+from onmt.inputters.numericalized_dataset import NumericalizedTextDataset, \
+    NumericalizedBatch
+from onmt.inputters.bucketing import TokenBucketIterator
 from onmt.utils.logging import logger
+from onmt.utils.misc import prefetch_iterator
 
 
 def _getstate(self):
@@ -134,6 +139,10 @@ def make_features(batch, side, data_type='text'):
         of size (len x batch).
     """
     assert side in ['src', 'tgt']
+    prepared = batch.__dict__.get('prepared_features')
+    if prepared is not None:
+        return prepared[side]
+
     if isinstance(batch.__dict__[side], tuple):
         data = batch.__dict__[side][0]
     else:
@@ -150,6 +159,25 @@ def make_features(batch, side, data_type='text'):
         return levels[0]
 
 
+def prepare_features(batch, data_type='text'):
+    """
+    Compute the `make_features` tensors of both sides of `batch` once and
+    keep them on the batch, so that later `make_features` calls on it are
+    free. This lets a background thread build the model inputs ahead of
+    the training loop.
+
+    Args:
+        batch (Tensor): a batch of source and target data.
+        data_type (str): type of the source input.
+            Options are [text|img|audio].
+    Returns:
+        The same batch.
+    """
+    batch.prepared_features = {'src': make_features(batch, 'src', data_type),
+                               'tgt': make_features(batch, 'tgt')}
+    return batch
+
+
 def collect_features(fields, side="src"):
     """
     Collect features from Field object.
@@ -270,9 +298,59 @@ def _build_field_vocab(field, counter, **kwargs):
     field.vocab = field.vocab_cls(counter, specials=specials, **kwargs)
 
 
+def _vocab_field_keys(fields):
+    """
+    Names of the fields in `fields` that get a vocabulary built
+    by `build_vocab`.
+    """
+    keys = ['src'] + collect_features(fields, 'src') + \
+        ['tgt'] + collect_features(fields, 'tgt')
+    return [k for k in keys if k in fields and fields[k].use_vocab]
+
+
+def update_vocab_counters(counters, dataset, fields):
+    """
+    Count the tokens of every example of `dataset` into `counters`.
+
+    This is meant to be called on each shard right after it is built,
+    so that `build_vocab` does not need to reload the saved shards.
+    Counters of different shards (or processes) are merged with
+    `merge_vocab_counters`.
+
+    Args:
+        counters (dict): `Counter` objects keyed by field name. Missing
+            keys are created.
+        dataset (DatasetBase): the dataset whose examples are counted.
+        fields (dict): fields to count tokens for.
+
+    Returns:
+        The updated `counters`.
+    """
+    keys = _vocab_field_keys(fields)
+    for ex in dataset.examples:
+        for k in keys:
+            val = getattr(ex, k, None)
+            if val is None:
+                continue
+            if not fields[k].sequential:
+                val = [val]
+            counters.setdefault(k, Counter()).update(val)
+    return counters
+
+
+def merge_vocab_counters(counters, other):
+    """
+    Add the per-field `other` counters to `counters`, in place.
+    """
+    for k, counter in other.items():
+        counters.setdefault(k, Counter()).update(counter)
+    return counters
+
+
 def build_vocab(train_dataset_files, fields, data_type, share_vocab,
                 src_vocab_path, src_vocab_size, src_words_min_frequency,
-                tgt_vocab_path, tgt_vocab_size, tgt_words_min_frequency):
+                tgt_vocab_path, tgt_vocab_size, tgt_words_min_frequency,
+                counters=None):
     """
     Args:
         train_dataset_files: a list of train dataset pt file.
@@ -287,41 +365,43 @@ def build_vocab(train_dataset_files, fields, data_type, share_vocab,
         tgt_vocab_size(int): size of the target vocabulary.
         tgt_words_min_frequency(int): the minimum frequency needed to
                 include a target word in the vocabulary.
+        counters(dict): token counters filled by `update_vocab_counters`
+                while the shards were built. If given,
+                `train_dataset_files` are not reloaded.
 
     Returns:
         Dict of Fields
     """
-    counter = {}
-    for k in fields:
-        counter[k] = Counter()
+    if counters is None:
+        counters = {}
+        for path in train_dataset_files:
+            dataset = torch.load(path)
+            logger.info(" * reloading %s." % path)
+            update_vocab_counters(counters, dataset, fields)
+    # Shallow copy, the filtering below must not alter the caller's dict.
+    counter = defaultdict(Counter, counters)
 
     # Load vocabulary
     src_vocab = load_vocabulary(src_vocab_path, tag="source")
     tgt_vocab = load_vocabulary(tgt_vocab_path, tag="target")
 
-    for path in train_dataset_files:
-        dataset = torch.load(path)
-        logger.info(" * reloading %s." % path)
-        for ex in dataset.examples:
-            for k in fields:
-                val = getattr(ex, k, None)
-                if val is not None and not fields[k].sequential:
-                    val = [val]
-                elif k == 'src' and src_vocab:
-                    val = [item for item in val if item in src_vocab]
-                elif k == 'tgt' and tgt_vocab:
-                    val = [item for item in val if item in tgt_vocab]
-                counter[k].update(val)
+    if src_vocab:
+        counter["src"] = Counter({w: c for w, c in counter["src"].items()
+                                  if w in src_vocab})
+    if tgt_vocab:
+        counter["tgt"] = Counter({w: c for w, c in counter["tgt"].items()
+                                  if w in tgt_vocab})
 
     _build_field_vocab(fields["tgt"], counter["tgt"],
                        max_size=tgt_vocab_size,
                        min_freq=tgt_words_min_frequency)
     logger.info(" * tgt vocab size: %d." % len(fields["tgt"].vocab))
 
-    # All datasets have same num of n_tgt_features,
-    # getting the last one is OK.
-    for j in range(dataset.n_tgt_feats):
-        key = "tgt_feat_" + str(j)
+    # All datasets have same num of n_tgt_features, so the features
+    # seen while counting are the ones of every dataset.
+    for key in collect_features(fields, 'tgt'):
+        if key not in counters:
+            continue
         _build_field_vocab(fields[key], counter[key])
         logger.info(" * %s vocab size: %d." % (key,
                                                len(fields[key].vocab)))
@@ -332,10 +412,11 @@ def build_vocab(train_dataset_files, fields, data_type, share_vocab,
                            min_freq=src_words_min_frequency)
         logger.info(" * src vocab size: %d." % len(fields["src"].vocab))
 
-        # All datasets have same num of n_src_features,
-        # getting the last one is OK.
-        for j in range(dataset.n_src_feats):
-            key = "src_feat_" + str(j)
+        # All datasets have same num of n_src_features, so the features
+        # seen while counting are the ones of every dataset.
+        for key in collect_features(fields, 'src'):
+            if key not in counters:
+                continue
             _build_field_vocab(fields[key], counter[key])
             logger.info(" * %s vocab size: %d." %
                         (key, len(fields[key].vocab)))
@@ -400,6 +481,84 @@ class OrderedIterator(torchtext.data.Iterator):
                 self.batches.append(sorted(b, key=self.sort_key))
 
 
+class _ExampleLengths(object):
+    """
+    Stands in for an `Example` when calling a `batch_size_fn`, which only
+    looks at the lengths of `src` and `tgt`.
+    """
+
+    def __init__(self, src_len, tgt_len):
+        self.src = range(src_len)
+        self.tgt = range(tgt_len)
+
+
+class NumericalizedIterator(object):
+    """
+    Iterator over a `NumericalizedTextDataset`, batching the examples the
+    way `OrderedIterator` does for torchtext datasets: when training,
+    pools of `batch_size * 100` shuffled examples are sorted by length,
+    split into batches, and the batches are shuffled. Each batch is sorted
+    by decreasing source length.
+
+    Args:
+        dataset (NumericalizedTextDataset): the dataset to iterate over.
+        fields (dict): fields of the dataset.
+        batch_size (int): batch size.
+        batch_size_fn: custom batch process function.
+        device: the device batches are moved to.
+        train (bool): train or valid?
+    """
+
+    def __init__(self, dataset, fields, batch_size, batch_size_fn,
+                 device, train):
+        self.dataset = dataset
+        self.fields = fields
+        self.batch_size = batch_size
+        self.batch_size_fn = batch_size_fn
+        self.device = device
+        self.train = train
+
+        self.src_lengths = dataset.lengths('src').tolist()
+        # Stored targets include <s> and </s>, examples do not.
+        self.tgt_lengths = [n - 2 for n in dataset.lengths('tgt').tolist()]
+
+    def _sort_key(self, i):
+        return self.src_lengths[i], self.tgt_lengths[i]
+
+    def _batch(self, ids):
+        if self.batch_size_fn is None:
+            size_fn = None
+        else:
+            def size_fn(i, count, sofar):
+                return self.batch_size_fn(
+                    _ExampleLengths(self.src_lengths[i], self.tgt_lengths[i]),
+                    count, sofar)
+        return torchtext.data.batch(ids, self.batch_size, size_fn)
+
+    def create_batches(self):
+        """ Create batches of example ids """
+        ids = list(range(len(self.dataset)))
+        if self.train:
+            random.shuffle(ids)
+            for p in torchtext.data.batch(ids, self.batch_size * 100):
+                p_batch = list(self._batch(sorted(p, key=self._sort_key)))
+                random.shuffle(p_batch)
+                for b in p_batch:
+                    yield b
+        else:
+            for b in self._batch(ids):
+                yield b
+
+    def __iter__(self):
+        for b in self.create_batches():
+            b = sorted(b, key=self._sort_key, reverse=True)
+            yield NumericalizedBatch(self.dataset, torch.LongTensor(b),
+                                     self.fields, self.device)
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+
 class DatasetLazyIter(object):
     """ An Ordered Dataset Iterator, supporting multiple datasets,
         and lazy loading.
@@ -411,16 +570,24 @@ class DatasetLazyIter(object):
         batch_size_fn: custom batch process function.
         device: the GPU device.
         is_train (bool): train or valid?
+        prefetch (int): number of datasets loaded ahead by a background
+            thread while the current one is consumed. 0 loads them
+            synchronously.
+        bucketing (bool): batch text datasets with a
+            `TokenBucketIterator`, `batch_size` being a number of tokens.
     """
 
     def __init__(self, datasets, fields, batch_size, batch_size_fn,
-                 device, is_train):
+                 device, is_train, prefetch=0, bucketing=False):
+        if prefetch > 0:
+            datasets = prefetch_iterator(datasets, prefetch)
         self.datasets = datasets
         self.fields = fields
         self.batch_size = batch_size
         self.batch_size_fn = batch_size_fn
         self.device = device
         self.is_train = is_train
+        self.bucketing = bucketing
 
         self.cur_iter = self._next_dataset_iterator(datasets)
         # We have at least one dataset.
@@ -446,6 +613,17 @@ class DatasetLazyIter(object):
         except StopIteration:
             return None
 
+        if self.bucketing and cur_dataset.data_type == 'text':
+            if not isinstance(cur_dataset, NumericalizedTextDataset):
+                cur_dataset.fields = self.fields
+            return TokenBucketIterator(cur_dataset, self.fields,
+                                       self.batch_size, self.device)
+
+        if isinstance(cur_dataset, NumericalizedTextDataset):
+            return NumericalizedIterator(
+                cur_dataset, self.fields, self.batch_size,
+                self.batch_size_fn, self.device, self.is_train)
+
         # We clear `fields` when saving, restore when loading.
         cur_dataset.fields = self.fields
 
@@ -495,17 +673,26 @@ def build_dataset_iter(datasets, fields, opt, is_train=True):
     else:
         device = "cpu"
 
+    bucketing = is_train and opt.batch_type == "tokens" \
+        and opt.bucket_batches
     return DatasetLazyIter(datasets, fields, batch_size, batch_size_fn,
-                           device, is_train)
+                           device, is_train, prefetch=opt.shard_prefetch,
+                           bucketing=bucketing)
 
 
-def lazily_load_dataset(corpus_type, data_path):
+def lazily_load_dataset(corpus_type, data_path, mmap=False, repeat=False):
     """
     Dataset generator. Don't do extra stuff here, like printing,
     because they will be postponed to the first loading time.
 
     Args:
         corpus_type: 'train' or 'valid'
+        mmap: memory-map the arrays of numericalized shards instead of
+            reading them.
+        repeat: yield the datasets again and again, epoch after epoch.
+            From the second epoch on, the shards are visited in a new
+            order (the same in every process). A corpus made of a single
+            shard is only loaded once.
     Returns:
         A list of dataset, the dataset(s) are lazily loaded.
     """
@@ -513,19 +700,39 @@ def lazily_load_dataset(corpus_type, data_path):
 
     def _lazy_dataset_loader(pt_file, corpus_type):
         dataset = torch.load(pt_file)
+        if isinstance(dataset, NumericalizedTextDataset):
+            dataset.load_arrays(pt_file, mmap=mmap)
         logger.info('Loading %s dataset from %s, number of examples: %d' %
                     (corpus_type, pt_file, len(dataset)))
         return dataset
 
     # Sort the glob output by file name (by increasing indexes).
     pts = sorted(glob.glob(data_path + '.' + corpus_type + '.[0-9]*.pt'))
-    if pts:
+    if not pts:
+        # Only one inputters.*Dataset, simple!
+        pts = [data_path + '.' + corpus_type + '.pt']
+
+    if not repeat:
         for pt in pts:
             yield _lazy_dataset_loader(pt, corpus_type)
-    else:
-        # Only one inputters.*Dataset, simple!
-        pt = data_path + '.' + corpus_type + '.pt'
-        yield _lazy_dataset_loader(pt, corpus_type)
+        return
+
+    if len(pts) == 1:
+        # Iterators reshuffle the examples on every pass, no need to
+        # reload the shard.
+        dataset = _lazy_dataset_loader(pts[0], corpus_type)
+        while True:
+            yield dataset
+
+    for epoch in count():
+        epoch_pts = list(pts)
+        if epoch > 0:
+            # A dedicated generator: the global one may be used by another
+            # thread, and all processes must load the shards in the same
+            # order.
+            random.Random(epoch).shuffle(epoch_pts)
+        for pt in epoch_pts:
+            yield _lazy_dataset_loader(pt, corpus_type)
 
 
 def _load_fields(dataset, data_type, data_path, checkpoint):
@@ -537,8 +744,12 @@ def _load_fields(dataset, data_type, data_path, checkpoint):
     else:
         fields = load_fields_from_vocab(
             torch.load(data_path + '.vocab.pt'), data_type)
+    if isinstance(dataset, NumericalizedTextDataset):
+        field_names = dataset.field_names
+    else:
+        field_names = dataset.examples[0].__dict__
     fields = dict([(k, f) for (k, f) in fields.items()
-                   if k in dataset.examples[0].__dict__])
+                   if k in field_names])
 
     if data_type == 'text':
         logger.info(' * vocabulary size. source = %d; target = %d' %
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+    Text dataset stored as flat arrays of vocabulary ids
+"""
+import numpy as np
+import torch
+
+
+class NumericalizedTextDataset(object):
+    """
+    Text dataset whose examples are already mapped to vocabulary ids.
+
+    Instead of a list of `torchtext.data.Example` holding token strings,
+    every sequential field (src, tgt and their features) is stored as a
+    single flat `IntTensor` of ids, plus an `offsets` `LongTensor` of
+    size `n_examples + 1` such that the ids of example `i` are
+    `values[offsets[i]:offsets[i + 1]]`. Special tokens added by the
+    fields (e.g. <s> and </s> on the target side) are included.
+
+    Batches are gathered from these arrays without any string to id
+    lookup.
+
+    On disk (see `save`), the arrays are written raw to a `.bin` file next
+    to the `.pt` file, which only holds their layout. `load_arrays` then
+    either reads them or memory-maps them, in which case several processes
+    training on the same shard share one page-cached copy of it.
+
+    Args:
+        data (dict): `(values, offsets)` tensor pairs keyed by field name.
+        indices (LongTensor): the `indices` field of every example.
+    """
+
+    data_type = 'text'
+
+    def __init__(self, data, indices):
+        self.data = data
+        self.indices = indices
+        self.layout = None
+
+    def __getstate__(self):
+        # The arrays themselves are written by `save`.
+        return {'layout': self.layout}
+
+    def __setstate__(self, state):
+        self.layout = state['layout']
+        self.data = None
+        self.indices = None
+
+    @classmethod
+    def from_dataset(cls, dataset, fields):
+        """
+        Numericalize a `TextDataset` against the vocabularies of `fields`.
+
+        Args:
+            dataset (TextDataset): the dataset to convert.
+            fields (dict): fields with their vocabulary built.
+        """
+        names = [k for k in dataset.examples[0].__dict__
+                 if k in fields and fields[k] is not None
+                 and fields[k].sequential and fields[k].use_vocab]
+
+        data = {}
+        for name in names:
+            field = fields[name]
+            prefix = [field.init_token] if field.init_token is not None \
+                else []
+            suffix = [field.eos_token] if field.eos_token is not None \
+                else []
+            stoi = field.vocab.stoi
+
+            values = []
+            offsets = [0]
+            for ex in dataset.examples:
+                tokens = prefix + list(getattr(ex, name)) + suffix
+                values.extend(stoi[tok] for tok in tokens)
+                offsets.append(len(values))
+            data[name] = (torch.IntTensor(values), torch.LongTensor(offsets))
+
+        indices = torch.LongTensor([ex.indices for ex in dataset.examples])
+        return cls(data, indices)
+
+    def _named_arrays(self):
+        yield 'indices', self.indices
+        for name, (values, offsets) in self.data.items():
+            yield name + '.values', values
+            yield name + '.offsets', offsets
+
+    def save(self, pt_file):
+        """
+        Write the arrays back to back to `pt_file + '.bin'`, then the
+        dataset, holding only their layout, to `pt_file`.
+        """
+        self.layout = []
+        pos = 0
+        with open(pt_file + '.bin', 'wb') as f:
+            for key, tensor in self._named_arrays():
+                array = tensor.numpy()
+                f.write(array.tobytes())
+                self.layout.append((key, array.dtype.str, pos, array.size))
+                pos += array.nbytes
+                # Keep every array 8-byte aligned for memory-mapping.
+                padding = -pos % 8
+                f.write(b'\0' * padding)
+                pos += padding
+        torch.save(self, pt_file)
+
+    def load_arrays(self, pt_file, mmap=False):
+        """
+        Load the arrays of a dataset read from `pt_file`.
+
+        Args:
+            pt_file (str): the path the dataset was saved to.
+            mmap (bool): memory-map the arrays instead of reading them.
+        """
+        self.data = {}
+        arrays = {}
+        with open(pt_file + '.bin', 'rb') as f:
+            for key, dtype, pos, size in self.layout:
+                if size == 0:
+                    array = np.empty(0, dtype=dtype)
+                elif mmap:
+                    # Copy-on-write mapping: pages are shared with other
+                    # processes as long as nobody writes to them.
+                    array = np.memmap(f, dtype=dtype, mode='c',
+                                      offset=pos, shape=(size,))
+                else:
+                    f.seek(pos)
+                    array = np.fromfile(f, dtype=dtype, count=size)
+                arrays[key] = torch.from_numpy(array)
+
+        self.indices = arrays.pop('indices')
+        for key in arrays:
+            name, kind = key.rsplit('.', 1)
+            if kind == 'values':
+                self.data[name] = (arrays[key], arrays[name + '.offsets'])
+        return self
+
+    def __len__(self):
+        if self.indices is None:
+            return dict((key, size) for key, _, _, size
+                        in self.layout)['indices']
+        return self.indices.size(0)
+
+    @property
+    def field_names(self):
+        """ Names of the fields stored in this dataset. """
+        if self.data is None:
+            return [key.rsplit('.', 1)[0] for key, _, _, _ in self.layout]
+        return list(self.data.keys()) + ['indices']
+
+    def lengths(self, name):
+        """ `LongTensor` of the lengths of every example of field `name`. """
+        offsets = self.data[name][1]
+        return offsets[1:] - offsets[:-1]
+
+    def pad_batch(self, name, ids, pad_idx):
+        """
+        Gather the examples `ids` of field `name` into a padded tensor.
+
+        Args:
+            name (str): field name.
+            ids (LongTensor): example ids of the batch.
+            pad_idx (int): padding id.
+
+        Returns:
+            A `[max_len x batch]` `LongTensor` and the `[batch]` lengths.
+        """
+        values, offsets = self.data[name]
+        starts = offsets.index_select(0, ids)
+        lengths = offsets.index_select(0, ids + 1) - starts
+
+        positions = torch.arange(0, lengths.max().item()).long().unsqueeze(1)
+        pad_mask = positions.ge(lengths.unsqueeze(0))
+        gather_idx = (starts.unsqueeze(0) + positions).masked_fill(pad_mask, 0)
+        padded = values[gather_idx].long().masked_fill(pad_mask, pad_idx)
+        return padded, lengths
+
+
+class NumericalizedBatch(object):
+    """
+    Batch of a `NumericalizedTextDataset`, with the same attributes as
+    the `torchtext.data.Batch` objects consumed by the trainer. Padded
+    tensors are pinned before an asynchronous copy to the GPU.
+
+    Args:
+        dataset (NumericalizedTextDataset): the dataset of the examples.
+        ids (LongTensor): example ids, sorted by decreasing src length.
+        fields (dict): fields of the dataset, for padding ids.
+        device: the device the batch is moved to.
+    """
+
+    def __init__(self, dataset, ids, fields, device):
+        self.batch_size = ids.size(0)
+        self.dataset = dataset
+        self.device = torch.device(device)
+        for name in dataset.data:
+            field = fields[name]
+            pad_idx = field.vocab.stoi[field.pad_token]
+            data, lengths = dataset.pad_batch(name, ids, pad_idx)
+            if field.include_lengths:
+                setattr(self, name, (self._to_device(data),
+                                     self._to_device(lengths)))
+            else:
+                setattr(self, name, self._to_device(data))
+        self.indices = self._to_device(dataset.indices.index_select(0, ids))
+
+    def _to_device(self, tensor):
+        if self.device.type == 'cuda':
+            return tensor.pin_memory().to(self.device, non_blocking=True)
+        return tensor
+
+    def __len__(self):
+        return self.batch_size
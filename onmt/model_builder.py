@@ -3,6 +3,8 @@ This file is for models creation, which consults options
 and creates each encoder and decoder accordingly.
 """
 
+import functools
+
 import torch
 import torch.nn as nn
 from torch.nn.init import xavier_uniform_
@@ -20,6 +22,10 @@ from onmt.decoders.decoder import InputFeedRNNDecoder, StdRNNDecoder
 from onmt.decoders.transformer import TransformerDecoder
 from onmt.decoders.cnn_decoder import CNNDecoder
 
+from onmt.models.sharded_checkpoint import is_sharded_checkpoint, \
+    ShardLoader, LazyModuleList
+from onmt.models.tensor_checkpoint import is_tensor_checkpoint, \
+    load_tensor_checkpoint, module_state
 from onmt.modules import Embeddings, CopyGenerator
 from onmt.utils.misc import use_gpu
 from onmt.utils.logging import logger
@@ -127,17 +133,129 @@ def build_decoder(opt, embeddings):
                              opt.reuse_copy_attn)
 
 
-def load_test_multitask_model(opt, model_path=None):
+def load_test_multitask_model(opt, dummy_opt, model_path=None):
+    """
+    Load a multi-task model for translation. Its encoders, decoders and
+    generators are only loaded (from a sharded or tensor checkpoint) or
+    moved to the device (from a checkpoint file) when first used, so
+    translating `opt.src_lang` to `opt.tgt_lang` leaves the other
+    languages alone.
+
+    Args:
+        opt: the translation options.
+        dummy_opt (dict): default model options, for the options the
+            checkpoint predates.
+        model_path (str): the checkpoint, `opt.models[0]` if None.
+    Returns:
+        the fields of `opt.src_lang` to `opt.tgt_lang`, the model and
+        the model options.
+    """
     if model_path is None:
         model_path = opt.models[0]
-    checkpoint = torch.load(model_path,
-                            map_location=lambda storage, loc: storage)
-    model = checkpoint['whole_model']
     device = torch.device("cuda" if use_gpu(opt) else "cpu")
-    model.to(device)
 
-    model.eval()
-    return model
+    if is_sharded_checkpoint(model_path) or \
+            is_tensor_checkpoint(model_path):
+        model, model_opt = _load_multitask_model_lazily(
+            model_path, dummy_opt, device)
+    else:
+        checkpoint = torch.load(model_path,
+                                map_location=lambda storage, loc: storage)
+        model = checkpoint['whole_model']
+        model_opt = checkpoint['opt']
+        _add_default_opts(model_opt, dummy_opt)
+        for name in ['encoders', 'decoders', 'generators']:
+            setattr(model, name, LazyModuleList(
+                [functools.partial(_to_device, module, device)
+                 for module in getattr(model, name)]))
+        _to_device(model, device)
+
+    fields = inputters.load_fields_from_vocab(
+        {'src': model.src_vocabs[opt.src_lang],
+         'tgt': model.tgt_vocabs[opt.tgt_lang]}, data_type=opt.data_type)
+    return fields, model, model_opt
+
+
+def _add_default_opts(model_opt, dummy_opt):
+    for arg in dummy_opt:
+        if arg not in model_opt:
+            model_opt.__dict__[arg] = dummy_opt[arg]
+
+
+def _to_device(module, device):
+    return module.to(device).eval()
+
+
+def _load_multitask_model_lazily(model_path, dummy_opt, device):
+    """
+    The multi-task model of the sharded or tensor checkpoint
+    `model_path`, and its options. Only its attention bridge is loaded,
+    the other modules are built and loaded when first used.
+    """
+    if is_sharded_checkpoint(model_path):
+        loader = ShardLoader(model_path)
+        checkpoint = loader.manifest
+
+        def load_module(module, name):
+            module.load_state_dict(loader.load(name))
+    else:
+        checkpoint = load_tensor_checkpoint(model_path)
+
+        def load_module(module, name):
+            # On the CPU, the parameters are the mapped tensors, whose
+            # memory is shared by all the processes loading the model.
+            module.load_state_dict(module_state(checkpoint, name),
+                                   assign=device.type == 'cpu')
+
+    model_opt = checkpoint['opt']
+    _add_default_opts(model_opt, dummy_opt)
+    model = onmt.models.MultiTaskModel(None, None, model_opt)
+    model.model_type = model_opt.model_type
+    model.src_vocabs = checkpoint['src_vocabs']
+    model.tgt_vocabs = checkpoint['tgt_vocabs']
+    model.encoder_ids = checkpoint.get('encoder_ids') or \
+        {lang: idx for idx, lang in enumerate(model.src_vocabs)}
+    model.decoder_ids = checkpoint.get('decoder_ids') or \
+        {lang: idx for idx, lang in enumerate(model.tgt_vocabs)}
+
+    def build(lang_builder, ids):
+        langs = sorted(ids, key=ids.get)
+        return [functools.partial(lang_builder, lang) for lang in langs]
+
+    def encoder(lang):
+        fields = inputters.load_fields_from_vocab(
+            [('src', model.src_vocabs[lang])],
+            data_type=model_opt.model_type)
+        module, _ = build_embeddings_then_encoder(model_opt, fields)
+        module = _to_device(module, device)
+        load_module(module, 'encoders/' + lang)
+        return module
+
+    # The decoder and generator of a language are built together, as
+    # they may share their embeddings.
+    built = {}
+
+    def decoder_and_generator(idx, lang):
+        if lang not in built:
+            fields = inputters.load_fields_from_vocab(
+                [('tgt', model.tgt_vocabs[lang])],
+                data_type=model_opt.model_type)
+            decoder, generator, _ = build_decoder_and_generator(
+                model_opt, fields)
+            built[lang] = (_to_device(decoder, device),
+                           _to_device(generator, device))
+            load_module(built[lang][0], 'decoders/' + lang)
+            load_module(built[lang][1], 'generators/' + lang)
+        return built[lang][idx]
+
+    model.encoders = LazyModuleList(build(encoder, model.encoder_ids))
+    model.decoders = LazyModuleList(build(
+        functools.partial(decoder_and_generator, 0), model.decoder_ids))
+    model.generators = LazyModuleList(build(
+        functools.partial(decoder_and_generator, 1), model.decoder_ids))
+    _to_device(model, device)
+    load_module(model.attention_bridge, 'attention_bridge')
+    return model, model_opt
 
 
 def load_test_model(opt, dummy_opt, model_path=None):
@@ -149,9 +267,7 @@ def load_test_model(opt, dummy_opt, model_path=None):
         checkpoint['vocab'], data_type=opt.data_type)
 
     model_opt = checkpoint['opt']
-    for arg in dummy_opt:
-        if arg not in model_opt:
-            model_opt.__dict__[arg] = dummy_opt[arg]
+    _add_default_opts(model_opt, dummy_opt)
     model = build_base_model(model_opt, fields, use_gpu(opt), checkpoint)
     model.eval()
     model.generator.eval()
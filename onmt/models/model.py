@@ -55,15 +55,73 @@ class MultiTaskModel(nn.Module):
         """
         tgt = tgt[:-1]  # exclude last target from inputs
 
-        encoder = self.encoders[self.encoder_ids[src_task]]
-        decoder = self.decoders[self.decoder_ids[tgt_task]]
+        enc_final, memory_bank, alphas = self.encode(src, src_task, lengths)
+        decoder_outputs, attns, dec_state = \
+            self.decode(src, tgt, tgt_task, lengths, enc_final, memory_bank,
+                        dec_state)
+        return decoder_outputs, attns, dec_state, alphas
 
-        enc_final, memory_bank = encoder(src, lengths)
+    def forward_grouped(self, src, tgts, src_task, lengths):
+        """Forward propagate `src` once through its encoder and the
+        attention bridge, then several targets through their decoders.
 
+        Args:
+            src (:obj:`Tensor`): the source sequences, as in `forward`.
+            tgts (list): `(tgt, tgt_task, index)` triples: a target
+                sequence of size `[tgt_len x n]`, its language, and the
+                `LongTensor` of the `n` rows of `src` it is the
+                translation of (None for all of them, e.g. multi-parallel
+                data).
+            src_task: the source language.
+            lengths(:obj:`LongTensor`): the src lengths, pre-padding `[batch]`.
+        Returns:
+            A list of `(decoder_outputs, attns, dec_state, alphas)` tuples,
+            as returned by `forward`, one per target.
+        """
+        enc_final, memory_bank, alphas = self.encode(src, src_task, lengths)
+
+        results = []
+        for tgt, tgt_task, index in tgts:
+            tgt = tgt[:-1]  # exclude last target from inputs
+            if index is None:
+                decoder_outputs, attns, dec_state = \
+                    self.decode(src, tgt, tgt_task, lengths, enc_final,
+                                memory_bank)
+                results.append((decoder_outputs, attns, dec_state, alphas))
+                continue
+
+            decoder_outputs, attns, dec_state = \
+                self.decode(_select_rows(src, index, 1), tgt, tgt_task,
+                            _select_rows(lengths, index, 0),
+                            _select_rows(enc_final, index, 1),
+                            _select_rows(memory_bank, index, 1))
+            results.append((decoder_outputs, attns, dec_state,
+                            _select_rows(alphas, index, 0)))
+        return results
+
+    def encode(self, src, src_task, lengths):
+        """Run the encoder of `src_task`, then the attention bridge.
 
+        Returns:
+            The final encoder state, the memory bank `[len x batch x
+            hidden]` and the attention bridge weights `[batch x heads x
+            src_len]` (None without attention bridge).
+        """
+        encoder = self.encoders[self.encoder_ids[src_task]]
+        enc_final, memory_bank = encoder(src, lengths)
+
+        alphas = None
         # Implement attention bridge/compound attention
         if self.use_attention_bridge:
             alphas, memory_bank = self.attention_bridge(memory_bank, src)
+        return enc_final, memory_bank, alphas
+
+    def decode(self, src, tgt, tgt_task, lengths, enc_final, memory_bank,
+               dec_state=None):
+        """Run the decoder of `tgt_task` on the encoded `src`. Unlike
+        `forward`, `tgt` must already exclude the last target.
+        """
+        decoder = self.decoders[self.decoder_ids[tgt_task]]
 
         enc_state = \
             decoder.init_decoder_state(src, memory_bank, enc_final)
@@ -78,8 +136,30 @@ class MultiTaskModel(nn.Module):
             # Not yet supported on multi-gpu
             dec_state = None
             attns = None
-        return decoder_outputs, attns, dec_state, alphas
+        return decoder_outputs, attns, dec_state
 
+    def language_modules(self):
+        """The modules specific to a language, with keys
+        `('encoder', lang)`, `('decoder', lang)` and `('generator', lang)`.
+        """
+        modules = {}
+        for lang, idx in self.encoder_ids.items():
+            modules[('encoder', lang)] = self.encoders[idx]
+        for lang, idx in self.decoder_ids.items():
+            modules[('decoder', lang)] = self.decoders[idx]
+            # Generators are in the order of the decoders.
+            modules[('generator', lang)] = self.generators[idx]
+        return modules
+
+
+def _select_rows(x, index, dim):
+    """ Select the `index` entries of the batch dimension `dim` of `x`,
+    which may be a tuple of tensors (e.g. LSTM states) or None. """
+    if x is None:
+        return None
+    if isinstance(x, tuple):
+        return tuple(_select_rows(t, index, dim) for t in x)
+    return x.index_select(dim, index)
 
 
 class NMTModel(nn.Module):
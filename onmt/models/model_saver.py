@@ -1,24 +1,54 @@
+import contextlib
+import copy
+import itertools
 import os
+import shutil
+import threading
 import torch
 import torch.nn as nn
 
 import onmt.inputters
 
 from collections import deque
+from six.moves.queue import Queue
+from onmt.models.sharded_checkpoint import save_sharded_checkpoint
+from onmt.models.tensor_checkpoint import save_tensor_checkpoint, \
+    check_tensor_checkpoints
 from onmt.utils.logging import logger
 
 
 def build_model_saver(model_opt, opt, model, fields, optim):
-    model_saver = ModelSaver(opt.save_model,
-                             model,
-                             model_opt,
-                             fields,
-                             optim,
-                             opt.save_checkpoint_steps,
-                             opt.keep_checkpoint)
+    if opt.checkpoint_format == 'tensors':
+        check_tensor_checkpoints()
+    saver_class = AsyncModelSaver if opt.async_checkpoint else ModelSaver
+    model_saver = saver_class(opt.save_model,
+                              model,
+                              model_opt,
+                              fields,
+                              optim,
+                              opt.save_checkpoint_steps,
+                              opt.keep_checkpoint,
+                              opt.checkpoint_format)
     return model_saver
 
 
+@contextlib.contextmanager
+def _parameters_replaced(model, values):
+    """ Replace the data of the parameters of `model` with `values`. """
+    if values is None:
+        yield
+        return
+    params = list(model.parameters())
+    data = [param.data for param in params]
+    for param, value in zip(params, values):
+        param.data = value.to(param.dtype)
+    try:
+        yield
+    finally:
+        for param, param_data in zip(params, data):
+            param.data = param_data
+
+
 class ModelSaverBase(object):
     """
         Base class for model saving operations
@@ -36,15 +66,21 @@ class ModelSaverBase(object):
         self.optim = optim
         self.keep_checkpoint = keep_checkpoint
         self.save_checkpoint_steps = save_checkpoint_steps
+        self.last_checkpoint = None
 
         if keep_checkpoint > 0:
             self.checkpoint_queue = deque([], maxlen=keep_checkpoint)
 
-    def maybe_save(self, step):
+    def maybe_save(self, step, moving_average=None):
         """
         Main entry point for model saver
         It wraps the `_save` method with checks and apply `keep_checkpoint`
         related logic
+
+        Args:
+            step (int): step number
+            moving_average (list): averages of the parameters of the
+                model, saved instead of them if given
         """
         if self.keep_checkpoint == 0:
             return
@@ -52,7 +88,9 @@ class ModelSaverBase(object):
         if step % self.save_checkpoint_steps != 0:
             return
 
-        chkpt, chkpt_name = self._save(step)
+        with _parameters_replaced(self.model, moving_average):
+            chkpt, chkpt_name = self._save(step)
+        self.last_checkpoint = chkpt_name
 
         if self.keep_checkpoint > 0:
             if len(self.checkpoint_queue) == self.checkpoint_queue.maxlen:
@@ -82,23 +120,58 @@ class ModelSaverBase(object):
         """
         raise NotImplementedError()
 
+    def close(self):
+        """ Wait for the checkpoints being saved, if any. """
+        pass
+
 
 # WORKING: update this class to support multi-enc, multi-dec
 class ModelSaver(ModelSaverBase):
     """
         Simple model saver to filesystem
+
+        Checkpoints are either files, or with `checkpoint_format`
+        'sharded', directories with a file per module (see
+        `onmt.models.sharded_checkpoint`), or with 'tensors', files of
+        raw tensors (see `onmt.models.tensor_checkpoint`).
     """
 
     def __init__(self, base_path, model, model_opt, fields, optim,
-                 save_checkpoint_steps, keep_checkpoint=0):
+                 save_checkpoint_steps, keep_checkpoint=0,
+                 checkpoint_format='file'):
         super(ModelSaver, self).__init__(
             base_path, model, model_opt, fields, optim,
             save_checkpoint_steps, keep_checkpoint)
+        self.checkpoint_format = checkpoint_format
+
+    def _checkpoint_path(self, step):
+        if self.checkpoint_format == 'sharded':
+            return '%s_step_%d' % (self.base_path, step)
+        if self.checkpoint_format == 'tensors':
+            return '%s_step_%d.tensors' % (self.base_path, step)
+        return '%s_step_%d.pt' % (self.base_path, step)
+
+    def _write(self, checkpoint, path):
+        if self.checkpoint_format == 'sharded':
+            save_sharded_checkpoint(checkpoint, path)
+        elif self.checkpoint_format == 'tensors':
+            save_tensor_checkpoint(checkpoint, path)
+        else:
+            _save_atomically(checkpoint, path)
 
     def _save(self, step):
-        real_model = (self.model.module
-                      if isinstance(self.model, nn.DataParallel)
-                      else self.model)
+        checkpoint = self._checkpoint(self.model, self.optim)
+
+        checkpoint_path = self._checkpoint_path(step)
+        logger.info("Saving checkpoint %s" % checkpoint_path)
+        self._write(checkpoint, checkpoint_path)
+        return checkpoint, checkpoint_path
+
+    def _checkpoint(self, model, optim):
+        """ The checkpoint of `model` and `optim`. """
+        real_model = (model.module
+                      if isinstance(model, nn.DataParallel)
+                      else model)
         #real_generator = (real_model.generator.module
         #                  if isinstance(real_model.generator, nn.DataParallel)
         #                  else real_model.generator)
@@ -113,14 +186,153 @@ class ModelSaver(ModelSaverBase):
             'vocab': onmt.inputters.save_fields_to_vocab(self.fields),
             # WORKING: updating serialization for multi enc-dec
             'opt': self.model_opt,
-            'optim': self.optim,
-            'whole_model': self.model
+            'optim': optim,
+            'whole_model': model
         }
+        return checkpoint
+
+    def _rm_checkpoint(self, name):
+        if os.path.isdir(name):
+            shutil.rmtree(name)
+        else:
+            os.remove(name)
+
+
+class AsyncModelSaver(ModelSaver):
+    """
+        Model saver writing checkpoints in a background thread
+
+        The model and the optimizer are copied to CPU (pinned) tensors,
+        which is all the training loop waits for, then a background
+        thread serializes the copies to a temporary file, renames it to
+        the checkpoint path and removes the checkpoints over
+        `keep_checkpoint`, in order. Copies are double-buffered: a new
+        checkpoint only waits for the one before the last to be written.
+    """
+
+    def __init__(self, base_path, model, model_opt, fields, optim,
+                 save_checkpoint_steps, keep_checkpoint=0,
+                 checkpoint_format='file'):
+        super(AsyncModelSaver, self).__init__(
+            base_path, model, model_opt, fields, optim,
+            save_checkpoint_steps, keep_checkpoint, checkpoint_format)
+        self.slots = [_Snapshot() for _ in range(2)]
+        self.next_slot = 0
+        self.error = None
+        self.queue = Queue()
+        self.writer = threading.Thread(target=self._write_checkpoints)
+        self.writer.daemon = True
+        self.writer.start()
 
-        logger.info("Saving checkpoint %s_step_%d.pt" % (self.base_path, step))
-        checkpoint_path = '%s_step_%d.pt' % (self.base_path, step)
-        torch.save(checkpoint, checkpoint_path)
+    def _save(self, step):
+        self._check_error()
+        slot = self.slots[self.next_slot]
+        self.next_slot = (self.next_slot + 1) % len(self.slots)
+        # The copies of the slot may still be being written.
+        slot.written.wait()
+        slot.written.clear()
+        model, optim = slot.copy(self.model, self.optim)
+        checkpoint = self._checkpoint(model, optim)
+
+        checkpoint_path = self._checkpoint_path(step)
+        logger.info("Saving checkpoint %s in the background"
+                    % checkpoint_path)
+        self.queue.put((self._write_in_background,
+                        (checkpoint, checkpoint_path), slot.written))
         return checkpoint, checkpoint_path
 
+    def _write_in_background(self, checkpoint, path):
+        self._write(checkpoint, path)
+        logger.info("Saved checkpoint %s" % path)
+
     def _rm_checkpoint(self, name):
-        os.remove(name)
+        # After the previous checkpoints are written.
+        self.queue.put((super(AsyncModelSaver, self)._rm_checkpoint,
+                        (name,), None))
+
+    def _write_checkpoints(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            task, args, done = item
+            try:
+                if self.error is None:
+                    task(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                if done is not None:
+                    done.set()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise RuntimeError("Saving a checkpoint failed: %s" % self.error)
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+        self._check_error()
+
+
+def _save_atomically(checkpoint, path):
+    """ Save `checkpoint` to `path`, which is never left incomplete. """
+    tmp_path = path + '.tmp'
+    torch.save(checkpoint, tmp_path)
+    os.rename(tmp_path, path)
+
+
+class _Snapshot(object):
+    """
+    CPU copies of a model and of its optimizer, refreshed in place.
+
+    The model is copied once, with CPU tensors (pinned with CUDA) instead
+    of its parameters and buffers, then only the tensors are copied. The
+    optimizer, whose state may gain tensors during training, is copied
+    again every time, but reuses the CPU tensors of the previous copy.
+    """
+
+    def __init__(self):
+        self.written = threading.Event()
+        self.written.set()
+        self.model = None
+        # id of a model or optimizer tensor -> its CPU copy.
+        self.tensors = {}
+
+    def _cpu_tensor(self, tensor):
+        cpu = self.tensors.get(id(tensor))
+        if cpu is None or cpu.size() != tensor.size() \
+                or cpu.dtype != tensor.dtype:
+            cpu = torch.empty(tensor.size(), dtype=tensor.dtype,
+                              pin_memory=tensor.is_cuda)
+            if isinstance(tensor, nn.Parameter):
+                cpu = nn.Parameter(cpu, requires_grad=tensor.requires_grad)
+            self.tensors[id(tensor)] = cpu
+        cpu.data.copy_(tensor.data, non_blocking=True)
+        return cpu
+
+    def copy(self, model, optim):
+        """ Return the copies of `model` and `optim`. """
+        # deepcopy takes the tensors of `memo` instead of copying them.
+        memo = {}
+        for tensor in itertools.chain(model.parameters(), model.buffers()):
+            memo[id(tensor)] = self._cpu_tensor(tensor)
+        if self.model is None:
+            # Other tensors held by modules, e.g. activations cached by the
+            # last forward pass, are not copied.
+            for module in model.modules():
+                for value in module.__dict__.values():
+                    if torch.is_tensor(value) and id(value) not in memo:
+                        memo[id(value)] = None
+            self.model = copy.deepcopy(model, memo)
+
+        for state in optim.optimizer.state.values():
+            for value in state.values():
+                if torch.is_tensor(value):
+                    memo[id(value)] = self._cpu_tensor(value)
+        optim = copy.deepcopy(optim, dict(memo))
+
+        # Wait for the asynchronous copies.
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return self.model, optim
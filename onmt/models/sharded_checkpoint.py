@@ -0,0 +1,217 @@
+"""
+Checkpoints of multi-task models with a file per language module
+
+A sharded checkpoint is a directory with:
+
+    manifest.pt: everything but the tensors of the model and the state of
+        the optimizer, and where to find the tensors of every shard
+    encoders/<lang>.pt, decoders/<lang>.pt, generators/<lang>.pt,
+    attention_bridge.pt: the state dict of each module
+    shared.pt: the other tensors of the model
+    optim.pt: the state dict of the optimizer
+
+A tensor shared by several modules (e.g. shared embeddings) is only
+stored in the first shard that has it, the others refer to it.
+"""
+import copy
+import os
+import shutil
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from onmt.models.tensor_checkpoint import is_tensor_checkpoint, \
+    load_tensor_checkpoint
+
+MANIFEST = 'manifest.pt'
+SHARED = 'shared'
+OPTIM = 'optim.pt'
+
+
+def model_shards(model):
+    """
+    The modules of `model` stored in their own shard, by shard name:
+    'encoders/<lang>', 'decoders/<lang>', 'generators/<lang>' and
+    'attention_bridge'.
+    """
+    shards = OrderedDict()
+    for (kind, lang), module in sorted(model.language_modules().items()):
+        shards['%ss/%s' % (kind, lang)] = module
+    shards['attention_bridge'] = model.attention_bridge
+    return shards
+
+
+def _shard_file(name):
+    return name + '.pt'
+
+
+def save_sharded_checkpoint(checkpoint, path):
+    """
+    Save `checkpoint` (see `ModelSaver._checkpoint`) as the sharded
+    checkpoint `path`, written in a temporary directory first so that
+    `path` is never left incomplete.
+    """
+    model = checkpoint['whole_model']
+    module_names = {id(module): name
+                    for name, module in model.named_modules()}
+    state = model.state_dict(keep_vars=True)
+
+    # Shard name -> state dict key prefix, the shared tensors last.
+    prefixes = OrderedDict(
+        (name, module_names[id(module)] + '.')
+        for name, module in model_shards(model).items())
+    prefixes[SHARED] = ''
+
+    shards = OrderedDict((name, OrderedDict()) for name in prefixes)
+    ties = OrderedDict((name, OrderedDict()) for name in prefixes)
+    # id of a tensor -> its shard and key in the shard.
+    owners = {}
+    for full_key, tensor in state.items():
+        name = next(name for name, prefix in prefixes.items()
+                    if full_key.startswith(prefix))
+        key = full_key[len(prefixes[name]):]
+        if id(tensor) in owners:
+            ties[name][key] = owners[id(tensor)]
+        else:
+            owners[id(tensor)] = (name, key)
+            shards[name][key] = tensor.detach()
+
+    # The optimizer is saved without the parameters it refers to.
+    optim = copy.copy(checkpoint['optim'])
+    optim.params, optim.sparse_params, optim.optimizer = [], [], None
+
+    manifest = {k: v for k, v in checkpoint.items()
+                if k not in ['model', 'whole_model', 'optim']}
+    manifest.update({
+        'optim': optim,
+        'src_vocabs': model.src_vocabs,
+        'tgt_vocabs': model.tgt_vocabs,
+        'encoder_ids': model.encoder_ids,
+        'decoder_ids': model.decoder_ids,
+        'shards': OrderedDict(
+            (name, {'prefix': prefixes[name], 'file': _shard_file(name),
+                    'ties': ties[name]})
+            for name in prefixes),
+    })
+
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    for name, shard in shards.items():
+        shard_path = os.path.join(tmp_path, _shard_file(name))
+        if not os.path.isdir(os.path.dirname(shard_path)):
+            os.makedirs(os.path.dirname(shard_path))
+        torch.save(shard, shard_path)
+    torch.save(checkpoint['optim'].optimizer.state_dict(),
+               os.path.join(tmp_path, OPTIM))
+    # Written last: a directory with a manifest is complete.
+    torch.save(manifest, os.path.join(tmp_path, MANIFEST))
+    os.rename(tmp_path, path)
+
+
+def is_sharded_checkpoint(path):
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def load_manifest(path):
+    """ The manifest of the sharded checkpoint `path`. """
+    return torch.load(os.path.join(path, MANIFEST),
+                      map_location=lambda storage, loc: storage)
+
+
+def _load(path, mmap):
+    if mmap:
+        return torch.load(path, map_location='cpu', mmap=True)
+    return torch.load(path, map_location=lambda storage, loc: storage)
+
+
+class ShardLoader(object):
+    """
+    Loads the shards of a sharded checkpoint on demand, along with the
+    shards holding the tensors they share.
+
+    Args:
+        path (str): the checkpoint directory.
+        manifest (dict): its manifest, loaded if None.
+        mmap (bool): memory-map the shards rather than read them.
+    """
+
+    def __init__(self, path, manifest=None, mmap=False):
+        self.path = path
+        self.manifest = load_manifest(path) if manifest is None else manifest
+        self.mmap = mmap
+
+    def _load_file(self, name, files):
+        if name not in files:
+            info = self.manifest['shards'][name]
+            files[name] = _load(os.path.join(self.path, info['file']),
+                                self.mmap)
+        return files[name]
+
+    def load(self, name, files=None):
+        """
+        The state dict of shard `name`, with the tensors it shares. The
+        files loaded along the way are kept in `files` if given.
+        """
+        files = {} if files is None else files
+        state = OrderedDict(self._load_file(name, files))
+        for key, (owner, owner_key) in \
+                self.manifest['shards'][name]['ties'].items():
+            state[key] = self._load_file(owner, files)[owner_key]
+        return state
+
+    def model_state_dict(self):
+        """ The state dict of the whole model. """
+        state = OrderedDict()
+        files = {}
+        for name, info in self.manifest['shards'].items():
+            for key, tensor in self.load(name, files).items():
+                state[info['prefix'] + key] = tensor
+        return state
+
+
+class LazyModuleList(nn.Module):
+    """
+    List of modules built on first access, e.g. the encoders of all the
+    languages of a model, of which a translator only uses one. Modules
+    not accessed yet are not submodules, e.g. `to()` ignores them.
+
+    Args:
+        builders (list): functions returning each module, ready for use.
+    """
+
+    def __init__(self, builders):
+        super(LazyModuleList, self).__init__()
+        self._builders = builders
+
+    def __getitem__(self, idx):
+        key = str(idx)
+        if key not in self._modules:
+            self.add_module(key, self._builders[idx]())
+        return self._modules[key]
+
+    def __len__(self):
+        return len(self._builders)
+
+
+def load_checkpoint(path, mmap=False):
+    """
+    Load the checkpoint `path`, either a file, a sharded checkpoint or a
+    tensor checkpoint (see `onmt.models.tensor_checkpoint`). A sharded
+    checkpoint is loaded whole, as a dict with the keys of a checkpoint
+    file but 'whole_model', and with the state dict of the optimizer
+    under 'optim_state'. With `mmap`, the tensors of checkpoint files
+    and shards are memory-mapped rather than read (those of tensor
+    checkpoints always are).
+    """
+    if is_tensor_checkpoint(path):
+        return load_tensor_checkpoint(path)
+    if not is_sharded_checkpoint(path):
+        return _load(path, mmap)
+
+    loader = ShardLoader(path, mmap=mmap)
+    checkpoint = dict(loader.manifest)
+    checkpoint['model'] = loader.model_state_dict()
+    checkpoint['optim_state'] = _load(os.path.join(path, OPTIM), mmap)
+    return checkpoint
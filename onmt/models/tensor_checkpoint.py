@@ -0,0 +1,265 @@
+"""
+Checkpoints as a single file of raw tensors, memory-mapped when loaded
+
+A tensor checkpoint is:
+
+    MAGIC
+    the length of the header: 8 bytes, little-endian
+    the header: JSON, padded with spaces to a multiple of ALIGNMENT bytes
+    the tensors, each at a multiple of ALIGNMENT bytes
+
+The header has the dtype, shape and offset of every tensor, and the rest
+of the checkpoint (options, vocabs, optimizer) as JSON, with the tensors
+replaced by their name. Loading a checkpoint unpickles nothing: its
+tensors are views of the mapped file, whose pages are shared by all the
+processes loading it. A tensor shared by several modules is stored once.
+"""
+import argparse
+import copy
+import inspect
+import json
+import os
+import struct
+from collections import Counter, defaultdict
+
+import torch
+import torch.nn as nn
+import torchtext
+
+from onmt.utils.mixed_precision import DynamicLossScaler
+from onmt.utils.optimizers import Optimizer
+
+MAGIC = b'ONMTTNSR'
+ALIGNMENT = 64
+
+_DTYPE_NAMES = ['float64', 'float32', 'float16', 'bfloat16',
+                'int64', 'int32', 'int16', 'int8', 'uint8', 'bool']
+# Classes stored as their attributes.
+_OBJECTS = {cls.__name__: cls for cls in [Optimizer, DynamicLossScaler]}
+
+
+def tensor_checkpoints_available():
+    """
+    Whether this version of PyTorch can map files to tensors and load
+    state dicts by assignment (PyTorch 2.1 or later), as tensor
+    checkpoints require.
+    """
+    return hasattr(torch, 'from_file') and 'assign' in \
+        inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def check_tensor_checkpoints():
+    """
+    Raise a `ValueError` if tensor checkpoints are not available with
+    this version of PyTorch.
+    """
+    if not tensor_checkpoints_available():
+        raise ValueError("Tensor checkpoints require PyTorch 2.1 or "
+                         "later, use -checkpoint_format file or sharded.")
+
+
+def _dtypes():
+    """ The dtypes of this version of PyTorch, by name. """
+    return {name: getattr(torch, name) for name in _DTYPE_NAMES
+            if hasattr(torch, name)}
+
+
+def _child(name, key):
+    return '%s/%s' % (name, key) if name else str(key)
+
+
+class _Encoder(object):
+    """ Encodes objects as JSON, and collects their tensors by name. """
+
+    def __init__(self):
+        self.tensors = []
+        # Storage, offset, shape and dtype of a tensor -> its name.
+        self._names = {}
+
+    def _add_tensor(self, name, tensor):
+        key = (tensor.data_ptr(), tensor.storage_offset(),
+               tuple(tensor.size()), tuple(tensor.stride()), tensor.dtype)
+        if key not in self._names:
+            self._names[key] = name
+            self.tensors.append((name, tensor))
+        return self._names[key]
+
+    def encode(self, obj, name):
+        if obj is None or isinstance(obj, (bool, int, float, str)):
+            return obj
+        if torch.is_tensor(obj):
+            return {'tensor': self._add_tensor(name, obj)}
+        if isinstance(obj, (list, tuple)):
+            return [self.encode(v, _child(name, i))
+                    for i, v in enumerate(obj)]
+        if isinstance(obj, dict):
+            return {'dict': [[k, self.encode(v, _child(name, k))]
+                             for k, v in obj.items()]}
+        if isinstance(obj, argparse.Namespace):
+            return {'namespace': self.encode(vars(obj), name)}
+        if isinstance(obj, torchtext.vocab.Vocab):
+            return {'vocab': {'itos': obj.itos,
+                              'freqs': self.encode(dict(obj.freqs), name)}}
+        if type(obj).__name__ in _OBJECTS:
+            return {'object': type(obj).__name__,
+                    'attrs': self.encode(vars(obj), name)}
+        raise TypeError('Cannot store a %s in a tensor checkpoint (%s)'
+                        % (type(obj).__name__, name))
+
+
+def _decode(obj, tensors):
+    if isinstance(obj, list):
+        return [_decode(v, tensors) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if 'tensor' in obj:
+        return tensors[obj['tensor']]
+    if 'dict' in obj:
+        return dict((k, _decode(v, tensors)) for k, v in obj['dict'])
+    if 'namespace' in obj:
+        return argparse.Namespace(**_decode(obj['namespace'], tensors))
+    if 'vocab' in obj:
+        vocab = torchtext.vocab.Vocab.__new__(torchtext.vocab.Vocab)
+        vocab.itos = obj['vocab']['itos']
+        vocab.stoi = defaultdict(
+            lambda: 0, ((w, i) for i, w in enumerate(vocab.itos)))
+        vocab.freqs = Counter(_decode(obj['vocab']['freqs'], tensors))
+        vocab.vectors = None
+        return vocab
+    instance = _OBJECTS[obj['object']].__new__(_OBJECTS[obj['object']])
+    instance.__dict__.update(_decode(obj['attrs'], tensors))
+    return instance
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save_tensor_checkpoint(checkpoint, path, transform=None):
+    """
+    Save `checkpoint` as the tensor checkpoint `path`, written in a
+    temporary file first so that `path` is never left incomplete. The
+    checkpoint is stored as `load_tensor_checkpoint` returns it.
+
+    Args:
+        checkpoint (dict): a checkpoint, as `ModelSaver._checkpoint` or
+            `onmt.models.sharded_checkpoint.load_checkpoint` return it.
+        path (str): the checkpoint file.
+        transform (function): if given, `transform(name, tensor)`, of
+            the same dtype and shape, is written instead of every tensor
+            of the checkpoint, `name` being 'model/<key>' for those of
+            the model. The tensors are transformed one at a time, as
+            they are written.
+    """
+    check_tensor_checkpoints()
+    contents = {k: v for k, v in checkpoint.items()
+                if k not in ['whole_model', 'optim']}
+    model = checkpoint.get('whole_model')
+    if model is not None:
+        contents.update({
+            'src_vocabs': model.src_vocabs,
+            'tgt_vocabs': model.tgt_vocabs,
+            'encoder_ids': model.encoder_ids,
+            'decoder_ids': model.decoder_ids,
+        })
+    for ids, vocabs in [('encoder_ids', 'src_vocabs'),
+                        ('decoder_ids', 'tgt_vocabs')]:
+        if ids not in contents:
+            # The modules are in the order of the vocabs.
+            contents[ids] = {lang: idx for idx, lang
+                             in enumerate(contents[vocabs])}
+
+    optim = checkpoint.get('optim')
+    if optim is not None and optim.optimizer is not None:
+        # The optimizer is saved without the parameters it refers to.
+        contents['optim_state'] = optim.optimizer.state_dict()
+        optim = copy.copy(optim)
+        optim.params, optim.sparse_params, optim.optimizer = [], [], None
+    if optim is not None:
+        contents['optim'] = optim
+
+    encoder = _Encoder()
+    header = {'checkpoint': encoder.encode(contents, None)}
+    header['tensors'] = {}
+    offset = 0
+    for name, tensor in encoder.tensors:
+        header['tensors'][name] = {
+            'dtype': str(tensor.dtype).replace('torch.', ''),
+            'shape': list(tensor.size()),
+            'offset': offset}
+        offset = _aligned(offset + tensor.numel() * tensor.element_size())
+
+    header = json.dumps(header).encode('utf-8')
+    start = _aligned(len(MAGIC) + 8 + len(header))
+    header += b' ' * (start - len(MAGIC) - 8 - len(header))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, tensor in encoder.tensors:
+            f.seek(start + _aligned(f.tell() - start))
+            if transform is not None:
+                tensor = transform(name, tensor)
+            data = tensor.detach().cpu().contiguous().view(-1)
+            f.write(memoryview(data.view(torch.uint8).numpy()))
+    # os.replace is Python 3 only, os.rename replaces files on POSIX.
+    getattr(os, 'replace', os.rename)(tmp_path, path)
+
+
+def is_tensor_checkpoint(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_tensor_checkpoint(path):
+    """
+    Load the tensor checkpoint `path`, as a dict with the keys of a
+    checkpoint file but 'whole_model', with the state dict of the
+    optimizer under 'optim_state' and the 'src_vocabs', 'tgt_vocabs',
+    'encoder_ids' and 'decoder_ids' of the model. Its tensors are on the
+    CPU, in the mapped file: writing to them does not change the file.
+    """
+    check_tensor_checkpoints()
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a tensor checkpoint' % path)
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+        start = f.tell()
+
+    blob = torch.from_file(path, shared=False,
+                           size=os.path.getsize(path), dtype=torch.uint8)
+    dtypes = _dtypes()
+    tensors = {}
+    for name, info in header['tensors'].items():
+        if info['dtype'] not in dtypes:
+            raise ValueError('%s has %s tensors, which this version of '
+                             'PyTorch does not have' % (path, info['dtype']))
+        dtype = dtypes[info['dtype']]
+        numel = 1
+        for dim in info['shape']:
+            numel *= dim
+        begin = start + info['offset']
+        end = begin + numel * torch.tensor([], dtype=dtype).element_size()
+        tensors[name] = blob[begin:end].view(dtype).view(info['shape'])
+    return _decode(header['checkpoint'], tensors)
+
+
+def module_state(checkpoint, name):
+    """
+    The state dict of the module `name` of a loaded tensor checkpoint,
+    named as the shards of `onmt.models.sharded_checkpoint`.
+    """
+    if name == 'attention_bridge':
+        prefix = 'attention_bridge.'
+    else:
+        kind, lang = name.split('/')
+        ids = checkpoint['encoder_ids' if kind == 'encoders'
+                         else 'decoder_ids']
+        prefix = '%s.%d.' % (kind, ids[lang])
+    return {key[len(prefix):]: tensor
+            for key, tensor in checkpoint['model'].items()
+            if key.startswith(prefix)}
@@ -0,0 +1,168 @@
+"""
+Linear + log-softmax generator fused with its loss, streaming over chunks
+of the vocabulary instead of materializing the `[n x vocab]` scores.
+"""
+from __future__ import division
+
+import math
+
+import torch
+from torch.autograd import Function
+
+
+def _chunk_scores(hidden, weight, bias, start, chunk_size):
+    """ Scores `[n x chunk]` of the classes `start:start + chunk_size`. """
+    weight = weight[start:start + chunk_size]
+    if bias is None:
+        return hidden.mm(weight.t())
+    return torch.addmm(bias[start:start + chunk_size], hidden, weight.t())
+
+
+def _column_in_chunk(index, start, size):
+    """ Whether `index` falls in the chunk, and its column in the chunk. """
+    in_chunk = (index >= start) & (index < start + size)
+    return in_chunk, (index - start).clamp(0, size - 1)
+
+
+def _xlogx(x):
+    return x * math.log(x) if x > 0 else 0.0
+
+
+class FusedGeneratorLossFunction(Function):
+    """
+    See `fused_generator_loss`. Only the log-sum-exp of every row is kept
+    for the backward pass, which computes the scores of each chunk again.
+    """
+
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, target, padding_idx,
+                label_smoothing, chunk_size):
+        n = hidden.size(0)
+        vocab_size = weight.size(0)
+
+        # Online log-sum-exp: running max and sum of exp(score - max).
+        max_score = hidden.new_full((n,), -float('inf'))
+        sum_exp = hidden.new_zeros(n)
+        pred = target.new_zeros(n)
+        target_score = hidden.new_zeros(n)
+        # Only needed with label smoothing.
+        sum_scores = hidden.new_zeros(n)
+        pad_score = hidden.new_zeros(n)
+
+        for start in range(0, vocab_size, chunk_size):
+            scores = _chunk_scores(hidden, weight, bias, start, chunk_size)
+            size = scores.size(1)
+
+            chunk_max, chunk_pred = scores.max(1)
+            pred = torch.where(chunk_max > max_score, chunk_pred + start,
+                               pred)
+            new_max = torch.max(max_score, chunk_max)
+            sum_exp = sum_exp * (max_score - new_max).exp() \
+                + (scores - new_max.unsqueeze(1)).exp().sum(1)
+            max_score = new_max
+
+            in_chunk, column = _column_in_chunk(target, start, size)
+            target_score = torch.where(
+                in_chunk, scores.gather(1, column.unsqueeze(1)).squeeze(1),
+                target_score)
+            if label_smoothing > 0:
+                sum_scores += scores.sum(1)
+                if start <= padding_idx < start + size:
+                    pad_score = scores[:, padding_idx - start]
+
+        lse = max_score + sum_exp.log()
+        non_padding = target.ne(padding_idx)
+
+        if label_smoothing > 0:
+            # KL-divergence with the smoothed distribution q, as in
+            # `LabelSmoothingLoss`: q = confidence for the target, 0 for
+            # padding and smoothing_value for the (vocab_size - 2) others.
+            confidence = 1.0 - label_smoothing
+            smoothing_value = label_smoothing / (vocab_size - 2)
+            others_log_prob = sum_scores - pad_score - target_score \
+                - (vocab_size - 2) * lse
+            loss = _xlogx(confidence) \
+                + (vocab_size - 2) * _xlogx(smoothing_value) \
+                - confidence * (target_score - lse) \
+                - smoothing_value * others_log_prob
+        else:
+            loss = lse - target_score
+        loss = (loss * non_padding.type_as(loss)).sum()
+
+        ctx.save_for_backward(hidden, weight, bias, target, lse)
+        ctx.padding_idx = padding_idx
+        ctx.label_smoothing = label_smoothing
+        ctx.chunk_size = chunk_size
+        ctx.mark_non_differentiable(pred)
+        return loss, pred
+
+    @staticmethod
+    def backward(ctx, grad_loss, grad_pred):
+        hidden, weight, bias, target, lse = ctx.saved_tensors
+        vocab_size = weight.size(0)
+        label_smoothing = ctx.label_smoothing
+        smoothing_value = label_smoothing / (vocab_size - 2)
+        confidence = 1.0 - label_smoothing
+
+        grad_hidden = grad_weight = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            grad_hidden = torch.zeros_like(hidden)
+        if ctx.needs_input_grad[1]:
+            grad_weight = torch.zeros_like(weight)
+        if bias is not None and ctx.needs_input_grad[2]:
+            grad_bias = torch.zeros_like(bias)
+
+        # d loss / d score = grad_loss * (p - q) on non padding rows.
+        row_scale = target.ne(ctx.padding_idx).type_as(hidden) * grad_loss
+        target_weight = (confidence - smoothing_value) \
+            if label_smoothing > 0 else 1.0
+        for start in range(0, vocab_size, ctx.chunk_size):
+            scores = _chunk_scores(hidden, weight, bias, start,
+                                   ctx.chunk_size)
+            size = scores.size(1)
+
+            grad_scores = (scores - lse.unsqueeze(1)).exp_()
+            if label_smoothing > 0:
+                grad_scores.sub_(smoothing_value)
+                if start <= ctx.padding_idx < start + size:
+                    grad_scores[:, ctx.padding_idx - start] += smoothing_value
+            in_chunk, column = _column_in_chunk(target, start, size)
+            grad_scores.scatter_add_(
+                1, column.unsqueeze(1),
+                in_chunk.type_as(hidden).unsqueeze(1) * -target_weight)
+            grad_scores.mul_(row_scale.unsqueeze(1))
+
+            if grad_hidden is not None:
+                grad_hidden.addmm_(grad_scores,
+                                   weight[start:start + ctx.chunk_size])
+            if grad_weight is not None:
+                grad_weight[start:start + size] = grad_scores.t().mm(hidden)
+            if grad_bias is not None:
+                grad_bias[start:start + size] = grad_scores.sum(0)
+
+        return grad_hidden, grad_weight, grad_bias, None, None, None, None
+
+
+def fused_generator_loss(hidden, weight, bias, target, padding_idx,
+                         label_smoothing=0.0, chunk_size=4096):
+    """
+    Loss of a `Linear(weight, bias)` + `LogSoftmax` generator, computed
+    over chunks of `chunk_size` classes so that the `[n x vocab]` scores
+    are never stored, neither for the forward nor for the backward pass.
+
+    Args:
+        hidden (FloatTensor): decoder outputs `[n x hidden]`.
+        weight (FloatTensor): generator weight `[vocab x hidden]`.
+        bias (FloatTensor): generator bias `[vocab]`, or None.
+        target (LongTensor): target classes `[n]`.
+        padding_idx (int): padding class, whose rows are ignored.
+        label_smoothing (float): if positive, the loss of
+            `LabelSmoothingLoss`, else the summed negative log-likelihood.
+        chunk_size (int): number of classes scored at once.
+
+    Returns:
+        The summed loss, and the most likely class of every row `[n]`.
+    """
+    return FusedGeneratorLossFunction.apply(
+        hidden, weight, bias, target, padding_idx, label_smoothing,
+        chunk_size)
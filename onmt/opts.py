@@ -169,6 +169,18 @@ def preprocess_opts(parser):
                        64 bytes. A commonly used sharding value is 131072000.
                        It is recommended to ensure the corpus is shuffled
                        before sharding.""")
+    group.add_argument('-num_workers', type=int, default=1,
+                       help="""Number of processes used to build and save
+                       the text shards in parallel. Only used together with
+                       -max_shard_size. Shards keep the same numbering
+                       whatever the number of workers.""")
+    group.add_argument('-numericalize', action='store_true',
+                       help="""Save text shards as flat arrays of vocabulary
+                       ids instead of pickled torchtext Examples. They are
+                       much faster to load and to batch during training.
+                       The training corpus is read twice: once to build
+                       the vocabulary, once to save the shards.
+                       Not compatible with -dynamic_dict.""")
 
     # Dictionary options, for text corpus
 
@@ -241,6 +253,25 @@ def train_opts(parser):
     group.add_argument('-src_tgt', required=True, nargs='+', type=str,
                        help="""src and tgt language codes in the form
                        <src>-<tgt>""")
+    group.add_argument('-pair_sampling', default='uniform',
+                       choices=['uniform', 'proportional', 'temperature',
+                                'round_robin', 'schedule'],
+                       help="""How the language pair of each training batch
+                       is chosen: uniformly at random, at random
+                       proportionally to the number of tokens of each
+                       corpus (counted by preprocess.py), at random with
+                       temperature -sampling_temperature, in turn, or
+                       following the -pair_schedule file.""")
+    group.add_argument('-sampling_temperature', type=float, default=5.0,
+                       help="""Temperature T of -pair_sampling temperature:
+                       pairs are drawn with probabilities proportional to
+                       their size ** (1 / T). 1 is proportional sampling,
+                       higher values upsample the small corpora.""")
+    group.add_argument('-pair_schedule', type=str, default=None,
+                       help="""Static schedule of -pair_sampling schedule,
+                       repeated throughout training: a file of
+                       "<src>-<tgt> [count]" lines, each scheduling the pair
+                       for count (default 1) batches in a row.""")
 
     group.add_argument('-save_model', default='model',
                        help="""Model filename (the model will be saved as
@@ -251,6 +282,26 @@ def train_opts(parser):
                        help="""Save a checkpoint every X steps""")
     group.add_argument('-keep_checkpoint', type=int, default=-1,
                        help="""Keep X checkpoints (negative: keep all)""")
+    group.add_argument('-checkpoint_format', default='file',
+                       choices=['file', 'sharded', 'tensors'],
+                       help="""Save checkpoints as a single file, as a
+                       directory with a file per encoder, decoder,
+                       generator and attention bridge, and a
+                       manifest, or as a file of raw tensors with a JSON
+                       header, which is memory-mapped rather than
+                       unpickled when loaded.""")
+    group.add_argument('-async_checkpoint', action='store_true',
+                       help="""Copy the model and optimizer to CPU memory
+                       when saving a checkpoint, and write it to disk in a
+                       background thread while training goes on.""")
+    group.add_argument('-average_decay', type=float, default=0,
+                       help="""Keep an exponential moving average of the
+                       weights with this decay (e.g. 0.9999), and save it
+                       in the checkpoints instead of the weights. 0 keeps
+                       no average.""")
+    group.add_argument('-average_every', type=int, default=1,
+                       help="""Update the moving average of the weights
+                       every X steps.""")
 
     # GPU
     group.add_argument('-gpuid', default=[], nargs='+', type=int,
@@ -263,6 +314,11 @@ def train_opts(parser):
                        help="Type of torch distributed backend")
     group.add_argument('-gpu_verbose_level', default=0, type=int,
                        help="Gives more info on each process per GPU.")
+    group.add_argument('-overlap_grad_reduce', action='store_true',
+                       help="""With several GPUs, sum the gradients of the
+                       encoders and decoders used in each step in buckets
+                       during its last backward pass, instead of after
+                       it.""")
 
     group.add_argument('-seed', type=int, default=-1,
                        help="""Random seed used for the experiments
@@ -307,6 +363,12 @@ def train_opts(parser):
                        choices=["sents", "tokens"],
                        help="""Batch grouping for batch_size. Standard
                                is sents. Tokens will do dynamic batching""")
+    group.add_argument('-bucket_batches', action='store_true',
+                       help="""With -batch_type tokens, build the training
+                       batches of each text shard over its examples sorted
+                       by length, which fills the batch_size token budget
+                       with little padding, instead of over pools of
+                       consecutive examples.""")
     group.add_argument('-normalization', default='sents',
                        choices=["sents", "tokens"],
                        help='Normalization method of the gradient.')
@@ -315,10 +377,46 @@ def train_opts(parser):
                        Approximately equivalent to updating
                        batch_size * accum_count batches at once.
                        Recommended for Transformer.""")
+    group.add_argument('-pairs_per_step', type=int, default=1,
+                       help="""Number of language pairs drawn (see
+                       -pair_sampling) for each of the accum_count batches
+                       of an optimizer step: one batch of each is trained
+                       on, grouped by language pair, before a single
+                       update. The same pair may be drawn several
+                       times.""")
+    group.add_argument('-grouped_forward', action='store_true',
+                       help="""When an optimizer step has several batches
+                       with the same source language (see -pairs_per_step
+                       and -accum_count), merge their sources into one
+                       batch that goes through the encoder and the
+                       attention bridge once, before the decoder of each
+                       language pair.""")
     group.add_argument('-valid_steps', type=int, default=10000,
                        help='Perfom validation every X steps')
     group.add_argument('-valid_batch_size', type=int, default=32,
                        help='Maximum batch size for validation')
+    group.add_argument('-mmap_shards', action='store_true',
+                       help="""Memory-map the shards written by preprocess.py
+                       -numericalize instead of reading them, so that the
+                       processes of multi-GPU training share a single
+                       page-cached copy of the data.""")
+    group.add_argument('-batch_queue_size', type=int, default=0,
+                       help="""Number of training batches prepared ahead by a
+                       background thread: padded, numericalized, turned into
+                       model inputs and moved to the device. 0 prepares each
+                       batch in the training loop.""")
+    group.add_argument('-shard_prefetch', type=int, default=0,
+                       help="""Number of dataset shards loaded ahead by a
+                       background thread while the current one is used.
+                       This bounds the number of extra shards in memory
+                       (plus the one being loaded). 0 loads each shard when
+                       the previous one is exhausted.""")
+    group.add_argument('-generator_chunk_size', type=int, default=0,
+                       help="""Compute the generator and the loss together
+                       over chunks of this many target words, without
+                       storing the scores of the whole vocabulary. Useful
+                       with large target vocabularies. 0 disables it. Not
+                       available with copy attention and sparsemax.""")
     group.add_argument('-max_generator_batches', type=int, default=32,
                        help="""Maximum batches of words in a sequence to run
                         the generator on in parallel. Higher is faster, but
@@ -340,6 +438,12 @@ def train_opts(parser):
                        help="""If the norm of the gradient vector exceeds this,
                        renormalize it to have the norm equal to
                        max_grad_norm""")
+    group.add_argument('-precision', default='fp32',
+                       choices=['fp32', 'fp16', 'bf16'],
+                       help="""Run the forward passes in mixed precision with
+                       autocast: fp16 (GPU only, with dynamic loss scaling,
+                       updates whose gradients overflow being skipped) or
+                       bf16. Parameters and gradients stay in fp32.""")
     group.add_argument('-dropout', type=float, default=0.3,
                        help="Dropout probability; applied in LSTM stacks.")
     group.add_argument('-truncated_decoder', type=int, default=0,
@@ -394,6 +498,12 @@ def train_opts(parser):
     group = parser.add_argument_group('Logging')
     group.add_argument('-report_every', type=int, default=50,
                        help="Print stats at this interval.")
+    group.add_argument('-report_timing', action='store_true',
+                       help="""Also report the time spent in every phase of
+                       training: data loading, forward, loss, backward,
+                       all-reduce and optimizer. On GPU, this synchronizes
+                       the device around each phase, which slows training
+                       down.""")
     group.add_argument('-log_file', type=str, default="",
                        help="Output logs to a file under this path.")
     group.add_argument('-exp_host', type=str, default="",
@@ -423,6 +533,11 @@ def train_opts(parser):
                        help="""Use self-attention layer between enc and dec""")
     group.add_argument('-attention_heads', type=int, default=4,
                       help="""Number of attention heads in attention brige""")
+    group.add_argument('-ab_penalty_every', type=int, default=1,
+                       help="""Add the attention bridge penalty to the loss
+                       every this many training steps only, saving its
+                       computation on the other steps. 0 disables the
+                       penalty.""")
     group.add_argument('-report_bleu', action='store_true',
                        help="""Report bleu score after validation,
                        call tools/multi-bleu.perl on command line""")
@@ -0,0 +1,155 @@
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import torch
+import torch.nn as nn
+
+from onmt.models.sharded_checkpoint import save_sharded_checkpoint
+from onmt.models.tensor_checkpoint import load_tensor_checkpoint, \
+    tensor_checkpoints_available
+from onmt.tests.test_sharded_checkpoint import _ToyModel
+from onmt.trainer import Trainer
+from onmt.utils.optimizers import Optimizer
+
+# tools is not a package.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                os.pardir, 'tools'))
+average_models = importlib.import_module('average_models')
+del sys.path[0]
+
+
+def _checkpoint(seed):
+    torch.manual_seed(seed)
+    model = _ToyModel()
+    optim = Optimizer('adam', 0.1, 5)
+    optim.set_parameters(model.named_parameters())
+    return {'model': model.state_dict(), 'vocab': [], 'opt': None,
+            'optim': optim, 'whole_model': model}
+
+
+def _mean(a, b, c):
+    return (a + b + c) / 3
+
+
+def _ema(a, b, c):
+    """ The average with a decay of 0.5. """
+    return (a * 0.5 + b * 0.5) * 0.5 + c * 0.5
+
+
+@unittest.skipUnless(tensor_checkpoints_available(),
+                     'averaging maps checkpoints, as of PyTorch 2.1')
+class TestAverageModels(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.checkpoints = [_checkpoint(seed) for seed in range(3)]
+        self.output = os.path.join(self.dir, 'average')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _files(self):
+        paths = []
+        for step, checkpoint in enumerate(self.checkpoints, 1):
+            paths.append(os.path.join(self.dir, 'model_step_%d.pt' % step))
+            torch.save(checkpoint, paths[-1])
+        return paths
+
+    def _check(self, state, expected):
+        self.assertEqual(set(state), set(self.checkpoints[-1]['model']))
+        for key in state:
+            tensors = [checkpoint['model'][key]
+                       for checkpoint in self.checkpoints]
+            self.assertTrue(state[key].allclose(expected(*tensors)), key)
+
+    def test_average_tensor(self):
+        tensors = [torch.Tensor([1., 2.]), torch.Tensor([3., 6.]),
+                   torch.Tensor([5., 4.])]
+        self.assertTrue(average_models.average_tensor(tensors)
+                        .equal(torch.Tensor([3., 4.])))
+        self.assertTrue(average_models.average_tensor(tensors, decay=0.5)
+                        .equal(torch.Tensor([3.5, 4.])))
+        self.assertTrue(average_models.average_tensor(
+            [torch.LongTensor([1]), torch.LongTensor([2])])
+            .equal(torch.LongTensor([2])))
+        half = [tensor.half() for tensor in tensors]
+        self.assertEqual(average_models.average_tensor(half).dtype,
+                         torch.float16)
+
+    def test_mean_to_tensors(self):
+        average_models.average_models(self._files(), self.output)
+
+        checkpoint = load_tensor_checkpoint(self.output)
+        self._check(checkpoint['model'], _mean)
+        self.assertIsNone(checkpoint.get('optim'))
+        self.assertNotIn('optim_state', checkpoint)
+        # The ties are kept.
+        self.assertEqual(checkpoint['model']['decoders.0.weight'].data_ptr(),
+                         checkpoint['model']['encoders.1.weight'].data_ptr())
+
+    def test_ema_to_file(self):
+        average_models.average_models(self._files(), self.output, decay=0.5,
+                                      output_format='file')
+
+        checkpoint = torch.load(self.output)
+        self._check(checkpoint['model'], _ema)
+        self._check(checkpoint['whole_model'].state_dict(), _ema)
+        self.assertIsNone(checkpoint['optim'])
+
+    def test_sharded_checkpoints(self):
+        paths = []
+        for step, checkpoint in enumerate(self.checkpoints, 1):
+            paths.append(os.path.join(self.dir, 'model_step_%d' % step))
+            save_sharded_checkpoint(checkpoint, paths[-1])
+        average_models.average_models(paths, self.output, decay=0.5)
+
+        checkpoint = load_tensor_checkpoint(self.output)
+        self._check(checkpoint['model'], _ema)
+        # Not the manifest of the newest checkpoint.
+        self.assertNotIn('shards', checkpoint)
+        self.assertEqual(checkpoint['decoder_ids'], {'de': 0, 'en': 1})
+
+    def test_file_output_needs_a_model(self):
+        paths = self._files()[:1]
+        tensors = os.path.join(self.dir, 'model_step_1.tensors')
+        average_models.average_models(paths, tensors)
+        with self.assertRaises(ValueError):
+            average_models.average_models([tensors], self.output,
+                                          output_format='file')
+
+
+def _trainer(model, model_saver, average_decay):
+    """ A trainer with only the attributes of the moving average. """
+    trainer = Trainer.__new__(Trainer)
+    trainer.model = model
+    trainer.model_saver = model_saver
+    trainer.average_decay = average_decay
+    trainer.moving_average = None
+    return trainer
+
+
+class TestMovingAverage(unittest.TestCase):
+
+    def test_warm_up(self):
+        model = nn.Linear(2, 1, bias=False)
+        trainer = _trainer(model, object(), 0.9999)
+        for step in range(1, 4):
+            model.weight.data.fill_(step)
+            trainer._update_average(step)
+
+        # The decay is (1 + step) / (10 + step) in the first steps.
+        expected = 1.
+        for step in [2, 3]:
+            decay = (1. + step) / (10. + step)
+            expected = decay * expected + (1 - decay) * step
+        average, = trainer.moving_average
+        self.assertTrue(average.allclose(torch.full((1, 2), expected)))
+
+    def test_not_saving(self):
+        trainer = _trainer(nn.Linear(2, 1), None, 0.9)
+        trainer._update_average(1)
+        self.assertIsNone(trainer.moving_average)
@@ -0,0 +1,37 @@
+import random
+import unittest
+
+import torch
+
+from onmt.inputters.bucketing import LengthIndex, token_bucket_batches
+
+
+class TestTokenBucketBatches(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1234)
+        torch.manual_seed(1234)
+        self.index = LengthIndex(torch.randint(1, 50, (500,)).long(),
+                                 torch.randint(1, 50, (500,)).long())
+
+    def test_budget_and_coverage(self):
+        max_tokens = 400
+        batches, padding_ratios = token_bucket_batches(self.index,
+                                                       max_tokens)
+        ids = torch.cat(batches).sort()[0]
+        self.assertTrue(ids.equal(torch.arange(0, 500).long()))
+
+        for batch in batches:
+            src = self.index.src_lengths[batch].max().item() + 2
+            tgt = self.index.tgt_lengths[batch].max().item() + 1
+            self.assertLessEqual(batch.size(0) * max(src, tgt), max_tokens)
+        for ratio in padding_ratios:
+            self.assertTrue(0 <= ratio < 1)
+
+    def test_long_example(self):
+        index = LengthIndex(torch.LongTensor([300, 2, 3]),
+                            torch.LongTensor([2, 300, 3]))
+        batches, _ = token_bucket_batches(index, 100)
+        sizes = sorted(batch.size(0) for batch in batches)
+        # The long examples are alone in their batch.
+        self.assertEqual(sizes, [1, 1, 1])
@@ -0,0 +1,52 @@
+import unittest
+
+import torch
+import torch.nn as nn
+
+from onmt.modules.fused_generator_loss import fused_generator_loss
+from onmt.utils.loss import LabelSmoothingLoss
+
+VOCAB_SIZE = 50
+HIDDEN_SIZE = 8
+PADDING_IDX = 1
+
+
+class TestFusedGeneratorLoss(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(1234)
+        self.linear = nn.Linear(HIDDEN_SIZE, VOCAB_SIZE).double()
+        self.hidden = torch.randn(12, HIDDEN_SIZE, dtype=torch.double,
+                                  requires_grad=True)
+        self.target = torch.randint(0, VOCAB_SIZE, (12,)).long()
+        self.target[:3] = PADDING_IDX
+
+    def _grads(self, loss):
+        params = [self.hidden, self.linear.weight, self.linear.bias]
+        return torch.autograd.grad(loss, params)
+
+    def _check(self, criterion, label_smoothing):
+        scores = nn.functional.log_softmax(self.linear(self.hidden), dim=-1)
+        expected_loss = criterion(scores, self.target)
+        expected_grads = self._grads(expected_loss)
+        expected_pred = scores.max(1)[1]
+
+        # Chunks not dividing the vocabulary, and a single chunk.
+        for chunk_size in [7, VOCAB_SIZE]:
+            loss, pred = fused_generator_loss(
+                self.hidden, self.linear.weight, self.linear.bias,
+                self.target, PADDING_IDX, label_smoothing=label_smoothing,
+                chunk_size=chunk_size)
+            self.assertAlmostEqual(loss.item(), expected_loss.item())
+            self.assertTrue(pred.equal(expected_pred))
+            for grad, expected in zip(self._grads(loss), expected_grads):
+                self.assertTrue(torch.allclose(grad, expected))
+
+    def test_nll(self):
+        criterion = nn.NLLLoss(ignore_index=PADDING_IDX, size_average=False)
+        self._check(criterion, 0.0)
+
+    def test_label_smoothing(self):
+        criterion = LabelSmoothingLoss(0.1, VOCAB_SIZE,
+                                       ignore_index=PADDING_IDX).double()
+        self._check(criterion, 0.1)
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+
+import torch
+import torch.distributed
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+from onmt.utils.distributed import GradientSync
+
+WORLD_SIZE = 2
+LANGS = ['en', 'de']
+
+
+def _build_model():
+    torch.manual_seed(1234)
+    return nn.ModuleDict({
+        'shared': nn.Linear(4, 4),
+        'en': nn.Linear(4, 4),
+        'de': nn.Linear(4, 4),
+    })
+
+
+def _backward(model, rank, loss_scale=1.):
+    """ Process `rank` trains the encoder of `LANGS[rank]` only. """
+    torch.manual_seed(rank)
+    x = torch.randn(3, 4)
+    loss = model[LANGS[rank]](model['shared'](x)).pow(2).sum()
+    (loss * loss_scale).backward()
+
+
+def _run(rank, store, overlap, loss_scale, results):
+    torch.distributed.init_process_group(
+        'gloo', init_method='file://' + store, world_size=WORLD_SIZE,
+        rank=rank)
+    model = _build_model()
+    groups = {('encoder', lang): list(model[lang].parameters())
+              for lang in LANGS}
+    # Small buckets: one per parameter.
+    sync = GradientSync(model.parameters(), groups, bucket_size=64,
+                        overlap=overlap)
+    sync.start({('encoder', LANGS[rank])})
+    sync.arm()
+    _backward(model, rank, loss_scale)
+    # As the trainer, which divides out the loss scale of fp16 training.
+    sync.finish(WORLD_SIZE * loss_scale)
+    results.put((rank, {name: p.grad.clone()
+                        for name, p in model.named_parameters()}))
+    torch.distributed.destroy_process_group()
+
+
+class TestGradientSync(unittest.TestCase):
+
+    def _check(self, overlap, loss_scale=1.):
+        store = tempfile.NamedTemporaryFile(delete=False).name
+        os.remove(store)
+        ctx = mp.get_context('spawn')
+        results = ctx.SimpleQueue()
+        procs = [ctx.Process(target=_run,
+                             args=(rank, store, overlap, loss_scale,
+                                   results))
+                 for rank in range(WORLD_SIZE)]
+        for proc in procs:
+            proc.start()
+        grads = dict(results.get() for _ in procs)
+        for proc in procs:
+            proc.join()
+            self.assertEqual(proc.exitcode, 0)
+
+        # Average of the gradients of both processes.
+        expected = {name: torch.zeros_like(p)
+                    for name, p in _build_model().named_parameters()}
+        for rank in range(WORLD_SIZE):
+            model = _build_model()
+            _backward(model, rank)
+            for name, p in model.named_parameters():
+                if p.grad is not None:
+                    expected[name] += p.grad / WORLD_SIZE
+
+        for rank in range(WORLD_SIZE):
+            for name, grad in grads[rank].items():
+                self.assertTrue(torch.allclose(grad, expected[name]), name)
+
+    def test_overlap(self):
+        self._check(True)
+
+    def test_after_backward(self):
+        self._check(False)
+
+    def test_loss_scale(self):
+        self._check(True, loss_scale=2. ** 10)
@@ -0,0 +1,52 @@
+import unittest
+
+import torch
+import torch.nn as nn
+
+from onmt.utils.loss import LabelSmoothingLoss
+
+VOCAB_SIZE = 20
+PADDING_IDX = 1
+
+
+def _dense_loss(output, target, label_smoothing):
+    """ The loss with the smoothed target distribution built in full. """
+    smoothing_value = label_smoothing / (VOCAB_SIZE - 2)
+    one_hot = torch.full((VOCAB_SIZE,), smoothing_value,
+                         dtype=output.dtype)
+    one_hot[PADDING_IDX] = 0
+    model_prob = one_hot.unsqueeze(0).repeat(target.size(0), 1)
+    model_prob.scatter_(1, target.unsqueeze(1), 1.0 - label_smoothing)
+    model_prob.masked_fill_((target == PADDING_IDX).unsqueeze(1), 0)
+    return nn.functional.kl_div(output, model_prob, reduction='sum')
+
+
+class TestLabelSmoothingLoss(unittest.TestCase):
+
+    def _check(self, label_smoothing):
+        torch.manual_seed(1234)
+        scores = torch.randn(12, VOCAB_SIZE, dtype=torch.double,
+                             requires_grad=True)
+        output = nn.functional.log_softmax(scores, dim=-1)
+        target = torch.randint(0, VOCAB_SIZE, (12,)).long()
+        target[:3] = PADDING_IDX
+
+        criterion = LabelSmoothingLoss(label_smoothing, VOCAB_SIZE,
+                                       ignore_index=PADDING_IDX)
+        loss = criterion(output, target)
+        expected = _dense_loss(output, target, label_smoothing)
+        self.assertAlmostEqual(loss.item(), expected.item())
+
+        # Both losses are computed from the same log_softmax.
+        grad, = torch.autograd.grad(loss, scores, retain_graph=True)
+        expected_grad, = torch.autograd.grad(expected, scores)
+        self.assertTrue(torch.allclose(grad, expected_grad))
+        # Padding rows are ignored.
+        self.assertTrue(grad[:3].eq(0).all())
+
+    def test_smoothing(self):
+        self._check(0.1)
+
+    def test_full_smoothing(self):
+        # No probability left for the target word.
+        self._check(1.0)
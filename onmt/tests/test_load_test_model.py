@@ -0,0 +1,152 @@
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+import onmt.inputters
+import onmt.opts
+from onmt.model_builder import build_embeddings_then_encoder, \
+    build_decoder_and_generator, load_test_multitask_model
+from onmt.models import MultiTaskModel
+from onmt.models.sharded_checkpoint import save_sharded_checkpoint
+from onmt.models.tensor_checkpoint import save_tensor_checkpoint, \
+    tensor_checkpoints_available
+from onmt.utils.optimizers import Optimizer
+
+parser = argparse.ArgumentParser(description='train.py')
+onmt.opts.model_opts(parser)
+onmt.opts.train_opts(parser)
+model_opt = parser.parse_known_args(
+    ['-data', 'dummy', '-src_tgt', 'en-de', 'de-en',
+     '-src_word_vec_size', '8', '-tgt_word_vec_size', '8',
+     '-rnn_size', '8', '-enc_layers', '1', '-dec_layers', '1',
+     '-hidden_ab_size', '8', '-use_attention_bridge', '-attention_heads',
+     '3', '-share_decoder_embeddings'])[0]
+# As training_opt_postprocessing sets it.
+model_opt.brnn = model_opt.encoder_type == 'brnn'
+
+SENTENCES = {
+    'en': [['the', 'cat', 'sleeps'], ['a', 'dog']],
+    'de': [['die', 'katze', 'schläft'], ['ein', 'hund', 'bellt']],
+}
+
+
+def _vocab(lang):
+    field = onmt.inputters.get_fields('text', 0, 0)['tgt']
+    field.build_vocab(SENTENCES[lang])
+    return field.vocab
+
+
+def build_multitask_model():
+    """
+    A model en->de and de->en, whose decoders are not in the order of the
+    encoders. As with a shared vocabulary, the encoder and the decoder
+    of a language share their embeddings, and the generators share those
+    of their decoder.
+    """
+    torch.manual_seed(1234)
+    model = MultiTaskModel(None, None, model_opt)
+    vocabs = {lang: _vocab(lang) for lang in SENTENCES}
+    modules = {}
+    for lang, vocab in vocabs.items():
+        fields = onmt.inputters.get_fields('text', 0, 0)
+        fields['src'].vocab = fields['tgt'].vocab = vocab
+        encoder, _ = build_embeddings_then_encoder(model_opt, fields)
+        decoder, generator, _ = build_decoder_and_generator(model_opt, fields)
+        decoder.embeddings.word_lut.weight = \
+            encoder.embeddings.word_lut.weight
+        generator[0].weight = decoder.embeddings.word_lut.weight
+        modules[lang] = encoder, decoder, generator
+
+    model.encoder_ids = {'en': 0, 'de': 1}
+    model.decoder_ids = {'de': 0, 'en': 1}
+    model.encoders = nn.ModuleList([modules[lang][0]
+                                    for lang in ['en', 'de']])
+    model.decoders = nn.ModuleList([modules[lang][1]
+                                    for lang in ['de', 'en']])
+    model.generators = nn.ModuleList([modules[lang][2]
+                                      for lang in ['de', 'en']])
+    model.src_vocabs = OrderedDict((lang, vocabs[lang])
+                                   for lang in ['en', 'de'])
+    model.tgt_vocabs = OrderedDict((lang, vocabs[lang])
+                                   for lang in ['de', 'en'])
+    return model.eval()
+
+
+def checkpoint_of(model):
+    optim = Optimizer('adam', 0.1, 5)
+    optim.set_parameters(model.named_parameters())
+    return {'model': model.state_dict(), 'vocab': [], 'opt': model_opt,
+            'optim': optim, 'whole_model': model}
+
+
+def translation_scores(model, src_lang, tgt_lang):
+    """ The generator scores of a batch, as when translating it. """
+    src = torch.LongTensor([[4, 5, 6], [6, 4, 5]]).t().unsqueeze(2)
+    tgt = torch.LongTensor([[2, 4, 5, 3], [2, 6, 5, 3]]).t().unsqueeze(2)
+    lengths = torch.LongTensor([3, 3])
+    with torch.no_grad():
+        dec_out, _, _, _ = model(src, tgt, src_lang, tgt_lang, lengths)
+        generator = model.generators[model.decoder_ids[tgt_lang]]
+        return generator(dec_out.view(-1, dec_out.size(2)))
+
+
+class TestLoadTestMultitaskModel(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _load(self, path, src_lang, tgt_lang):
+        opt = argparse.Namespace(models=[path], src_lang=src_lang,
+                                 tgt_lang=tgt_lang, data_type='text',
+                                 gpu=-1)
+        return load_test_multitask_model(opt, {})
+
+    def _check(self, model, path):
+        expected = translation_scores(model, 'de', 'en')
+        fields, loaded, _ = self._load(path, 'de', 'en')
+        self.assertEqual(fields['src'].vocab.itos,
+                         model.src_vocabs['de'].itos)
+        self.assertTrue(translation_scores(loaded, 'de', 'en')
+                        .allclose(expected))
+
+        # Only the modules of de->en are built.
+        self.assertEqual(list(loaded.encoders._modules),
+                         [str(loaded.encoder_ids['de'])])
+        self.assertEqual(list(loaded.decoders._modules),
+                         [str(loaded.decoder_ids['en'])])
+        self.assertEqual(list(loaded.generators._modules),
+                         [str(loaded.decoder_ids['en'])])
+        decoder = loaded.decoders[loaded.decoder_ids['en']]
+        generator = loaded.generators[loaded.decoder_ids['en']]
+        self.assertTrue(generator[0].weight.equal(
+            decoder.embeddings.word_lut.weight))
+        return loaded
+
+    def test_sharded_checkpoint(self):
+        model = build_multitask_model()
+        path = os.path.join(self.dir, 'model_step_1')
+        save_sharded_checkpoint(checkpoint_of(model), path)
+        self._check(model, path)
+
+    @unittest.skipUnless(tensor_checkpoints_available(),
+                         'tensor checkpoints require PyTorch 2.1')
+    def test_tensor_checkpoint(self):
+        model = build_multitask_model()
+        path = os.path.join(self.dir, 'model_step_1.tensors')
+        save_tensor_checkpoint(checkpoint_of(model), path)
+        loaded = self._check(model, path)
+
+        # On the CPU, the tied weights are the same mapped tensor.
+        decoder = loaded.decoders[loaded.decoder_ids['en']]
+        generator = loaded.generators[loaded.decoder_ids['en']]
+        self.assertEqual(generator[0].weight.data_ptr(),
+                         decoder.embeddings.word_lut.weight.data_ptr())
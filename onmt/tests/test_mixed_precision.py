@@ -0,0 +1,109 @@
+import unittest
+
+import torch
+import torch.nn as nn
+
+from onmt.utils.mixed_precision import DynamicLossScaler, autocast, \
+    check_precision
+from onmt.utils.optimizers import Optimizer
+
+
+def _build(method='sgd', max_grad_norm=0, **kwargs):
+    torch.manual_seed(1234)
+    model = nn.Linear(4, 3)
+    optim = Optimizer(method, 1., max_grad_norm, **kwargs)
+    optim.set_parameters(model.named_parameters())
+    return model, optim
+
+
+def _backward(model, loss_scale=1.):
+    model.zero_grad()
+    torch.manual_seed(5678)
+    loss = model(torch.randn(5, 4)).pow(2).sum()
+    (loss * loss_scale).backward()
+
+
+class TestDynamicLossScaler(unittest.TestCase):
+
+    def test_overflow(self):
+        model, optim = _build(start_decay_steps=1, decay_steps=1,
+                              lr_decay=.5)
+        optim.loss_scaler = DynamicLossScaler(init_scale=8.)
+        weight = model.weight.detach().clone()
+        _backward(model, optim.loss_scale)
+        model.bias.grad[0] = float('inf')
+
+        self.assertFalse(optim.step())
+        # No update, nor learning rate decay.
+        self.assertTrue(model.weight.equal(weight))
+        self.assertEqual(optim._step, 0)
+        self.assertEqual(optim.learning_rate, 1.)
+        self.assertEqual(optim.loss_scale, 4.)
+
+        model.weight.grad[0, 0] = float('nan')
+        self.assertFalse(optim.step())
+        self.assertEqual(optim.loss_scale, 2.)
+
+    def test_growth(self):
+        scaler = DynamicLossScaler(init_scale=8., growth_interval=3)
+        for overflow in [False, False, True, False, False]:
+            scaler.update(overflow)
+        # The overflow starts the interval over.
+        self.assertEqual(scaler.scale, 4.)
+        scaler.update(False)
+        self.assertEqual(scaler.scale, 8.)
+        for _ in range(3):
+            scaler.update(False)
+        self.assertEqual(scaler.scale, 16.)
+
+    def test_unscaled_gradients(self):
+        # Gradient norm of about 8: only the scaled gradients would be
+        # clipped to 10.
+        model, optim = _build(max_grad_norm=10)
+        _backward(model)
+        grads = [p.grad.clone() for p in model.parameters()]
+        optim.step()
+        expected = [p.detach().clone() for p in model.parameters()]
+
+        model, optim = _build(max_grad_norm=10)
+        optim.loss_scaler = DynamicLossScaler(init_scale=2. ** 10)
+        _backward(model, optim.loss_scale)
+        self.assertTrue(optim.step())
+        for p, grad, param in zip(model.parameters(), grads, expected):
+            self.assertTrue(p.grad.allclose(grad))
+            self.assertTrue(p.allclose(param))
+
+    def test_gradients_already_unscaled(self):
+        # As after the all-reduce, which divides out the loss scale.
+        model, optim = _build()
+        optim.loss_scaler = DynamicLossScaler(init_scale=2. ** 10)
+        _backward(model)
+        grads = [p.grad.clone() for p in model.parameters()]
+        self.assertTrue(optim.step(grad_scale=1.))
+        for p, grad in zip(model.parameters(), grads):
+            self.assertTrue(p.grad.equal(grad))
+
+
+class TestAutocast(unittest.TestCase):
+
+    def test_fp32(self):
+        model = nn.Linear(4, 3)
+        with autocast('fp32', 'cpu'):
+            self.assertEqual(model(torch.randn(2, 4)).dtype, torch.float32)
+
+    @unittest.skipUnless(hasattr(torch, 'autocast'),
+                         'requires torch.autocast')
+    def test_bf16_on_cpu(self):
+        check_precision('bf16', 'cpu')
+        model = nn.Linear(4, 3)
+        with autocast('bf16', 'cpu'):
+            out = model(torch.randn(2, 4))
+        self.assertEqual(out.dtype, torch.bfloat16)
+        out.float().sum().backward()
+        # Parameters and gradients stay in fp32.
+        self.assertEqual(model.weight.dtype, torch.float32)
+        self.assertEqual(model.weight.grad.dtype, torch.float32)
+
+    def test_no_fp16_on_cpu(self):
+        with self.assertRaises(ValueError):
+            check_precision('fp16', 'cpu')
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+import torch.nn as nn
+
+from onmt.models.model_saver import AsyncModelSaver, ModelSaver
+from onmt.utils.optimizers import Optimizer
+
+
+class TestAsyncModelSaver(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.model = nn.Linear(4, 4)
+        self.optim = Optimizer('adam', 0.1, 5)
+        self.optim.set_parameters(self.model.named_parameters())
+        self.saver = AsyncModelSaver(os.path.join(self.dir, 'model'),
+                                     self.model, None, {}, self.optim,
+                                     save_checkpoint_steps=1,
+                                     keep_checkpoint=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _train_step(self):
+        self.model.zero_grad()
+        self.model(torch.randn(3, 4)).sum().backward()
+        self.optim.step()
+
+    def test_snapshots(self):
+        weights = {}
+        for step in range(1, 4):
+            self._train_step()
+            weights[step] = self.model.weight.detach().clone()
+            self.saver.maybe_save(step)
+        self.saver.close()
+
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['model_step_2.pt', 'model_step_3.pt'])
+        for step in [2, 3]:
+            checkpoint = torch.load(
+                os.path.join(self.dir, 'model_step_%d.pt' % step))
+            # The weights at the time of saving, not the last ones.
+            self.assertTrue(checkpoint['model']['weight'].equal(
+                weights[step]))
+            self.assertTrue(checkpoint['whole_model'].weight.equal(
+                weights[step]))
+            optim = checkpoint['optim']
+            self.assertEqual(optim._step, step)
+            self.assertTrue(optim.params[0] is
+                            checkpoint['whole_model'].weight)
+
+
+class TestModelSaver(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_moving_average(self):
+        model = nn.Linear(4, 4)
+        optim = Optimizer('adam', 0.1, 5)
+        optim.set_parameters(model.named_parameters())
+        saver = ModelSaver(os.path.join(self.dir, 'model'), model, None,
+                           {}, optim, save_checkpoint_steps=1,
+                           keep_checkpoint=-1)
+        weight = model.weight.detach().clone()
+        average = [torch.full_like(p, 0.5) for p in model.parameters()]
+        saver.maybe_save(1, moving_average=average)
+
+        checkpoint = torch.load(os.path.join(self.dir, 'model_step_1.pt'))
+        # The averages are saved instead of the parameters.
+        for key in ['weight', 'bias']:
+            self.assertTrue(checkpoint['model'][key].eq(0.5).all(), key)
+            self.assertTrue(getattr(checkpoint['whole_model'], key)
+                            .eq(0.5).all(), key)
+        # The parameters of the model are back.
+        self.assertTrue(model.weight.equal(weight))
+        self.assertTrue(model.weight is optim.params[0])
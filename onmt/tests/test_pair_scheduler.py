@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+from collections import Counter
+
+from onmt.utils.pair_scheduler import CyclicScheduler, \
+    TemperatureScheduler, read_pair_schedule
+
+PAIRS = [('en', 'de'), ('en', 'fr'), ('de', 'fr')]
+
+
+class TestPairScheduler(unittest.TestCase):
+
+    def test_round_robin(self):
+        scheduler = CyclicScheduler(PAIRS)
+        drawn = [scheduler.next_pair() for _ in range(2 * len(PAIRS))]
+        self.assertEqual(drawn, PAIRS + PAIRS)
+
+    def test_temperature(self):
+        sizes = [800, 100, 100]
+        proportional = TemperatureScheduler(PAIRS, sizes, 1.0)
+        for prob, size in zip(proportional.probabilities, sizes):
+            self.assertAlmostEqual(prob, size / 1000.)
+
+        flat = TemperatureScheduler(PAIRS, sizes, 1000.0)
+        for prob in flat.probabilities:
+            self.assertAlmostEqual(prob, 1. / 3, places=2)
+
+        counts = Counter(proportional.next_pair() for _ in range(10000))
+        self.assertGreater(counts[('en', 'de')], 7000)
+        self.assertLess(counts[('en', 'fr')], 1500)
+
+    def test_schedule_file(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('# warm up on en-de\nen-de 2\n\nen-fr\n')
+        try:
+            scheduler = CyclicScheduler(PAIRS, read_pair_schedule(path))
+        finally:
+            os.remove(path)
+        drawn = [scheduler.next_pair() for _ in range(4)]
+        self.assertEqual(drawn, [('en', 'de'), ('en', 'de'), ('en', 'fr'),
+                                 ('en', 'de')])
+        with self.assertRaises(ValueError):
+            CyclicScheduler(PAIRS, [('fr', 'en')])
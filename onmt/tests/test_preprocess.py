@@ -10,6 +10,7 @@ import os
 import codecs
 from collections import Counter
 
+import torch
 import torchtext
 
 import onmt
@@ -57,13 +58,75 @@ class TestData(unittest.TestCase):
         preprocess.build_save_dataset('valid', fields, opt)
 
         # Remove the generated *pt files.
-        for pt in glob.glob(SAVE_DATA_PREFIX + '*.pt'):
+        for pt in glob.glob(SAVE_DATA_PREFIX + '*.pt*'):
             os.remove(pt)
         if hasattr(opt, 'src_vocab') and os.path.exists(opt.src_vocab):
             os.remove(opt.src_vocab)
         if hasattr(opt, 'tgt_vocab') and os.path.exists(opt.tgt_vocab):
             os.remove(opt.tgt_vocab)
 
+    def test_vocab_counted_while_sharding(self):
+        opt = copy.deepcopy(self.opt)
+        opt.max_shard_size = 500000
+        fields = onmt.inputters.get_fields("text", 0, 0)
+        counters = {}
+        train_data_files = preprocess.build_save_dataset(
+            'train', fields, opt, counters)
+
+        def vocab_args(counters):
+            return (train_data_files, onmt.inputters.get_fields("text", 0, 0),
+                    opt.data_type, opt.share_vocab,
+                    opt.src_vocab, opt.src_vocab_size,
+                    opt.src_words_min_frequency,
+                    opt.tgt_vocab, opt.tgt_vocab_size,
+                    opt.tgt_words_min_frequency, counters)
+
+        streamed = onmt.inputters.build_vocab(*vocab_args(counters))
+        reloaded = onmt.inputters.build_vocab(*vocab_args(None))
+
+        for pt in glob.glob(SAVE_DATA_PREFIX + '*.pt*'):
+            os.remove(pt)
+
+        for side in ['src', 'tgt']:
+            self.assertEqual(reloaded[side].vocab.itos,
+                             streamed[side].vocab.itos)
+
+    def test_numericalized_dataset(self):
+        opt = copy.deepcopy(self.opt)
+        opt.numericalize = True
+        fields = onmt.inputters.get_fields("text", 0, 0)
+        counters = {}
+        train_data_files = preprocess.build_save_dataset(
+            'train', fields, opt, counters)
+        preprocess.build_save_vocab(train_data_files, fields, opt, counters)
+        dataset = torch.load(train_data_files[0])
+
+        numericalized = onmt.inputters.NumericalizedTextDataset.from_dataset(
+            dataset, fields)
+        numericalized.save(SAVE_DATA_PREFIX + '.numericalized.pt')
+        numericalized = torch.load(
+            SAVE_DATA_PREFIX + '.numericalized.pt').load_arrays(
+                SAVE_DATA_PREFIX + '.numericalized.pt', mmap=True)
+
+        for pt in glob.glob(SAVE_DATA_PREFIX + '*.pt*'):
+            os.remove(pt)
+
+        self.assertEqual(len(dataset), len(numericalized))
+        ids = torch.LongTensor([3, 0, 7])
+        src_pad = fields['src'].vocab.stoi[onmt.inputters.PAD_WORD]
+        tgt_pad = fields['tgt'].vocab.stoi[onmt.inputters.PAD_WORD]
+        src, src_lengths = numericalized.pad_batch('src', ids, src_pad)
+        tgt, tgt_lengths = numericalized.pad_batch('tgt', ids, tgt_pad)
+        for b, i in enumerate(ids.tolist()):
+            ex = dataset.examples[i]
+            self.assertEqual(len(ex.src), src_lengths[b].item())
+            self.assertEqual([fields['src'].vocab.stoi[w] for w in ex.src],
+                             src[:len(ex.src), b].tolist())
+            self.assertEqual(len(ex.tgt) + 2, tgt_lengths[b].item())
+            self.assertEqual([fields['tgt'].vocab.stoi[w] for w in ex.tgt],
+                             tgt[1:len(ex.tgt) + 1, b].tolist())
+            self.assertTrue(src[len(ex.src):, b].eq(src_pad).all())
+
     def test_merge_vocab(self):
         va = torchtext.vocab.Vocab(Counter('abbccc'))
         vb = torchtext.vocab.Vocab(Counter('eeabbcccf'))
@@ -124,6 +187,10 @@ test_databuild = [[],
                    ('share_vocab', True)],
                   [('dynamic_dict', True),
                    ('max_shard_size', 500000)],
+                  [('max_shard_size', 500),
+                   ('num_workers', 2)],
+                  [('numericalize', True),
+                   ('max_shard_size', 500000)],
                   [('src_vocab', '/tmp/src_vocab.txt'),
                    ('tgt_vocab', '/tmp/tgt_vocab.txt')],
                   ]
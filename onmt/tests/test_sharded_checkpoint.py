@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+import torch.nn as nn
+
+from onmt.models.sharded_checkpoint import save_sharded_checkpoint, \
+    load_checkpoint, load_manifest, LazyModuleList
+from onmt.utils.optimizers import Optimizer
+
+
+class _ToyModel(nn.Module):
+    """ The module layout of a `MultiTaskModel` en->de, de->en. """
+
+    def __init__(self):
+        super(_ToyModel, self).__init__()
+        self.encoder_ids = {'en': 0, 'de': 1}
+        self.decoder_ids = {'de': 0, 'en': 1}
+        self.encoders = nn.ModuleList([nn.Embedding(5, 3),
+                                       nn.Embedding(5, 3)])
+        self.decoders = nn.ModuleList([nn.Embedding(5, 3),
+                                       nn.Embedding(5, 3)])
+        self.generators = nn.ModuleList([nn.Linear(3, 5), nn.Linear(3, 5)])
+        self.attention_bridge = nn.Linear(3, 3)
+        self.generator = nn.Linear(3, 5)
+        # Embeddings shared by the encoder and decoder of a language.
+        self.decoders[0].weight = self.encoders[1].weight
+        self.decoders[1].weight = self.encoders[0].weight
+        self.src_vocabs = {'en': None, 'de': None}
+        self.tgt_vocabs = {'en': None, 'de': None}
+
+    def language_modules(self):
+        modules = {}
+        for lang, idx in self.encoder_ids.items():
+            modules[('encoder', lang)] = self.encoders[idx]
+        for lang, idx in self.decoder_ids.items():
+            modules[('decoder', lang)] = self.decoders[idx]
+            modules[('generator', lang)] = self.generators[idx]
+        return modules
+
+
+class TestShardedCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_and_load(self):
+        model = _ToyModel()
+        optim = Optimizer('adam', 0.1, 5)
+        optim.set_parameters(model.named_parameters())
+        loss = model.generators[0](model.encoders[0](
+            torch.LongTensor([1, 2]))).sum()
+        loss.backward()
+        optim.step()
+
+        path = os.path.join(self.dir, 'model_step_1')
+        save_sharded_checkpoint({'model': model.state_dict(), 'vocab': [],
+                                 'opt': None, 'optim': optim,
+                                 'whole_model': model}, path)
+        self.assertTrue(os.path.isfile(
+            os.path.join(path, 'encoders', 'en.pt')))
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+        manifest = load_manifest(path)
+        # The embeddings of German are stored with its encoder.
+        self.assertEqual(manifest['shards']['decoders/de']['ties'],
+                         {'weight': ('encoders/de', 'weight')})
+
+        checkpoint = load_checkpoint(path)
+        self.assertEqual(set(checkpoint['model']),
+                         set(model.state_dict()))
+        for key, tensor in model.state_dict().items():
+            self.assertTrue(checkpoint['model'][key].equal(tensor), key)
+        self.assertEqual(checkpoint['optim']._step, 1)
+        self.assertEqual(checkpoint['optim'].params, [])
+        self.assertEqual(len(checkpoint['optim_state']['state']),
+                         len(optim.optimizer.state))
+
+
+class TestLazyModuleList(unittest.TestCase):
+
+    def test_build_on_access(self):
+        built = []
+
+        def build(idx):
+            built.append(idx)
+            return nn.Linear(2, 2)
+
+        modules = LazyModuleList([lambda: build(0), lambda: build(1)])
+        self.assertEqual(len(modules), 2)
+        self.assertEqual(list(modules.parameters()), [])
+        self.assertTrue(modules[1] is modules[1])
+        self.assertEqual(built, [1])
+        self.assertEqual(len(list(modules.parameters())), 2)
@@ -0,0 +1,35 @@
+import os
+import tempfile
+import unittest
+
+import torch.distributed
+
+from onmt.utils.statistics import Statistics
+
+
+class TestAllReduceStats(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # The store file is created, and deleted, by the process group.
+        store = tempfile.NamedTemporaryFile(delete=False).name
+        os.remove(store)
+        torch.distributed.init_process_group(
+            'gloo', init_method='file://' + store, world_size=1, rank=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        torch.distributed.destroy_process_group()
+
+    def test_counters_keep_their_type(self):
+        stats = {('en', 'de'): Statistics(12.5, 10, 7),
+                 ('de', 'fr'): Statistics(3.0, 4, 1)}
+        stats[('en', 'de')].add_tokens(('en', 'de'), 20, 30)
+
+        Statistics.all_reduce_stats_dict(stats)
+        en_de = stats[('en', 'de')]
+        self.assertEqual(en_de.loss, 12.5)
+        self.assertEqual((en_de.n_words, en_de.n_correct), (10, 7))
+        self.assertIsInstance(en_de.n_words, int)
+        self.assertEqual(en_de.padding_ratio(), 1 - 20. / 30)
+        self.assertEqual(stats[('de', 'fr')].n_words, 4)
@@ -0,0 +1,134 @@
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+import torch.nn as nn
+
+from onmt.models.sharded_checkpoint import load_checkpoint
+from onmt.models.tensor_checkpoint import save_tensor_checkpoint, \
+    load_tensor_checkpoint, is_tensor_checkpoint, module_state, \
+    tensor_checkpoints_available
+from onmt.tests.test_load_test_model import build_multitask_model, \
+    checkpoint_of
+from onmt.utils.optimizers import Optimizer, build_optim
+
+
+class _ToyModel(nn.Module):
+    """ The module layout of a `MultiTaskModel` en->de. """
+
+    def __init__(self):
+        super(_ToyModel, self).__init__()
+        self.encoder_ids = {'en': 0}
+        self.decoder_ids = {'de': 0}
+        self.encoders = nn.ModuleList([nn.Embedding(5, 3)])
+        self.decoders = nn.ModuleList([nn.Embedding(5, 3)])
+        self.generators = nn.ModuleList([nn.Linear(3, 5)])
+        self.attention_bridge = nn.Linear(3, 3)
+        # Output layer tied to the target embeddings.
+        self.generators[0].weight = self.decoders[0].weight
+        self.src_vocabs = {}
+        self.tgt_vocabs = {}
+
+
+@unittest.skipUnless(tensor_checkpoints_available(),
+                     'tensor checkpoints require PyTorch 2.1')
+class TestTensorCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_and_load(self):
+        model = _ToyModel()
+        optim = Optimizer('adam', 0.1, 5)
+        optim.set_parameters(model.named_parameters())
+        loss = model.generators[0](model.encoders[0](
+            torch.LongTensor([1, 2]))).sum()
+        loss.backward()
+        optim.step()
+
+        path = os.path.join(self.dir, 'model_step_1.tensors')
+        opt = argparse.Namespace(rnn_size=3, layers=[1, 2])
+        save_tensor_checkpoint({'model': model.state_dict(), 'vocab': [],
+                                'opt': opt, 'optim': optim,
+                                'whole_model': model}, path)
+        self.assertTrue(is_tensor_checkpoint(path))
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+        checkpoint = load_tensor_checkpoint(path)
+        self.assertEqual(checkpoint['opt'], opt)
+        self.assertEqual(checkpoint['encoder_ids'], {'en': 0})
+        self.assertEqual(set(checkpoint['model']), set(model.state_dict()))
+        for key, tensor in model.state_dict().items():
+            self.assertTrue(checkpoint['model'][key].equal(tensor), key)
+        # The tied weights are stored once.
+        self.assertEqual(
+            checkpoint['model']['generators.0.weight'].data_ptr(),
+            checkpoint['model']['decoders.0.weight'].data_ptr())
+        self.assertEqual(set(module_state(checkpoint, 'generators/de')),
+                         {'weight', 'bias'})
+
+        self.assertEqual(checkpoint['optim']._step, 1)
+        self.assertEqual(checkpoint['optim'].params, [])
+        state = checkpoint['optim_state']
+        self.assertEqual(
+            [group['params'] for group in state['param_groups']],
+            [group['params'] for group
+             in optim.optimizer.state_dict()['param_groups']])
+        self.assertEqual(len(state['state']), len(optim.optimizer.state))
+
+    def test_module_state(self):
+        model = build_multitask_model()
+        path = os.path.join(self.dir, 'model_step_1.tensors')
+        save_tensor_checkpoint(checkpoint_of(model), path)
+
+        checkpoint = load_tensor_checkpoint(path)
+        for (kind, lang), module in model.language_modules().items():
+            state = module_state(checkpoint, '%ss/%s' % (kind, lang))
+            self.assertEqual(set(state), set(module.state_dict()))
+            for key, tensor in module.state_dict().items():
+                self.assertTrue(state[key].equal(tensor), key)
+
+    def test_train_from(self):
+        model = build_multitask_model()
+        checkpoint = checkpoint_of(model)
+        optim = checkpoint['optim']
+        _train_step(model, optim)
+        path = os.path.join(self.dir, 'model_step_1.tensors')
+        save_tensor_checkpoint(checkpoint, path)
+
+        # As train_single resumes training.
+        checkpoint = load_checkpoint(path)
+        resumed = build_multitask_model()
+        resumed.load_state_dict(checkpoint['model'])
+        opt = argparse.Namespace(train_from=path, precision='fp32',
+                                 gpuid=[])
+        resumed_optim = build_optim(resumed, opt, checkpoint)
+        self.assertEqual(resumed_optim._step, 1)
+        self.assertEqual(set(resumed_optim.optimizer.state_dict()['state']),
+                         set(optim.optimizer.state_dict()['state']))
+
+        # Training goes on as it would have without the checkpoint.
+        _train_step(model, optim)
+        _train_step(resumed, resumed_optim)
+        for (name, param), resumed_param in zip(model.named_parameters(),
+                                                resumed.parameters()):
+            self.assertTrue(param.allclose(resumed_param), name)
+
+
+def _train_step(model, optim):
+    # The same dropout masks for both models.
+    torch.manual_seed(1234)
+    model.train()
+    model.zero_grad()
+    src = torch.LongTensor([[4, 5, 6]]).t().unsqueeze(2)
+    tgt = torch.LongTensor([[2, 4, 5, 3]]).t().unsqueeze(2)
+    dec_out, _, _, _ = model(src, tgt, 'en', 'de', torch.LongTensor([3]))
+    generator = model.generators[model.decoder_ids['de']]
+    generator(dec_out.squeeze(1)).sum().backward()
+    optim.step()
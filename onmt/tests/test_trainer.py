@@ -0,0 +1,117 @@
+import unittest
+from collections import defaultdict, OrderedDict
+
+import torch
+import torch.nn as nn
+
+import onmt
+from onmt.tests.test_load_test_model import build_multitask_model, model_opt
+from onmt.trainer import Trainer
+from onmt.utils.loss import AttentionBridgePenalty, \
+    build_loss_from_generator_and_vocab
+from onmt.utils.optimizers import Optimizer
+
+PADDING_IDX = 1
+
+
+class _Batch(object):
+    """ A text batch of a language pair, as the training iterators yield. """
+
+    def __init__(self, src_lang, tgt_lang, src, tgt):
+        lengths = [len(seq) for seq in src]
+        self.src = (_padded(src), torch.LongTensor(lengths))
+        self.tgt = _padded(tgt)
+        self.batch_size = len(src)
+        self.src_lang, self.tgt_lang = src_lang, tgt_lang
+
+
+def _padded(seqs):
+    """ Sequences as a `[len x batch]` tensor. """
+    max_len = max(len(seq) for seq in seqs)
+    return torch.LongTensor([seq + [PADDING_IDX] * (max_len - len(seq))
+                             for seq in seqs]).t().contiguous()
+
+
+def _batches():
+    # Sources sorted by decreasing length, as bucketing sorts them.
+    return [
+        _Batch('de', 'en', [[4, 5, 6], [7, 4]],
+               [[2, 4, 5, 3], [2, 6, 3]]),
+        _Batch('en', 'de', [[4, 5, 6, 7], [8, 4]],
+               [[2, 6, 7, 8, 3], [2, 5, 3]]),
+        _Batch('en', 'en', [[5, 6, 7]], [[2, 8, 4, 3]]),
+    ]
+
+
+def _build_model():
+    model = build_multitask_model()
+    for module in model.modules():
+        if isinstance(module, nn.Dropout):
+            module.p = 0.
+    return model
+
+
+def _expected_grads(batches, normalization):
+    """
+    The gradients of the loss of every batch, each with its own forward
+    and backward pass.
+    """
+    model = _build_model().train()
+    penalty = AttentionBridgePenalty(model_opt.attention_heads)
+    criterion = nn.NLLLoss(ignore_index=PADDING_IDX, reduction='sum')
+    for batch in batches:
+        src, lengths = batch.src
+        outputs, _, _, alphas = model(src.unsqueeze(2),
+                                      batch.tgt.unsqueeze(2),
+                                      batch.src_lang, batch.tgt_lang,
+                                      lengths)
+        generator = model.generators[model.decoder_ids[batch.tgt_lang]]
+        scores = generator(outputs.view(-1, outputs.size(2)))
+        loss = criterion(scores, batch.tgt[1:].contiguous().view(-1)) + \
+            penalty(alphas)
+        loss.div(normalization).backward()
+    return {name: p.grad for name, p in model.named_parameters()}
+
+
+class TestMultiPairStep(unittest.TestCase):
+
+    def _check(self, shard_size=32, **kwargs):
+        model = _build_model()
+        losses = OrderedDict(
+            (lang, build_loss_from_generator_and_vocab(
+                model.generators[idx], model.tgt_vocabs[lang], model_opt))
+            for lang, idx in model.decoder_ids.items())
+        # No update: the gradients are left as they are.
+        optim = Optimizer('sgd', 0., 0)
+        optim.set_parameters(model.named_parameters())
+        trainer = Trainer(model, losses, losses, optim,
+                          model_opt.attention_heads, shard_size=shard_size,
+                          pairs_per_step=3, **kwargs)
+        trainer.pair_stats = defaultdict(onmt.utils.Statistics)
+
+        batches = _batches()
+        normalization = sum(batch.batch_size for batch in batches)
+        trainer._gradient_accumulation(batches, normalization,
+                                       onmt.utils.Statistics(),
+                                       onmt.utils.Statistics())
+
+        expected = _expected_grads(batches, normalization)
+        for name, p in model.named_parameters():
+            if expected[name] is None:
+                self.assertTrue(p.grad is None or p.grad.eq(0).all(), name)
+            else:
+                self.assertTrue(p.grad.allclose(expected[name], atol=1e-6),
+                                name)
+
+    def test_pairs_per_step(self):
+        self._check()
+
+    def test_loss_shards(self):
+        # The loss of each batch is backpropagated through the generator
+        # shard by shard, and through the model once.
+        self._check(shard_size=2)
+
+    def test_grouped_forward(self):
+        # The batches from English are encoded together.
+        self._check(grouped_forward=True)
+        self._check(shard_size=2, grouped_forward=True)
@@ -20,8 +20,10 @@ from onmt.inputters.inputter import (build_dataset_iter, lazily_load_dataset,
 from onmt.model_builder import (build_model, build_embeddings_then_encoder,
     build_decoder_and_generator)
 from onmt.utils.optimizers import build_optim
+from onmt.utils.pair_scheduler import build_pair_scheduler
 from onmt.trainer import build_trainer
 from onmt.models import build_model_saver
+from onmt.models.sharded_checkpoint import load_checkpoint
 from onmt.utils.logging import init_logger, logger
 
 
@@ -81,10 +83,12 @@ def training_opt_postprocessing(opt):
 
 def build_data_iter_fct(dataset_name, path_, fields_, opt_):
 
+    # Training iterators never end: they go through the shards epoch
+    # after epoch instead of being recreated by the trainer.
     def train_iter_wrapper():
-        return build_dataset_iter(lazily_load_dataset(dataset_name, path_),
-                                  fields_,
-                                  opt_)
+        datasets = lazily_load_dataset(dataset_name, path_, opt_.mmap_shards,
+                                       repeat=dataset_name == 'train')
+        return build_dataset_iter(datasets, fields_, opt_)
 
     return train_iter_wrapper
 
@@ -95,8 +99,7 @@ def main(opt):
     # Load checkpoint if we resume from a previous training.
     if opt.train_from:
         logger.info('Loading checkpoint from %s' % opt.train_from)
-        checkpoint = torch.load(opt.train_from,
-                                map_location=lambda storage, loc: storage)
+        checkpoint = load_checkpoint(opt.train_from)
         model_opt = checkpoint['opt']
     else:
         checkpoint = None
@@ -254,12 +257,16 @@ def main(opt):
     # Build model saver
     model_saver = build_model_saver(model_opt, opt, model, fields, optim)
 
+    pair_scheduler = build_pair_scheduler(opt, list(train_iter_fcts.keys()),
+                                          opt.data)
+
     trainer = build_trainer(
         opt, model, fields, optim, data_type, generators, tgt_vocabs,
-        model_saver=model_saver)
+        model_saver=model_saver, pair_scheduler=pair_scheduler)
 
     trainer.train(train_iter_fcts, valid_iter_fcts, opt.train_steps,
                   opt.valid_steps)
+    model_saver.close()
 
     if opt.tensorboard:
         trainer.report_manager.tensorboard_writer.close()
@@ -11,8 +11,6 @@
 
 from __future__ import division
 
-import random
-
 from collections import OrderedDict
 
 import onmt.inputters as inputters
@@ -20,16 +18,21 @@ import onmt.utils
 import subprocess
 import sys
 
-from onmt.utils.loss import build_loss_from_generator_and_vocab
+from onmt.utils.loss import build_loss_from_generator_and_vocab, \
+    AttentionBridgePenalty
 
 from onmt.utils.logging import logger
+from onmt.utils.misc import prefetch_iterator
+from onmt.utils.mixed_precision import autocast, check_precision
+from onmt.utils.pair_scheduler import UniformScheduler
+from onmt.utils.statistics import PhaseTimer
 import torch
-from torch.autograd import Variable
 
 def build_trainer(opt, model, fields, optim, data_type,
                   generators,
                   tgt_vocabs,
-                  model_saver=None):
+                  model_saver=None,
+                  pair_scheduler=None):
     """
     Simplify `Trainer` creation based on user `opt`s*
 
@@ -42,6 +45,8 @@ def build_trainer(opt, model, fields, optim, data_type,
             e.g. "text", "img", "audio"
         model_saver(:obj:`onmt.models.ModelSaverBase`): the utility object
             used to save the model
+        pair_scheduler(:obj:`onmt.utils.pair_scheduler.PairScheduler`):
+            chooses the language pair of each training batch
     """
 
     # Chris: one loss for every decoder
@@ -70,13 +75,32 @@ def build_trainer(opt, model, fields, optim, data_type,
     n_gpu = len(opt.gpuid)
     gpu_rank = opt.gpu_rank
     gpu_verbose_level = opt.gpu_verbose_level
+    batch_queue_size = opt.batch_queue_size
+    pairs_per_step = opt.pairs_per_step
+    grouped_forward = opt.grouped_forward
+    ab_penalty_every = opt.ab_penalty_every
+    precision = opt.precision
+    report_timing = opt.report_timing
+    overlap_grad_reduce = opt.overlap_grad_reduce
+    average_decay = opt.average_decay
+    average_every = opt.average_every
 
     report_manager = onmt.utils.build_report_manager(opt)
     trainer = onmt.Trainer(model, train_losses, valid_losses, optim, opt.attention_heads, trunc_size,
                            shard_size, data_type, norm_method,
                            grad_accum_count, n_gpu, gpu_rank,
                            gpu_verbose_level, report_manager,
-                           opt.use_attention_bridge, model_saver=model_saver)
+                           opt.use_attention_bridge, model_saver=model_saver,
+                           batch_queue_size=batch_queue_size,
+                           pair_scheduler=pair_scheduler,
+                           pairs_per_step=pairs_per_step,
+                           grouped_forward=grouped_forward,
+                           ab_penalty_every=ab_penalty_every,
+                           precision=precision,
+                           report_timing=report_timing,
+                           overlap_grad_reduce=overlap_grad_reduce,
+                           average_decay=average_decay,
+                           average_every=average_every)
     return trainer
 
 
@@ -103,12 +127,42 @@ class Trainer(object):
             model_saver(:obj:`onmt.models.ModelSaverBase`): the saver is
                 used to save a checkpoint.
                 Thus nothing will be saved if this parameter is None
+            batch_queue_size(int): number of training batches prepared
+                ahead by a background thread. 0 prepares them in the
+                training loop.
+            pair_scheduler(:obj:`onmt.utils.pair_scheduler.PairScheduler`):
+                chooses the language pair of each training batch, uniformly
+                at random if None.
+            pairs_per_step(int): number of language pairs drawn, and
+                batches trained on, for each of the `grad_accum_count`
+                accumulations of an optimizer step.
+            grouped_forward(bool): encode the batches of a step that share
+                their source language at once.
+            ab_penalty_every(int): add the attention bridge penalty to the
+                loss every this many steps, 0 never.
+            precision(str): 'fp32', or 'fp16' or 'bf16' to run the forward
+                passes with autocast (fp16 with dynamic loss scaling).
+            report_timing(bool): report the time spent in every phase of
+                training (see `onmt.utils.statistics.PhaseTimer`).
+            overlap_grad_reduce(bool): with several GPUs, sum the gradients
+                during the last backward pass of a step, rather than after
+                it (see `onmt.utils.distributed.GradientSync`).
+            average_decay(float): keep an exponential moving average of
+                the parameters with this decay, saved in the checkpoints
+                instead of them. 0 keeps no average.
+            average_every(int): update the average every this many steps.
     """
 
     def __init__(self, model, train_losses, valid_losses, optim, attention_heads,
                  trunc_size=0, shard_size=32, data_type='text',
                  norm_method="sents", grad_accum_count=1, n_gpu=1, gpu_rank=1,
-                 gpu_verbose_level=0, report_manager=None, use_attention_bridge=True, model_saver=None):
+                 gpu_verbose_level=0, report_manager=None,
+                 use_attention_bridge=True, model_saver=None,
+                 batch_queue_size=0, pair_scheduler=None,
+                 pairs_per_step=1, grouped_forward=False,
+                 ab_penalty_every=1, precision='fp32', report_timing=False,
+                 overlap_grad_reduce=False, average_decay=0,
+                 average_every=1):
         # Basic attributes.
         self.model = model
         self.train_losses = train_losses
@@ -127,12 +181,35 @@ class Trainer(object):
         self.last_model = None
         self.use_attention_bridge = use_attention_bridge
         self.attention_heads = attention_heads
+        self.ab_penalty = AttentionBridgePenalty(attention_heads,
+                                                 every=ab_penalty_every)
+        self.batch_queue_size = batch_queue_size
+        self.pair_scheduler = pair_scheduler
+        self.pairs_per_step = pairs_per_step
+        self.grouped_forward = grouped_forward
+        self.precision = precision
+        self.device_type = 'cuda' if n_gpu > 0 else 'cpu'
+        check_precision(precision, self.device_type)
+        self.timer = PhaseTimer(enabled=report_timing, cuda=n_gpu > 0)
+        self.pair_stats = {}
+        self.average_decay = average_decay
+        self.average_every = average_every
+        self.moving_average = None
+        self.grad_sync = None
+        if n_gpu > 1:
+            self.grad_sync = self._build_grad_sync(overlap_grad_reduce)
+        for train_loss in train_losses.values():
+            train_loss.timer = self.timer
 
         assert grad_accum_count > 0
-        if grad_accum_count > 1:
+        assert pairs_per_step > 0
+        if grad_accum_count > 1 or pairs_per_step > 1:
             assert(self.trunc_size == 0), \
                 """To enable accumulated gradients,
                    you must disable target sequence truncating."""
+        if grouped_forward:
+            assert data_type == 'text', \
+                "Grouped forward is only supported for text data."
 
         # Set model in training mode.
         self.model.train()
@@ -165,30 +242,22 @@ class Trainer(object):
 
         total_stats = onmt.utils.Statistics()
         report_stats = onmt.utils.Statistics()
+        # Training stats of every pair, reported along with validation.
+        self.pair_stats = {pair: onmt.utils.Statistics()
+                           for pair in train_iter_fcts}
         self._start_report_manager(start_time=total_stats.start_time)
 
-        # init every train iter
-        train_iters = {k: (b for b in f())
-                       for k, f in train_iter_fcts.items()}
+        cuda_device = torch.cuda.current_device() if self.n_gpu > 0 else None
+        train_batches = self._train_batches(train_iter_fcts, cuda_device)
+        if self.batch_queue_size > 0:
+            train_batches = prefetch_iterator(train_batches,
+                                              self.batch_queue_size)
 
         while step <= train_steps:
 
             reduce_counter = 0
-            src_lang, tgt_lang = random.choice(list(train_iters.keys()))
-
-            try:
-                batch = next(train_iters[(src_lang, tgt_lang)])
-            except:
-                # re-init the iterator
-                logger.info('recreating {}-{} dataset'.format(src_lang,
-                                                              tgt_lang))
-                train_iters[(src_lang, tgt_lang)] = \
-                    (b for b in train_iter_fcts[(src_lang, tgt_lang)]())
-                batch = next(train_iters[(src_lang, tgt_lang)])
-
-            # assign the source and target langs to the batch
-            setattr(batch, 'src_lang', src_lang)
-            setattr(batch, 'tgt_lang', tgt_lang)
+            with self.timer('data', total_stats, report_stats):
+                batches = next(train_batches)
 
             # CHRIS: note this may not work yet for multi-gpu or accumulation
             #if self.n_gpu == 0 or (i % self.n_gpu == self.gpu_rank):
@@ -197,14 +266,16 @@ class Trainer(object):
                     logger.info("GpuRank %d: index: %d accum: %d"
                                 % (self.gpu_rank, step, accum))
 
-                true_batchs.append(batch)
+                true_batchs.extend(batches)
 
-                if self.norm_method == "tokens":
-                    num_tokens = batch.tgt[1:].ne(
-                        self.train_losses[tgt_lang].padding_idx).sum()
-                    normalization += num_tokens.item()
-                else:
-                    normalization += batch.batch_size
+                for batch in batches:
+                    if self.norm_method == "tokens":
+                        num_tokens = batch.tgt[1:].ne(
+                            self.train_losses[batch.tgt_lang].padding_idx)\
+                            .sum()
+                        normalization += num_tokens.item()
+                    else:
+                        normalization += batch.batch_size
                 accum += 1
                 if accum == self.grad_accum_count:
                     reduce_counter += 1
@@ -214,13 +285,18 @@ class Trainer(object):
                                     % (self.gpu_rank, reduce_counter,
                                        len(true_batchs)))
                     if self.n_gpu > 1:
-                        normalization = sum(onmt.utils.distributed
-                                            .all_gather_list
-                                            (normalization))
+                        with self.timer('all_reduce', total_stats,
+                                        report_stats):
+                            normalization = sum(onmt.utils.distributed
+                                                .all_gather_list
+                                                (normalization))
 
                     self._gradient_accumulation(
                         true_batchs, normalization, total_stats,
                         report_stats)
+                    if self.average_decay > 0 and \
+                            step % self.average_every == 0:
+                        self._update_average(step)
 
                     report_stats = self._maybe_report_training(
                         step, train_steps,
@@ -231,26 +307,7 @@ class Trainer(object):
                     accum = 0
                     normalization = 0
                     if (step % valid_steps == 0):
-                        for lang_pair in valid_iter_fcts.items():
-                            valid_iter_fct = lang_pair[1]
-                            src_tgt = lang_pair[0]
-                            logger.info('Current language pair: {}'.format(src_tgt))
-                            # loop valid over all lang pairs
-                            if self.gpu_verbose_level > 0:
-                                logger.info('GpuRank %d: validate step %d'
-                                            % (self.gpu_rank, step))
-                            valid_iter = valid_iter_fct()
-                            valid_stats = self.validate(valid_iter, src_tgt)
-                            if self.gpu_verbose_level > 0:
-                                logger.info('GpuRank %d: gather valid stat \
-                                            step %d' % (self.gpu_rank, step))
-                            valid_stats = self._maybe_gather_stats(valid_stats)
-                            if self.gpu_verbose_level > 0:
-                                logger.info('GpuRank %d: report stat step %d'
-                                            % (self.gpu_rank, step))
-                            self._report_step(self.optim.learning_rate,
-                                              step, valid_stats=valid_stats)
-
+                        self._validate_pairs(valid_iter_fcts, step)
                         self._maybe_save(step)
                         """
                         # TODO: change in a better way
@@ -300,6 +357,117 @@ class Trainer(object):
 
         return total_stats
 
+    def _build_grad_sync(self, overlap):
+        """
+        Synchronization of the gradients of the modules used in a step
+        by some GPU, e.g. of a single encoder and decoder per pair.
+        """
+        modules = self.model.language_modules()
+        groups = {key: list(module.parameters())
+                  for key, module in modules.items()}
+        generators = [p for key, module in modules.items()
+                      if key[0] == 'generator' for p in module.parameters()]
+        return onmt.utils.distributed.GradientSync(
+            self.model.parameters(), groups, deferred=generators,
+            overlap=overlap)
+
+    def _start_grad_sync(self, batches):
+        """ Start the gradient synchronization of a step on `batches`. """
+        if self.grad_sync is not None:
+            self.grad_sync.start(set(
+                key for batch in batches
+                for key in [('encoder', batch.src_lang),
+                            ('decoder', batch.tgt_lang),
+                            ('generator', batch.tgt_lang)]))
+
+    def _arm_grad_sync(self):
+        """ Mark the next loss computation as the last one of the step. """
+        if self.grad_sync is not None:
+            self.grad_sync.arm()
+
+    def _train_batches(self, train_iter_fcts, cuda_device=None):
+        """
+        Endless generator of lists of `pairs_per_step` training batches.
+        Each batch is drawn from the language pair given by
+        `pair_scheduler` (uniformly random by default), tagged with its
+        languages and with its model inputs already built (see
+        `inputters.prepare_features`). Batches of the same pair are next
+        to each other in the list, so that the modules they use are
+        trained on in a row.
+
+        It may run in a background thread (see `batch_queue_size`), hence
+        the CUDA device is set again from `cuda_device`.
+        """
+        if cuda_device is not None:
+            torch.cuda.set_device(cuda_device)
+
+        # init every train iter, they are expected to be endless (see
+        # `inputters.lazily_load_dataset`)
+        train_iters = {k: iter(f())
+                       for k, f in train_iter_fcts.items()}
+        pair_scheduler = self.pair_scheduler
+        if pair_scheduler is None:
+            pair_scheduler = UniformScheduler(list(train_iters.keys()))
+
+        while True:
+            pairs = sorted(pair_scheduler.next_pair()
+                           for _ in range(self.pairs_per_step))
+            yield [self._next_batch(train_iters, train_iter_fcts, pair)
+                   for pair in pairs]
+
+    def _next_batch(self, train_iters, train_iter_fcts, pair):
+        """ Next batch of language pair `pair`, ready for training. """
+        src_lang, tgt_lang = pair
+        try:
+            batch = next(train_iters[(src_lang, tgt_lang)])
+        except StopIteration:
+            # re-init the iterator
+            logger.info('recreating {}-{} dataset'.format(src_lang,
+                                                          tgt_lang))
+            train_iters[(src_lang, tgt_lang)] = \
+                iter(train_iter_fcts[(src_lang, tgt_lang)]())
+            batch = next(train_iters[(src_lang, tgt_lang)])
+
+        # assign the source and target langs to the batch
+        setattr(batch, 'src_lang', src_lang)
+        setattr(batch, 'tgt_lang', tgt_lang)
+        return inputters.prepare_features(batch, self.data_type)
+
+    def _validate_pairs(self, valid_iter_fcts, step):
+        """
+        Validate the model on every language pair, then report the
+        validation stats of every pair next to its training stats since
+        the last validation. With several GPUs, the stats of all pairs are
+        summed at once (see `Statistics.all_reduce_stats_dict`).
+        """
+        valid_stats = OrderedDict()
+        for src_tgt, valid_iter_fct in valid_iter_fcts.items():
+            if self.gpu_verbose_level > 0:
+                logger.info('GpuRank %d: validate %s-%s step %d'
+                            % ((self.gpu_rank,) + src_tgt + (step,)))
+            valid_stats[src_tgt] = self.validate(valid_iter_fct(), src_tgt)
+
+        if self.n_gpu > 1:
+            if self.gpu_verbose_level > 0:
+                logger.info('GpuRank %d: reduce valid stats step %d'
+                            % (self.gpu_rank, step))
+            stats = {('valid',) + pair: stat
+                     for pair, stat in valid_stats.items()}
+            stats.update((('train',) + pair, stat)
+                         for pair, stat in self.pair_stats.items())
+            onmt.utils.Statistics.all_reduce_stats_dict(stats)
+
+        total_valid_stats = onmt.utils.Statistics()
+        for stat in valid_stats.values():
+            total_valid_stats.update(stat)
+        self._report_step(self.optim.learning_rate, step,
+                          valid_stats=total_valid_stats)
+        if self.report_manager is not None:
+            self.report_manager.report_pairs(
+                self.optim.learning_rate, step, self.pair_stats, valid_stats)
+        self.pair_stats = {pair: onmt.utils.Statistics()
+                           for pair in self.pair_stats}
+
     def validate(self, valid_iter, src_tgt):
         """ Validate model.
             valid_iter: validate data iterator
@@ -323,10 +491,9 @@ class Trainer(object):
             tgt = inputters.make_features(batch, 'tgt')
 
             # F-prop through the model.
-            outputs, attns, _, alphasZ = self.model(src, tgt,
-                            batch.src_lang,
-                            batch.tgt_lang,
-                            src_lengths)
+            with autocast(self.precision, self.device_type):
+                outputs, attns, _, alphas_z = self.model(
+                    src, tgt, batch.src_lang, batch.tgt_lang, src_lengths)
             # Compute loss.
             batch_stats = \
                 self.valid_losses[batch.tgt_lang].monolithic_compute_loss(
@@ -342,15 +509,36 @@ class Trainer(object):
 
     def _gradient_accumulation(self, true_batchs, normalization, total_stats,
                                report_stats):
-        if self.grad_accum_count > 1:
+        # Several batches (accumulated, or of several language pairs) are
+        # trained on before a single update.
+        accumulate = len(true_batchs) > 1
+        if accumulate:
             self.model.zero_grad()
-
-        I = Variable(torch.stack([torch.eye(self.attention_heads) for i in range(len(true_batchs[0]) ) ] )) #len(true_batchs[0] = true_batchs[0].__dict__['batch_size']
-        I = I.cuda() if self.n_gpu >= 1 else I
+            self._start_grad_sync(true_batchs)
+
+        penalty = self.ab_penalty \
+            if self.ab_penalty.is_due(self.optim._step + 1) else None
+        # With fp16, the loss is scaled up (see `Optimizer.loss_scale`).
+        normalization = normalization / self.optim.loss_scale
+
+        if accumulate and self.grouped_forward:
+            groups = OrderedDict()
+            for batch in true_batchs:
+                groups.setdefault(batch.src_lang, []).append(batch)
+            # Lone batches of their source language go the usual way.
+            true_batchs = [batches[0] for batches in groups.values()
+                           if len(batches) == 1]
+            grouped = [batches for batches in groups.values()
+                       if len(batches) > 1]
+            for i, batches in enumerate(grouped):
+                self._grouped_forward_backward(
+                    batches, normalization, penalty, total_stats,
+                    report_stats,
+                    last=not true_batchs and i == len(grouped) - 1)
 
         # Chris: the `batch` contains the information about what the source
         # Chris: and target languages are
-        for batch in true_batchs:
+        for b, batch in enumerate(true_batchs):
             target_size = batch.tgt.size(0)
             # Truncated BPTT: reminder not compatible with accum > 1
             if self.trunc_size:
@@ -362,62 +550,172 @@ class Trainer(object):
             src = inputters.make_features(batch, 'src', self.data_type)
             if self.data_type == 'text':
                 _, src_lengths = batch.src
-                report_stats.n_src_words += src_lengths.sum().item()
+                n_src_tokens = src_lengths.sum().item()
+                report_stats.n_src_words += n_src_tokens
             else:
                 src_lengths = None
+                n_src_tokens = 0
 
             tgt_outer = inputters.make_features(batch, 'tgt')
+            n_tgt_words = 0
 
             for j in range(0, target_size-1, trunc_size):
                 # 1. Create truncated target.
                 tgt = tgt_outer[j: j + trunc_size]
 
                 # 2. F-prop all but generator.
-                if self.grad_accum_count == 1:
+                if not accumulate:
                     self.model.zero_grad()
+                    self._start_grad_sync([batch])
 
-                outputs, attns, dec_state, alphasZ = \
-                    self.model(src, tgt,
-                               batch.src_lang,
-                               batch.tgt_lang,
-                               src_lengths,
-                               dec_state)
+                with self.timer('forward', total_stats, report_stats), \
+                        autocast(self.precision, self.device_type):
+                    outputs, attns, dec_state, alphas_z = \
+                        self.model(src, tgt,
+                                   batch.src_lang,
+                                   batch.tgt_lang,
+                                   src_lengths,
+                                   dec_state)
 
                 # 3. Compute loss in shards for memory efficiency.
                 # Chris: note the loss is different for different decoders
+                if not accumulate or b == len(true_batchs) - 1:
+                    self._arm_grad_sync()
                 batch_stats = \
                     self.train_losses[batch.tgt_lang].sharded_compute_loss(
                         batch, outputs, attns, j,
-                        trunc_size, self.shard_size, normalization, alphasZ, I)
+                        trunc_size, self.shard_size, normalization, alphas_z,
+                        penalty)
 
-                total_stats.update(batch_stats)
-                report_stats.update(batch_stats)
+                self._update_stats(batch, batch_stats, total_stats,
+                                   report_stats)
+                n_tgt_words += batch_stats.n_words
 
                 # 4. Update the parameters and statistics.
-                if self.grad_accum_count == 1:
-                    # Multi GPU gradient gather
-                    if self.n_gpu > 1:
-                        grads = [p.grad.data for p in self.model.parameters()
-                                 if p.requires_grad
-                                 and p.grad is not None]
-                        onmt.utils.distributed.all_reduce_and_rescale_tensors(
-                            grads, float(1))
-                    self.optim.step()
+                if not accumulate:
+                    self._update_parameters(total_stats, report_stats)
 
                 # If truncated, don't backprop fully.
                 if dec_state is not None:
                     dec_state.detach()
 
+            self._count_tokens(batch, n_src_tokens, n_tgt_words,
+                               total_stats, report_stats)
+
         # in case of multi step gradient accumulation,
         # update only after accum batches
-        if self.grad_accum_count > 1:
-            if self.n_gpu > 1:
-                grads = [p.grad.data for p in self.model.parameters()
-                         if p.requires_grad
-                         and p.grad is not None]
-                onmt.utils.distributed.all_reduce_and_rescale_tensors(
-                    grads, float(1))
-            self.optim.step()
+        if accumulate:
+            self._update_parameters(total_stats, report_stats)
+
+    def _update_parameters(self, total_stats, report_stats):
+        """ Gather the gradients of all GPUs, then update the parameters. """
+        if self.n_gpu > 1:
+            # The loss scale is divided out by the all-reduce.
+            with self.timer('all_reduce', total_stats, report_stats):
+                self.grad_sync.finish(float(self.optim.loss_scale))
+            with self.timer('optim', total_stats, report_stats):
+                self.optim.step(grad_scale=1.)
+        else:
+            with self.timer('optim', total_stats, report_stats):
+                self.optim.step()
+
+    def _update_average(self, step):
+        """
+        Update the moving average of the parameters. Its decay is lower
+        in the first steps, not to keep the initial parameters for long.
+        Only the process saving the checkpoints keeps it.
+        """
+        if self.model_saver is None:
+            return
+        params = [param.detach().float() for param in self.model.parameters()]
+        if self.moving_average is None:
+            self.moving_average = [param.clone() for param in params]
+            return
+        decay = min(self.average_decay, (1. + step) / (10. + step))
+        for average, param in zip(self.moving_average, params):
+            average.mul_(decay).add_(param, alpha=1 - decay)
+
+    def _update_stats(self, batch, batch_stats, total_stats, report_stats):
+        """ Add `batch_stats` to the stats, and to those of its pair. """
+        total_stats.update(batch_stats)
+        report_stats.update(batch_stats)
+        self.pair_stats[(batch.src_lang, batch.tgt_lang)].update(batch_stats)
+
+    def _count_tokens(self, batch, n_src_tokens, n_tgt_words, *stats):
+        """
+        Count the source and target tokens of `batch` and their padded
+        count in `stats`, given its `n_src_tokens` source tokens (0 for
+        non text data) and `n_tgt_words` target words (without <s>).
+        """
+        n_padded_tokens = batch.tgt.size(0) * batch.batch_size
+        if self.data_type == 'text':
+            n_padded_tokens += batch.src[0].size(0) * batch.batch_size
+        n_tokens = n_src_tokens + n_tgt_words + batch.batch_size
+        for stat in stats:
+            stat.add_tokens((batch.src_lang, batch.tgt_lang), n_tokens,
+                            n_padded_tokens)
+
+    def _grouped_forward_backward(self, batches, normalization, penalty,
+                                  total_stats, report_stats, last=False):
+        """
+        Forward and backward `batches` of the same source language at once:
+        their sources are merged into one batch, encoded and bridged once,
+        and the rows of each batch are then decoded by the decoder of its
+        target language (see `MultiTaskModel.forward_grouped`). `last`
+        tells whether they are the last batches of the step.
+        """
+        src_lang = batches[0].src_lang
+        pad_idx = self.model.src_vocabs[src_lang].stoi[inputters.PAD_WORD]
+
+        srcs = [inputters.make_features(batch, 'src', self.data_type)
+                for batch in batches]
+        max_len = max(src.size(0) for src in srcs)
+        padded_srcs = []
+        for src in srcs:
+            padded = src.new_full((max_len,) + src.size()[1:], pad_idx)
+            padded[:src.size(0)] = src
+            padded_srcs.append(padded)
+        src = torch.cat(padded_srcs, 1)
+        src_lengths = torch.cat([batch.src[1] for batch in batches])
+        n_src_tokens = torch.stack([batch.src[1].sum() for batch in batches])\
+            .tolist()
+        report_stats.n_src_words += sum(n_src_tokens)
+
+        # Encoders need the merged batch sorted by decreasing lengths.
+        src_lengths, order = src_lengths.sort(descending=True)
+        src = src.index_select(1, order)
+        # Position of every example in the sorted merged batch.
+        _, position = order.sort()
+
+        tgts = []
+        offset = 0
+        for batch in batches:
+            index = position[offset:offset + batch.batch_size]
+            tgts.append((inputters.make_features(batch, 'tgt'),
+                         batch.tgt_lang, index))
+            offset += batch.batch_size
+
+        with self.timer('forward', total_stats, report_stats), \
+                autocast(self.precision, self.device_type):
+            results = self.model.forward_grouped(src, tgts, src_lang,
+                                                 src_lengths)
+        for i, (batch, (outputs, attns, _, alphas_z)) in \
+                enumerate(zip(batches, results)):
+            # The following batches share the graph up to the attention
+            # bridge.
+            target_size = batch.tgt.size(0)
+            if last and i == len(batches) - 1:
+                self._arm_grad_sync()
+            batch_stats = \
+                self.train_losses[batch.tgt_lang].sharded_compute_loss(
+                    batch, outputs, attns, 0,
+                    target_size, self.shard_size, normalization, alphas_z,
+                    penalty, retain_graph=i < len(batches) - 1)
+
+            self._update_stats(batch, batch_stats, total_stats,
+                               report_stats)
+            self._count_tokens(batch, n_src_tokens[i], batch_stats.n_words,
+                               total_stats, report_stats)
 
     def _start_report_manager(self, start_time=None):
         """
@@ -471,5 +769,6 @@ class Trainer(object):
         Save the model if a model saver is set
         """
         if self.model_saver is not None:
-            self.model_saver.maybe_save(step)
-            self.last_model = self.model_saver.base_path + '_step_' + str(step) + '.pt'
+            self.model_saver.maybe_save(step,
+                                        moving_average=self.moving_average)
+            self.last_model = self.model_saver.last_checkpoint
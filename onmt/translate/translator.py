@@ -37,13 +37,8 @@ def build_translator(opt, report_score=True, logger=None, out_file=None):
             onmt.decoders.ensemble.load_test_model(opt, dummy_opt.__dict__)
     else:
         fields, model, model_opt = \
-           onmt.model_builder.load_test_model(opt, dummy_opt.__dict__)
-
-        # Chris: Note we currently just overwrite model and fields
-        model = onmt.model_builder.load_test_multitask_model(opt)
-        fields = inputters.inputter.load_fields_from_vocab(
-            {'src': model.src_vocabs[opt.src_lang],
-             'tgt': model.tgt_vocabs[opt.tgt_lang]})
+            onmt.model_builder.load_test_multitask_model(
+                opt, dummy_opt.__dict__)
 
 
     scorer = onmt.translate.GNMTGlobalScorer(opt.alpha,
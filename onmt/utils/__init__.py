@@ -4,7 +4,9 @@ from onmt.utils.report_manager import ReportMgr, build_report_manager
 from onmt.utils.statistics import Statistics
 from onmt.utils.optimizers import build_optim, MultipleOptimizer, \
     Optimizer
+from onmt.utils.pair_scheduler import build_pair_scheduler
 
 __all__ = ["aeq", "use_gpu", "ReportMgr",
            "build_report_manager", "Statistics",
-           "build_optim", "MultipleOptimizer", "Optimizer"]
+           "build_optim", "MultipleOptimizer", "Optimizer",
+           "build_pair_scheduler"]
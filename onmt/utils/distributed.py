@@ -8,6 +8,7 @@ from __future__ import print_function
 
 import math
 import pickle
+import torch
 import torch.distributed
 
 from onmt.utils.logging import logger
@@ -32,6 +33,14 @@ def multi_init(opt):
     return opt.gpu_rank
 
 
+def collective_device():
+    """ The device of the tensors of collective operations: NCCL only
+    supports CUDA tensors, Gloo CPU ones. """
+    if torch.distributed.get_backend() == 'nccl':
+        return torch.device('cuda')
+    return torch.device('cpu')
+
+
 def all_reduce_and_rescale_tensors(tensors, rescale_denom,
                                    buffer_size=10485760):
     """All-reduce and rescale tensors in chunks of the specified size.
@@ -120,3 +129,206 @@ def all_gather_list(data, max_size=4096):
         result = pickle.loads(bytes_list)
         results.append(result)
     return results
+
+
+class GradientSync(object):
+    """
+    Sum the gradients of all processes, only for the modules used in the
+    step, and, with `overlap`, while the backward pass runs instead of
+    after it.
+
+    Only the parameters of the language-specific modules (e.g. encoders
+    and decoders) used by some process in the step are synchronized,
+    along with the shared ones (in no group). Processes may have trained
+    on different language pairs: those which did not use a module add
+    zeros to its gradients.
+
+    Gradients are gathered in flat buckets of about `bucket_size` bytes,
+    in reverse order of `params`, i.e. about the order in which the
+    backward pass computes them. With `overlap`, hooks on the parameters
+    launch the asynchronous all-reduce of a bucket as soon as all its
+    gradients are accumulated, and `finish` waits for them. Buckets are
+    launched in the same order by all processes, as collective
+    operations must. A step goes:
+
+        sync.start(active_groups)
+        ... backward passes ...
+        sync.arm()
+        ... last backward pass of the step ...
+        sync.finish(rescale_denom)
+
+    Gradients accumulated before `arm` (e.g. of previous batches of the
+    step) are final once the last backward pass has gone through their
+    parameters. Those of `deferred` parameters, which can be accumulated
+    more than once by the last backward pass (e.g. generators, trained
+    shard by shard), are only reduced by `finish`.
+
+    Without `overlap`, `arm` does nothing and all the buckets are reduced
+    by `finish`.
+
+    Args:
+        params (list): the parameters to synchronize, in the order of
+            `model.parameters()`.
+        groups (dict): parameters of every language-specific module. A
+            parameter may be in several groups (shared embeddings).
+        deferred (list): see above.
+        bucket_size (int): bucket size in bytes.
+        overlap (bool): reduce the gradients during the backward pass.
+    """
+
+    def __init__(self, params, groups, deferred=(), bucket_size=10485760,
+                 overlap=True):
+        self.params = [p for p in params if p.requires_grad]
+        self.keys = sorted(groups)
+        self.bucket_size = bucket_size
+        index = {id(p): i for i, p in enumerate(self.params)}
+        self._owners = [set() for _ in self.params]
+        for k, key in enumerate(self.keys):
+            for p in groups[key]:
+                if id(p) in index:
+                    self._owners[index[id(p)]].add(k)
+        deferred = set(index[id(p)] for p in deferred if id(p) in index)
+        self._deferred = deferred
+
+        # Bucket layouts, for every set of active groups.
+        self._layouts = {}
+        self._buckets = None
+        self._position = {}
+        self._next_bucket = 0
+        self._armed = False
+
+        # Keep the gradient accumulators alive, hooks are registered on
+        # them with older PyTorch versions.
+        self._grad_accs = []
+        for i, p in enumerate(self.params):
+            if i in deferred or not overlap:
+                continue
+            if hasattr(p, 'register_post_accumulate_grad_hook'):
+                p.register_post_accumulate_grad_hook(self._make_hook(i))
+            else:
+                grad_acc = p.expand_as(p).grad_fn.next_functions[0][0]
+                grad_acc.register_hook(self._make_hook(i))
+                self._grad_accs.append(grad_acc)
+
+    def _make_hook(self, i):
+        def hook(*unused):
+            self._grad_ready(i)
+        return hook
+
+    def _layout(self, active):
+        """ Buckets of parameter ids for the active group ids. """
+        if active in self._layouts:
+            return self._layouts[active]
+        ids = [i for i in reversed(range(len(self.params)))
+               if not self._owners[i] or self._owners[i] & active]
+        # Deferred parameters are reduced last.
+        ids = [i for i in ids if i not in self._deferred] + \
+            [i for i in ids if i in self._deferred]
+
+        layout = []
+        bucket, filled = [], 0
+        for i in ids:
+            p = self.params[i]
+            size = p.numel() * p.element_size()
+            if bucket and (filled + size > self.bucket_size
+                           or p.dtype != self.params[bucket[0]].dtype):
+                layout.append(bucket)
+                bucket, filled = [], 0
+            bucket.append(i)
+            filled += size
+        if bucket:
+            layout.append(bucket)
+        self._layouts[active] = layout
+        return layout
+
+    def start(self, active_groups):
+        """
+        Prepare the synchronization of a step, in which this process
+        uses the modules of `active_groups`. Their union over all
+        processes is taken with a small all-reduce.
+        """
+        mask = torch.zeros(len(self.keys), device=collective_device())
+        for key in active_groups:
+            mask[self.keys.index(key)] = 1
+        if len(self.keys) > 0:
+            torch.distributed.all_reduce(
+                mask, op=torch.distributed.ReduceOp.MAX)
+        active = frozenset(k for k, used in enumerate(mask.tolist())
+                           if used)
+
+        self._buckets = []
+        self._position = {}
+        for b, ids in enumerate(self._layout(active)):
+            self._buckets.append(_Bucket(ids))
+            for i in ids:
+                self._position[i] = b
+        self._next_bucket = 0
+        self._armed = False
+
+    def arm(self):
+        """ The next backward pass is the last one of the step. """
+        self._armed = True
+
+    def _grad_ready(self, i):
+        if not self._armed or i not in self._position:
+            return
+        bucket = self._buckets[self._position[i]]
+        bucket.ready.add(i)
+        # Launch in order the buckets whose gradients are all ready.
+        while self._next_bucket < len(self._buckets) and \
+                self._buckets[self._next_bucket].is_ready():
+            self._launch(self._buckets[self._next_bucket])
+            self._next_bucket += 1
+
+    def _launch(self, bucket):
+        params = [self.params[i] for i in bucket.ids]
+        bucket.buffer = params[0].new_empty(
+            sum(p.numel() for p in params))
+        offset = 0
+        for p in params:
+            numel = p.numel()
+            if p.grad is None:
+                # Used by other processes only.
+                bucket.buffer[offset:offset + numel].zero_()
+            else:
+                bucket.buffer[offset:offset + numel].copy_(p.grad.view(-1))
+            offset += numel
+        bucket.work = torch.distributed.all_reduce(bucket.buffer,
+                                                   async_op=True)
+
+    def finish(self, rescale_denom):
+        """
+        Reduce the remaining buckets, wait for all of them and copy the
+        sums divided by `rescale_denom` back to the gradients.
+        """
+        for bucket in self._buckets[self._next_bucket:]:
+            self._launch(bucket)
+        for bucket in self._buckets:
+            bucket.work.wait()
+            bucket.buffer.div_(rescale_denom)
+            offset = 0
+            for i in bucket.ids:
+                p = self.params[i]
+                numel = p.numel()
+                grad = bucket.buffer[offset:offset + numel].view_as(p)
+                if p.grad is None:
+                    p.grad = grad.clone()
+                else:
+                    p.grad.copy_(grad)
+                offset += numel
+        self._buckets = None
+        self._position = {}
+        self._armed = False
+
+
+class _Bucket(object):
+    """ Parameter ids of a bucket of `GradientSync`, and its state. """
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.ready = set()
+        self.buffer = None
+        self.work = None
+
+    def is_ready(self):
+        return len(self.ready) == len(self.ids)
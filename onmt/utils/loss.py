@@ -5,13 +5,15 @@ This includes: LossComputeBase and the standard NMTLossCompute, and
                sharded loss compute stuff.
 """
 from __future__ import division
+import functools
+import math
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 
 import onmt
 import onmt.inputters as inputters
 from onmt.modules.sparse_losses import SparsemaxLoss
+from onmt.modules.fused_generator_loss import fused_generator_loss
 
 
 import argparse
@@ -35,7 +37,8 @@ def build_loss_compute(model, tgt_vocab, opt, train=True):
     else:
         compute = NMTLossCompute(
             model.generator, tgt_vocab,
-            label_smoothing=opt.label_smoothing if train else 0.0)
+            label_smoothing=opt.label_smoothing if train else 0.0,
+            chunk_size=opt.generator_chunk_size)
     compute.to(device)
 
     return compute
@@ -59,18 +62,53 @@ def build_loss_from_generator_and_vocab(generator,
     else:
         compute = NMTLossCompute(
             generator, tgt_vocab,
-            label_smoothing=opt.label_smoothing if train else 0.0)
+            label_smoothing=opt.label_smoothing if train else 0.0,
+            chunk_size=opt.generator_chunk_size)
     compute.to(device)
 
     return compute
 
-def Frobenius(mat):
-    size = mat.size()
-    if len(size) == 3:  # batched matrix
-        ret = (torch.sum(torch.sum((mat ** 2), 1), 1).squeeze() + 1e-10) ** 0.5
-        return torch.sum(ret) / size[0]
-    else:
-        raise Exception('matrix for computing Frobenius norm should be with 3 dims')
+
+class AttentionBridgePenalty(nn.Module):
+    """
+    Penalty `||A A^T - I||_F` on the attention bridge weights `A`,
+    averaged over the batch, which pushes the heads to attend to different
+    parts of the sentence (Lin et al., 2017).
+
+    The identity is built once per device and type, and broadcast over
+    the batch.
+
+    Args:
+        attention_heads (int): number of heads of the attention bridge.
+        every (int): the penalty is applied every this many steps,
+            0 disables it.
+    """
+
+    def __init__(self, attention_heads, every=1):
+        super(AttentionBridgePenalty, self).__init__()
+        self.attention_heads = attention_heads
+        self.every = every
+        self._identities = {}
+
+    def is_due(self, step):
+        """ Whether the penalty is applied at training step `step`. """
+        return self.every > 0 and step % self.every == 0
+
+    def _identity(self, alphas):
+        key = (alphas.device, alphas.dtype)
+        if key not in self._identities:
+            self._identities[key] = torch.eye(
+                self.attention_heads, device=alphas.device,
+                dtype=alphas.dtype)
+        return self._identities[key]
+
+    def forward(self, alphas):
+        """
+        alphas (FloatTensor): batch_size x heads x src_len
+        """
+        diff = torch.bmm(alphas, alphas.transpose(1, 2)) \
+            - self._identity(alphas)
+        return ((diff ** 2).sum(2).sum(1) + 1e-10).sqrt().mean()
 
 
 class LossComputeBase(nn.Module):
@@ -98,6 +136,8 @@ class LossComputeBase(nn.Module):
         self.generator = generator
         self.tgt_vocab = tgt_vocab
         self.padding_idx = tgt_vocab.stoi[inputters.PAD_WORD]
+        # Times the 'loss' and 'backward' phases of training.
+        self.timer = onmt.utils.statistics.PhaseTimer()
 
     def _make_shard_state(self, batch, output, range_, attns=None):
         """
@@ -141,6 +181,7 @@ class LossComputeBase(nn.Module):
             :obj:`onmt.utils.Statistics`: loss statistics
         """
         range_ = (0, batch.tgt.size(0))
+        output, attns = _to_float(output), _to_float(attns)
         shard_state = self._make_shard_state(batch, output, range_, attns)
         _, batch_stats = self._compute_loss(batch, **shard_state)
 
@@ -150,7 +191,8 @@ class LossComputeBase(nn.Module):
 
     def sharded_compute_loss(self, batch, output, attns,
                              cur_trunc, trunc_size, shard_size,
-                             normalization, alphasZ, I):
+                             normalization, alphasZ=None, penalty=None,
+                             retain_graph=False):
         """Compute the forward loss and backpropagate.  Computation is done
         with shards and optionally truncation for memory efficiency.
 
@@ -163,6 +205,10 @@ class LossComputeBase(nn.Module):
         approximate efficiency trick to relieve the memory required
         in the RNN buffers.
 
+        Each shard only backpropagates through the generator, and the
+        attention bridge penalty is added once, to the single backward
+        pass through the model done after the last shard.
+
         Args:
           batch (batch) : batch of labeled examples
           output (:obj:`FloatTensor`) :
@@ -173,6 +219,12 @@ class LossComputeBase(nn.Module):
           trunc_size (int) : length of truncation window
           shard_size (int) : maximum number of examples in a shard
           normalization (int) : Loss is divided by this number
+          alphasZ (:obj:`FloatTensor`) : attention bridge weights
+              `[batch x heads x src_len]`, or None
+          penalty (:obj:`AttentionBridgePenalty`) : penalty on `alphasZ`
+              added to the loss, or None
+          retain_graph (bool) : keep the graph of the model after the
+              backward pass, e.g. when it is shared with other batches
 
         Returns:
             :obj:`onmt.utils.Statistics`: validation loss statistics
@@ -182,17 +234,25 @@ class LossComputeBase(nn.Module):
 
         batch_stats = onmt.utils.Statistics()
         range_ = (cur_trunc, cur_trunc + trunc_size)
+        # Mixed precision: the generator and the loss are computed in fp32.
+        output, attns = _to_float(output), _to_float(attns)
+        alphas_z = _to_float(alphasZ)
         shard_state = self._make_shard_state(batch, output, range_, attns)
 
-        attentionT = torch.transpose(alphasZ, 1, 2).contiguous()
-        extra_loss = (Frobenius(torch.bmm(alphasZ, attentionT) - I[:alphasZ.size(0)]) * 1.0)
-        # num_shards = (round up) batch.batch_size/shard_size
-        #TODO: extra_loss = extra_loss/num_shards
-
-        for shard in shards(shard_state, shard_size):
-            loss, stats = self._compute_loss(batch, **shard)
-            loss=torch.add(loss,extra_loss)
-            loss.div(float(normalization)).backward(retain_graph=True)#
+        extra_loss = None
+        if alphas_z is not None and penalty is not None:
+            extra_loss = penalty(alphas_z)
+            batch_stats.penalty += extra_loss.item()
+            batch_stats.n_penalties += 1
+            extra_loss = extra_loss.div(float(normalization))
+
+        backward_timer = functools.partial(self.timer, 'backward',
+                                           batch_stats)
+        for shard in shards(shard_state, shard_size, extra_loss=extra_loss,
+                            retain_graph=retain_graph, timer=backward_timer):
+            with self.timer('loss', batch_stats):
+                loss, stats = self._compute_loss(batch, **shard)
+                loss.div(float(normalization)).backward()
             batch_stats.update(stats)
 
         return batch_stats
@@ -208,6 +268,10 @@ class LossComputeBase(nn.Module):
             :obj:`onmt.utils.Statistics` : statistics for this batch.
         """
         pred = scores.max(1)[1]
+        return self._stats_from_pred(loss, pred, target)
+
+    def _stats_from_pred(self, loss, pred, target):
+        """ Same as `_stats`, given the predictions instead of the scores. """
         non_padding = target.ne(self.padding_idx)
         num_correct = pred.eq(target) \
                           .masked_select(non_padding) \
@@ -228,29 +292,48 @@ class LabelSmoothingLoss(nn.Module):
     With label smoothing,
     KL-divergence between q_{smoothed ground truth prob.}(w)
     and p_{prob. computed by model}(w) is minimized.
+
+    q is `confidence` for the target word, 0 for padding and
+    `smoothing_value` for the other words, so the loss is computed from
+    the sum of the log-probabilities of a row and their values at the
+    target and padding words, without building q.
     """
     def __init__(self, label_smoothing, tgt_vocab_size, ignore_index=-100):
         assert 0.0 < label_smoothing <= 1.0
         self.padding_idx = ignore_index
+        self.label_smoothing = label_smoothing
         super(LabelSmoothingLoss, self).__init__()
 
-        smoothing_value = label_smoothing / (tgt_vocab_size - 2)
-        one_hot = torch.full((tgt_vocab_size,), smoothing_value)
-        one_hot[self.padding_idx] = 0
-        self.register_buffer('one_hot', one_hot.unsqueeze(0))
-
+        self.smoothing_value = label_smoothing / (tgt_vocab_size - 2)
         self.confidence = 1.0 - label_smoothing
+        # sum of q * log(q) over a row
+        self.neg_entropy = (tgt_vocab_size - 2) * self.smoothing_value \
+            * math.log(self.smoothing_value)
+        if self.confidence > 0:
+            self.neg_entropy += self.confidence * math.log(self.confidence)
 
     def forward(self, output, target):
         """
         output (FloatTensor): batch_size x n_classes
         target (LongTensor): batch_size
         """
-        model_prob = self.one_hot.repeat(target.size(0), 1)
-        model_prob.scatter_(1, target.unsqueeze(1), self.confidence)
-        model_prob.masked_fill_((target == self.padding_idx).unsqueeze(1), 0)
+        gold = output.gather(1, target.unsqueeze(1)).squeeze(1)
+        others = output.sum(1) - output[:, self.padding_idx] - gold
+        loss = self.neg_entropy - self.confidence * gold \
+            - self.smoothing_value * others
+        return loss.masked_select(target.ne(self.padding_idx)).sum()
 
-        return F.kl_div(output, model_prob, size_average=False)
+    def chunked_forward(self, hidden, linear, target, chunk_size):
+        """
+        Same as `forward(log_softmax(linear(hidden)), target)`, without
+        materializing the scores (see `fused_generator_loss`).
+
+        Returns:
+            The loss, and the most likely class of every row.
+        """
+        return fused_generator_loss(
+            hidden, linear.weight, linear.bias, target, self.padding_idx,
+            label_smoothing=self.label_smoothing, chunk_size=chunk_size)
 
 
 class NMTLossCompute(LossComputeBase):
@@ -259,9 +342,11 @@ class NMTLossCompute(LossComputeBase):
     """
 
     def __init__(self, generator, tgt_vocab, normalization="sents",
-                 label_smoothing=0.0):
+                 label_smoothing=0.0, chunk_size=0):
         super(NMTLossCompute, self).__init__(generator, tgt_vocab)
         self.sparse = not isinstance(generator[1], nn.LogSoftmax)
+        # Fuse the generator with the loss, see `fused_generator_loss`.
+        self.chunk_size = 0 if self.sparse else chunk_size
         if label_smoothing > 0:
             self.criterion = LabelSmoothingLoss(
                 label_smoothing, len(tgt_vocab), ignore_index=self.padding_idx
@@ -283,6 +368,8 @@ class NMTLossCompute(LossComputeBase):
 
     def _compute_loss(self, batch, output, target):
         bottled_output = self._bottle(output)
+        if self.chunk_size > 0:
+            return self._compute_chunked_loss(bottled_output, target)
         if self.sparse:
             # for sparsemax loss, the loss function operates on the raw output
             # vector, not a probability vector. Hence it's only necessary to
@@ -297,6 +384,29 @@ class NMTLossCompute(LossComputeBase):
 
         return loss, stats
 
+    def _compute_chunked_loss(self, bottled_output, target):
+        gtruth = target.view(-1)
+        if isinstance(self.criterion, LabelSmoothingLoss):
+            loss, pred = self.criterion.chunked_forward(
+                bottled_output, self.generator[0], gtruth, self.chunk_size)
+        else:
+            loss, pred = fused_generator_loss(
+                bottled_output, self.generator[0].weight,
+                self.generator[0].bias, gtruth, self.padding_idx,
+                chunk_size=self.chunk_size)
+        stats = self._stats_from_pred(loss.clone(), pred, gtruth)
+
+        return loss, stats
+
+
+def _to_float(x):
+    """ Cast a tensor, or a dict of tensors, to fp32. None is kept. """
+    if x is None:
+        return None
+    if isinstance(x, dict):
+        return {k: _to_float(v) for k, v in x.items()}
+    return x.float()
+
 
 def filter_shard_state(state, shard_size=None):
     """ ? """
@@ -314,7 +424,8 @@ def filter_shard_state(state, shard_size=None):
             yield k, (v, v_split)
 
 
-def shards(state, shard_size, eval_only=False):
+def shards(state, shard_size, eval_only=False, extra_loss=None,
+           retain_graph=False, timer=None):
     """
     Args:
         state: A dictionary which corresponds to the output of
@@ -323,6 +434,11 @@ def shards(state, shard_size, eval_only=False):
         shard_size: The maximum size of the shards yielded by the model.
         eval_only: If True, only yield the state, nothing else.
               Otherwise, yield shards.
+        extra_loss: A scalar loss backpropagated along with the shards,
+              e.g. a penalty on the model that is not part of the state.
+        retain_graph: Keep the graph after back-propagation.
+        timer: A function returning a context manager enclosing the
+              back-propagation, e.g. to time it.
 
     Yields:
         Each yielded shard is a dict.
@@ -361,4 +477,12 @@ def shards(state, shard_size, eval_only=False):
                 variables.extend(zip(torch.split(state[k], shard_size),
                                      [v_chunk.grad for v_chunk in v_split]))
         inputs, grads = zip(*variables)
-        torch.autograd.backward(inputs, grads)
\ No newline at end of file
+        if extra_loss is not None:
+            inputs += (extra_loss,)
+            grads += (None,)
+        if timer is None:
+            torch.autograd.backward(inputs, grads, retain_graph=retain_graph)
+        else:
+            with timer():
+                torch.autograd.backward(inputs, grads,
+                                        retain_graph=retain_graph)
\ No newline at end of file
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import threading
+from six.moves.queue import Queue
+
 import torch
 
 
@@ -53,3 +56,37 @@ def use_gpu(opt):
     """
     return (hasattr(opt, 'gpuid') and len(opt.gpuid) > 0) or \
         (hasattr(opt, 'gpu') and opt.gpu > -1)
+
+
+def prefetch_iterator(iterable, depth):
+    """
+    Iterate over `iterable` from a background thread, which runs at most
+    `depth` items ahead of the consumer. Exceptions raised while producing
+    an item are re-raised when that item is requested.
+
+    Args:
+        iterable: the iterable to consume in the background.
+        depth (int): the number of items produced in advance.
+    """
+    items = Queue(maxsize=depth)
+    end = object()
+
+    def _produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except Exception as e:
+            items.put((None, e))
+        items.put((end, None))
+
+    thread = threading.Thread(target=_produce)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is end:
+            return
+        yield item
@@ -0,0 +1,90 @@
+""" Mixed precision training utilities """
+from __future__ import division
+
+import contextlib
+import math
+
+import torch
+
+from onmt.utils.logging import logger
+
+
+def check_precision(precision, device_type):
+    """
+    Raise a `ValueError` if training in `precision` ('fp32', 'fp16' or
+    'bf16') is not available on `device_type` ('cuda' or 'cpu').
+    """
+    if precision == 'fp32':
+        return
+    if not hasattr(torch, 'autocast'):
+        raise ValueError("-precision %s requires a version of PyTorch "
+                         "with torch.autocast." % precision)
+    if precision == 'fp16' and device_type == 'cpu':
+        raise ValueError("-precision fp16 is only available on GPU, "
+                         "use bf16 on CPU.")
+
+
+@contextlib.contextmanager
+def _no_autocast():
+    yield
+
+
+def autocast(precision, device_type):
+    """
+    Context manager running the eligible operations enclosed in
+    `precision`, or nothing special for 'fp32'. Parameters, and thus
+    gradients, stay in fp32.
+    """
+    if precision == 'fp32':
+        return _no_autocast()
+    dtype = torch.float16 if precision == 'fp16' else torch.bfloat16
+    return torch.autocast(device_type, dtype=dtype)
+
+
+class DynamicLossScaler(object):
+    """
+    Loss scale of fp16 training, which keeps small gradients from
+    underflowing. Gradients are computed for the loss multiplied by
+    `scale`, and divided by it before the update.
+
+    When gradients overflow, the update is skipped and the scale reduced.
+    It grows again after `growth_interval` updates without overflow.
+
+    Args:
+        init_scale (float): initial scale.
+        growth_factor (float): scale multiplier after `growth_interval`
+            updates without overflow.
+        backoff_factor (float): scale multiplier on overflow.
+        growth_interval (int): see `growth_factor`.
+    """
+
+    def __init__(self, init_scale=2.**16, growth_factor=2.,
+                 backoff_factor=.5, growth_interval=2000):
+        self.scale = init_scale
+        self.growth_factor = growth_factor
+        self.backoff_factor = backoff_factor
+        self.growth_interval = growth_interval
+        self.good_steps = 0
+
+    @staticmethod
+    def has_overflow(params):
+        """ Whether some gradient of `params` is inf or nan. """
+        sums = [p.grad.data.float().sum() for p in params
+                if p.grad is not None]
+        # A single synchronization: inf and nan propagate to the total.
+        if not sums:
+            return False
+        total = torch.stack(sums).sum().item()
+        return math.isinf(total) or math.isnan(total)
+
+    def update(self, overflow):
+        """ Update the scale after an optimization step. """
+        if overflow:
+            self.scale *= self.backoff_factor
+            self.good_steps = 0
+            logger.info("Gradient overflow, skipping update, loss scale "
+                        "reduced to %g" % self.scale)
+            return
+        self.good_steps += 1
+        if self.good_steps % self.growth_interval == 0:
+            self.scale *= self.growth_factor
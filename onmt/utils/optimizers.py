@@ -4,6 +4,7 @@ import torch.optim as optim
 from torch.nn.utils import clip_grad_norm_
 
 from onmt.utils import use_gpu
+from onmt.utils.mixed_precision import DynamicLossScaler
 
 
 def build_optim(model, opt, checkpoint):
@@ -17,7 +18,11 @@ def build_optim(model, opt, checkpoint):
         # the method optim.set_parameters(model.parameters()) will overwrite
         # optim.optimizer, and with ith the values stored in
         # optim.optimizer.state_dict()
-        saved_optimizer_state_dict = optim.optimizer.state_dict()
+        # Sharded checkpoints store the state dict apart from `optim`.
+        if 'optim_state' in checkpoint:
+            saved_optimizer_state_dict = checkpoint['optim_state']
+        else:
+            saved_optimizer_state_dict = optim.optimizer.state_dict()
     else:
         optim = Optimizer(
             opt.optim, opt.learning_rate, opt.max_grad_norm,
@@ -40,6 +45,13 @@ def build_optim(model, opt, checkpoint):
     # parameters from the model.
     optim.set_parameters(model.named_parameters())
 
+    # The loss scale of a checkpoint is kept when resuming fp16 training.
+    if opt.precision == 'fp16':
+        if getattr(optim, 'loss_scaler', None) is None:
+            optim.loss_scaler = DynamicLossScaler()
+    else:
+        optim.loss_scaler = None
+
     if opt.train_from:
         # Stage 2: In this stage, which is only performed when loading an
         # optimizer from a checkpoint, we load the saved_optimizer_state_dict
@@ -154,6 +166,13 @@ class Optimizer(object):
         self.decay_method = decay_method
         self.warmup_steps = warmup_steps
         self.model_size = model_size
+        # fp16 training, see `build_optim`
+        self.loss_scaler = None
+
+    @property
+    def loss_scale(self):
+        """ Factor the loss is multiplied by before backpropagation. """
+        return 1. if self.loss_scaler is None else self.loss_scaler.scale
 
     def set_parameters(self, params):
         """ ? """
@@ -195,12 +214,32 @@ class Optimizer(object):
             for op in self.optimizer.optimizers:
                 op.param_groups[0]['lr'] = self.learning_rate
 
-    def step(self):
+    def step(self, grad_scale=None):
         """Update the model parameters based on current gradients.
 
         Optionally, will employ gradient modification or update learning
         rate.
+
+        With a loss scaler, gradients are first divided by `grad_scale`
+        (the loss scale by default), and the update is skipped if they
+        overflowed.
+
+        Returns:
+            False if the update was skipped, else True.
         """
+        if self.loss_scaler is not None:
+            params = self.params + self.sparse_params
+            overflow = self.loss_scaler.has_overflow(params)
+            if not overflow:
+                if grad_scale is None:
+                    grad_scale = self.loss_scale
+                for p in params:
+                    if p.grad is not None and grad_scale != 1.:
+                        p.grad.data.div_(grad_scale)
+            self.loss_scaler.update(overflow)
+            if overflow:
+                return False
+
         self._step += 1
 
         # Decay method used in tensor2tensor.
@@ -226,3 +265,4 @@ class Optimizer(object):
         if self.max_grad_norm:
             clip_grad_norm_(self.params, self.max_grad_norm)
         self.optimizer.step()
+        return True
@@ -0,0 +1,179 @@
+"""
+    Schedules deciding which language pair each training batch is drawn from
+"""
+from __future__ import division
+
+import bisect
+import itertools
+import os
+import random
+
+import torch
+
+from onmt.utils.logging import logger
+
+
+class PairScheduler(object):
+    """
+    Base class of the language pair schedules of the trainer.
+
+    Random schedules use the global `random` generator, seeded by
+    `-seed`, so that every process of a multi-GPU training draws the
+    same pairs.
+
+    Args:
+        pairs (list): the `(src_lang, tgt_lang)` pairs to schedule.
+    """
+
+    def __init__(self, pairs):
+        self.pairs = list(pairs)
+
+    def next_pair(self):
+        """ Returns the `(src_lang, tgt_lang)` pair of the next batch. """
+        raise NotImplementedError
+
+
+class UniformScheduler(PairScheduler):
+    """ Draws every pair with the same probability. """
+
+    def next_pair(self):
+        return random.choice(self.pairs)
+
+
+class WeightedScheduler(PairScheduler):
+    """
+    Draws the pairs with probabilities proportional to `weights`.
+
+    Args:
+        pairs (list): the `(src_lang, tgt_lang)` pairs to schedule.
+        weights (list): a positive weight for each pair.
+    """
+
+    def __init__(self, pairs, weights):
+        super(WeightedScheduler, self).__init__(pairs)
+        assert len(weights) == len(self.pairs)
+        assert all(w > 0 for w in weights), \
+            "Pair sampling weights must be positive: %s" % str(weights)
+        self.cum_weights = []
+        self.total = 0
+        for w in weights:
+            self.total += w
+            self.cum_weights.append(self.total)
+
+    @property
+    def probabilities(self):
+        """ The probability of drawing each pair. """
+        weights = [b - a for a, b in
+                   zip([0] + self.cum_weights[:-1], self.cum_weights)]
+        return [w / self.total for w in weights]
+
+    def next_pair(self):
+        i = bisect.bisect_right(self.cum_weights, random.random() * self.total)
+        return self.pairs[min(i, len(self.pairs) - 1)]
+
+
+class TemperatureScheduler(WeightedScheduler):
+    """
+    Draws the pairs with probabilities proportional to `size ** (1 / T)`.
+
+    `T = 1` samples proportionally to the corpus sizes, and the larger `T`
+    the closer to uniform sampling, which upsamples the small pairs.
+
+    Args:
+        pairs (list): the `(src_lang, tgt_lang)` pairs to schedule.
+        sizes (list): the size (e.g. number of tokens) of each corpus.
+        temperature (float): `T`.
+    """
+
+    def __init__(self, pairs, sizes, temperature=1.0):
+        assert temperature > 0
+        total = sum(sizes)
+        weights = [(size / total) ** (1.0 / temperature) for size in sizes]
+        super(TemperatureScheduler, self).__init__(pairs, weights)
+
+
+class CyclicScheduler(PairScheduler):
+    """
+    Goes through `schedule` again and again, without randomness.
+
+    Args:
+        pairs (list): the `(src_lang, tgt_lang)` pairs to schedule.
+        schedule (list): the pairs in order, by default each pair once
+            (i.e. round-robin).
+    """
+
+    def __init__(self, pairs, schedule=None):
+        super(CyclicScheduler, self).__init__(pairs)
+        schedule = self.pairs if schedule is None else list(schedule)
+        unknown = set(schedule) - set(self.pairs)
+        if unknown:
+            raise ValueError("Scheduled pairs not trained: %s" % str(unknown))
+        assert len(schedule) > 0
+        self.schedule = itertools.cycle(schedule)
+
+    def next_pair(self):
+        return next(self.schedule)
+
+
+def read_pair_schedule(path):
+    """
+    Read a static schedule file, made of `<src>-<tgt> [count]` lines: each
+    pair is scheduled `count` (default 1) times in a row, in file order.
+    Empty lines and lines starting with `#` are ignored.
+
+    Returns:
+        The list of scheduled `(src_lang, tgt_lang)` pairs.
+    """
+    schedule = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            tokens = line.split()
+            count = int(tokens[1]) if len(tokens) > 1 else 1
+            schedule.extend([tuple(tokens[0].split('-'))] * count)
+    return schedule
+
+
+def load_corpus_size(data_path):
+    """
+    Number of tokens of the training corpus `data_path`, as counted by
+    preprocess.py in `<data_path>.meta.pt`.
+    """
+    meta_file = data_path + '.meta.pt'
+    if not os.path.exists(meta_file):
+        raise ValueError("%s not found, run preprocess.py again to sample "
+                         "language pairs by corpus size." % meta_file)
+    metadata = torch.load(meta_file)
+    return sum(metadata.get(k, 0) for k in ['src_tokens', 'tgt_tokens'])
+
+
+def build_pair_scheduler(opt, pairs, data_paths):
+    """
+    Build the language pair schedule selected by `opt.pair_sampling`.
+
+    Args:
+        opt (:obj:`Namespace`): user options.
+        pairs (list): the `(src_lang, tgt_lang)` pairs to schedule.
+        data_paths (list): the data path prefix of each pair.
+    """
+    if opt.pair_sampling == 'uniform':
+        return UniformScheduler(pairs)
+    if opt.pair_sampling == 'round_robin':
+        return CyclicScheduler(pairs)
+    if opt.pair_sampling == 'schedule':
+        if not opt.pair_schedule:
+            raise ValueError("-pair_sampling schedule requires "
+                             "-pair_schedule.")
+        return CyclicScheduler(pairs, read_pair_schedule(opt.pair_schedule))
+
+    temperature = 1.0 if opt.pair_sampling == 'proportional' \
+        else opt.sampling_temperature
+    sizes = [load_corpus_size(path) for path in data_paths]
+    scheduler = TemperatureScheduler(pairs, sizes, temperature)
+    for (src_lang, tgt_lang), size, prob in \
+            zip(pairs, sizes, scheduler.probabilities):
+        logger.info(' * %s-%s: %d tokens, sampled with probability %.4f'
+                    % (src_lang, tgt_lang, size, prob))
+    return scheduler
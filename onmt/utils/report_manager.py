@@ -28,6 +28,7 @@ class ReportMgrBase(object):
     Inherited classes should override:
         * `_report_training`
         * `_report_step`
+        * `_report_pairs`
     """
 
     def __init__(self, report_every, start_time=-1.):
@@ -93,6 +94,22 @@ class ReportMgrBase(object):
     def _report_step(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def report_pairs(self, lr, step, train_stats, valid_stats):
+        """
+        Report the training and validation stats of every language pair
+
+        Args:
+            lr(float): current learning rate
+            step(int): current step
+            train_stats(dict): training `Statistics` of every pair
+                (`(src_lang, tgt_lang)` tuple) since the last report
+            valid_stats(dict): validation `Statistics` of every pair
+        """
+        self._report_pairs(lr, step, train_stats, valid_stats)
+
+    def _report_pairs(self, *args, **kwargs):
+        raise NotImplementedError()
+
 
 class ReportMgr(ReportMgrBase):
     def __init__(self, report_every, start_time=-1., tensorboard_writer=None):
@@ -151,3 +168,26 @@ class ReportMgr(ReportMgrBase):
                                        "valid",
                                        lr,
                                        step)
+
+    def _report_pairs(self, lr, step, train_stats, valid_stats):
+        """
+        See base class method `ReportMgrBase.report_pairs`.
+        """
+        def metrics(stats):
+            # Pairs may not have been trained on since the last report.
+            if stats is None or stats.n_words == 0:
+                return "%9s %9s" % ("-", "-")
+            return "%9.2f %9.2f" % (stats.ppl(), stats.accuracy())
+
+        self.log("%-12s %9s %9s %9s %9s" % (
+            "Pair", "train ppl", "train acc", "valid ppl", "valid acc"))
+        for pair in sorted(set(train_stats) | set(valid_stats)):
+            name = "%s-%s" % pair
+            self.log("%-12s %s %s" % (name, metrics(train_stats.get(pair)),
+                                      metrics(valid_stats.get(pair))))
+
+            for prefix, stats in [("train/", train_stats.get(pair)),
+                                  ("valid/", valid_stats.get(pair))]:
+                if stats is not None and stats.n_words > 0:
+                    self.maybe_log_tensorboard(stats, prefix + name, lr,
+                                               step)
@@ -1,11 +1,13 @@
 """ Statistics calculation utility """
 from __future__ import division
+import contextlib
 import time
 import math
 import sys
 
+import torch
 from torch.distributed import get_rank
-from onmt.utils.distributed import all_gather_list
+from onmt.utils.distributed import all_gather_list, collective_device
 from onmt.utils.logging import logger
 
 
@@ -16,7 +18,11 @@ class Statistics(object):
 
     * accuracy
     * perplexity
+    * attention bridge penalty
     * elapsed time
+    * time spent in each training phase (see `PhaseTimer`)
+    * padding ratio
+    * throughput of every language pair
     """
 
     def __init__(self, loss=0, n_words=0, n_correct=0):
@@ -24,6 +30,14 @@ class Statistics(object):
         self.n_words = n_words
         self.n_correct = n_correct
         self.n_src_words = 0
+        self.penalty = 0
+        self.n_penalties = 0
+        # Source and target tokens, and their padded count.
+        self.n_tokens = 0
+        self.n_padded_tokens = 0
+        # "<src>-<tgt>" -> source and target tokens.
+        self.pair_tokens = {}
+        self.phase_times = {}
         self.start_time = time.time()
 
     @staticmethod
@@ -42,6 +56,32 @@ class Statistics(object):
         stats = Statistics.all_gather_stats_list([stat], max_size=max_size)
         return stats[0]
 
+    @staticmethod
+    def all_reduce_stats_dict(stats):
+        """
+        Sum the counters of a dict of `Statistics` (e.g. one per language
+        pair) accross all processes/nodes with a single `all_reduce`,
+        instead of gathering pickled objects. Every process must pass the
+        same keys. Pair tokens and phase times are left as they are.
+
+        Args:
+            stats(dict): `Statistics` objects, updated in place
+
+        Returns:
+            `stats`
+        """
+        keys = sorted(stats)
+        # Double precision: counts are exact up to 2**53.
+        counters = torch.tensor(
+            [[getattr(stats[key], name) for name, _ in SUMMED_COUNTERS]
+             for key in keys], dtype=torch.float64,
+            device=collective_device())
+        torch.distributed.all_reduce(counters)
+        for key, values in zip(keys, counters.tolist()):
+            for (name, type_), value in zip(SUMMED_COUNTERS, values):
+                setattr(stats[key], name, type_(value))
+        return stats
+
     @staticmethod
     def all_gather_stats_list(stat_list, max_size=4096):
         """
@@ -76,13 +116,41 @@ class Statistics(object):
             update_n_src_words(bool): whether to update (sum) `n_src_words`
                 or not
 
+        The token counts are summed in any case, whereas the phase times
+        are only those of this process: they are not summed when
+        `update_n_src_words` is set, i.e. when gathering the statistics
+        of other processes.
         """
         self.loss += stat.loss
         self.n_words += stat.n_words
         self.n_correct += stat.n_correct
+        self.penalty += stat.penalty
+        self.n_penalties += stat.n_penalties
+        self.n_tokens += stat.n_tokens
+        self.n_padded_tokens += stat.n_padded_tokens
+        for pair, n_tokens in stat.pair_tokens.items():
+            self.pair_tokens[pair] = self.pair_tokens.get(pair, 0) + n_tokens
 
         if update_n_src_words:
             self.n_src_words += stat.n_src_words
+        else:
+            self.add_times(stat.phase_times)
+
+    def add_tokens(self, pair, n_tokens, n_padded_tokens):
+        """
+        Count the `n_tokens` source and target tokens of a batch of
+        language pair `pair`, padded to `n_padded_tokens`.
+        """
+        self.n_tokens += n_tokens
+        self.n_padded_tokens += n_padded_tokens
+        pair = "%s-%s" % pair
+        self.pair_tokens[pair] = self.pair_tokens.get(pair, 0) + n_tokens
+
+    def add_times(self, phase_times):
+        """ Add the seconds of `phase_times` to those of each phase. """
+        for phase, seconds in phase_times.items():
+            self.phase_times[phase] = \
+                self.phase_times.get(phase, 0.) + seconds
 
     def accuracy(self):
         """ compute accuracy """
@@ -96,6 +164,14 @@ class Statistics(object):
         """ compute perplexity """
         return math.exp(min(self.loss / self.n_words, 100))
 
+    def ab_penalty(self):
+        """ compute the average attention bridge penalty of a batch """
+        return self.penalty / max(self.n_penalties, 1)
+
+    def padding_ratio(self):
+        """ compute the share of padding in the source and target tokens """
+        return 1 - self.n_tokens / max(self.n_padded_tokens, 1)
+
     def elapsed_time(self):
         """ compute elapsed time """
         return time.time() - self.start_time
@@ -109,24 +185,104 @@ class Statistics(object):
            start (int): start time of step.
         """
         t = self.elapsed_time()
+        penalty = "pen: %5.3f; " % self.ab_penalty() \
+            if self.n_penalties > 0 else ""
+        padding = "pad: %4.1f%%; " % (100 * self.padding_ratio()) \
+            if self.n_padded_tokens > 0 else ""
         logger.info(
-            ("Step %2d/%5d; acc: %6.2f; ppl: %5.2f; xent: %4.2f; " +
+            ("Step %2d/%5d; acc: %6.2f; ppl: %5.2f; xent: %4.2f; %s%s" +
              "lr: %7.5f; %3.0f/%3.0f tok/s; %6.0f sec")
             % (step, num_steps,
                self.accuracy(),
                self.ppl(),
                self.xent(),
+               penalty,
+               padding,
                learning_rate,
                self.n_src_words / (t + 1e-5),
                self.n_words / (t + 1e-5),
                time.time() - start))
+        if self.pair_tokens:
+            logger.info("Pair tok/s: " + "; ".join(
+                "%s %.0f" % (pair, n_tokens / (t + 1e-5))
+                for pair, n_tokens in sorted(self.pair_tokens.items())))
+        if self.phase_times:
+            logger.info("Phase time: " + "; ".join(
+                "%s %.2fs (%.0f%%)" % (phase, seconds, 100 * seconds / t)
+                for phase, seconds in self.phase_times_items()))
         sys.stdout.flush()
 
+    def phase_times_items(self):
+        """ The timed phases and their times, in the order of a step. """
+        return [(phase, self.phase_times[phase]) for phase in PHASES
+                if phase in self.phase_times]
+
     def log_tensorboard(self, prefix, writer, learning_rate, step):
         """ display statistics to tensorboard """
         t = self.elapsed_time()
         writer.add_scalar(prefix + "/xent", self.xent(), step)
         writer.add_scalar(prefix + "/ppl", self.ppl(), step)
         writer.add_scalar(prefix + "/accuracy", self.accuracy(), step)
+        if self.n_penalties > 0:
+            writer.add_scalar(prefix + "/penalty", self.ab_penalty(), step)
+        if self.n_padded_tokens > 0:
+            writer.add_scalar(prefix + "/padding", self.padding_ratio(), step)
         writer.add_scalar(prefix + "/tgtper", self.n_words / t, step)
+        for pair, n_tokens in self.pair_tokens.items():
+            writer.add_scalar(prefix + "/tokper/" + pair, n_tokens / t, step)
+        for phase, seconds in self.phase_times_items():
+            writer.add_scalar(prefix + "/time/" + phase, seconds, step)
         writer.add_scalar(prefix + "/lr", learning_rate, step)
+
+
+# Counters summed by `Statistics.all_reduce_stats_dict`, and their type.
+SUMMED_COUNTERS = [('loss', float), ('n_words', int), ('n_correct', int),
+                   ('n_src_words', int), ('penalty', float),
+                   ('n_penalties', int), ('n_tokens', int),
+                   ('n_padded_tokens', int)]
+
+# Phases of a training step, in order.
+PHASES = ['data', 'forward', 'loss', 'backward', 'all_reduce', 'optim']
+
+
+class PhaseTimer(object):
+    """
+    Measures the wall time of the training phases (see `PHASES`), e.g.
+    to tell whether training is bound by data loading, computation or
+    communication:
+
+        with timer('forward', report_stats):
+            outputs = model(...)
+
+    CUDA kernels run asynchronously, so the device is synchronized before
+    and after each phase, which slows training down: timing is disabled
+    by default, and then measures nothing.
+
+    Args:
+        enabled (bool): measure the phases.
+        cuda (bool): synchronize the current CUDA device.
+    """
+
+    def __init__(self, enabled=False, cuda=False):
+        self.enabled = enabled
+        self.cuda = cuda
+
+    def _synchronize(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def __call__(self, phase, *stats):
+        """ Add the time of the enclosed code to `phase` of all `stats`. """
+        if not self.enabled:
+            yield
+            return
+        self._synchronize()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._synchronize()
+            seconds = time.time() - start
+            for stat in stats:
+                stat.add_times({phase: seconds})
@@ -5,9 +5,11 @@
 """
 
 import argparse
+import io
 import os
 import glob
 import sys
+from multiprocessing import Pool
 
 import torch
 
@@ -42,13 +44,17 @@ def parse_args():
     opt = parser.parse_args()
     torch.manual_seed(opt.seed)
 
+    if opt.numericalize and (opt.data_type != 'text' or opt.dynamic_dict):
+        parser.error("-numericalize is only supported for text data "
+                     "without -dynamic_dict.")
+
     check_existing_pt_files(opt)
 
     return opt
 
 
 def build_save_in_shards(src_corpus, tgt_corpus, fields,
-                         corpus_type, opt):
+                         corpus_type, opt, counters=None, save=True):
     """
     Divide the big corpus into shards, and build dataset separately.
     This is currently only for data_type=='text'.
@@ -74,6 +80,10 @@ def build_save_in_shards(src_corpus, tgt_corpus, fields,
     NOTE! `max_shard_size` is measuring the input corpus size, not the
     output pt file size. So a shard pt file consists of examples of size
     2 * `max_shard_size`(source + target).
+
+    If `counters` is not None, the tokens of each shard are counted into
+    it while the shard is still in memory (see `build_save_vocab`).
+    If `save` is False, the shards are only counted, not saved.
     """
 
     corpus_size = os.path.getsize(src_corpus)
@@ -87,6 +97,11 @@ def build_save_in_shards(src_corpus, tgt_corpus, fields,
                     'separately (shard_size = %d bytes).'
                     % opt.max_shard_size)
 
+        if opt.num_workers > 1:
+            return build_save_in_shards_using_pool(
+                src_corpus, tgt_corpus, fields, corpus_type, opt, counters,
+                save)
+
     ret_list = []
     src_iter = inputters.ShardedTextCorpusIterator(
         src_corpus, opt.src_seq_length_trunc,
@@ -106,22 +121,173 @@ def build_save_in_shards(src_corpus, tgt_corpus, fields,
             tgt_seq_length=opt.tgt_seq_length,
             dynamic_dict=opt.dynamic_dict)
 
-        # We save fields in vocab.pt separately, so make it empty.
-        dataset.fields = []
+        if counters is not None:
+            inputters.update_vocab_counters(counters, dataset, fields)
+        if not save:
+            continue
 
         pt_file = "{:s}.{:s}.{:d}.pt".format(
             opt.save_data, corpus_type, index)
         logger.info(" * saving %s data shard to %s."
                     % (corpus_type, pt_file))
-        torch.save(dataset, pt_file)
+        save_dataset(dataset, fields, pt_file, opt)
 
         ret_list.append(pt_file)
 
     return ret_list
 
 
-def build_save_dataset(corpus_type, fields, opt):
-    """ Building and saving the dataset """
+def save_dataset(dataset, fields, pt_file, opt):
+    """
+    Save a dataset to `pt_file`. With `-numericalize`, and once the
+    vocabulary of `fields` is built, it is saved as a
+    `NumericalizedTextDataset` (whose arrays go to `pt_file + '.bin'`).
+    """
+    if opt.numericalize and 'vocab' in fields['tgt'].__dict__:
+        inputters.NumericalizedTextDataset.from_dataset(
+            dataset, fields).save(pt_file)
+    else:
+        # We save fields in vocab.pt separately, so make it empty.
+        dataset.fields = []
+        torch.save(dataset, pt_file)
+
+
+def compute_shard_offsets(src_corpus, tgt_corpus, shard_size):
+    """
+    Scan the parallel corpora once and split them into line-aligned
+    byte ranges, each holding roughly `shard_size` bytes of source text.
+
+    Returns:
+        A list of `(src_start, src_end, tgt_start, tgt_end)` tuples,
+        one per shard, in corpus order.
+    """
+    offsets = []
+    src_start = src_pos = tgt_start = tgt_pos = 0
+    with open(src_corpus, 'rb') as src_f, open(tgt_corpus, 'rb') as tgt_f:
+        for src_line in src_f:
+            tgt_line = tgt_f.readline()
+            if not tgt_line:
+                raise AssertionError(
+                    "Two corpuses must have same number of lines!")
+            src_pos += len(src_line)
+            tgt_pos += len(tgt_line)
+            if src_pos - src_start >= shard_size:
+                offsets.append((src_start, src_pos, tgt_start, tgt_pos))
+                src_start, tgt_start = src_pos, tgt_pos
+        if tgt_f.readline():
+            raise AssertionError(
+                "Two corpuses must have same number of lines!")
+
+    if src_pos > src_start:
+        offsets.append((src_start, src_pos, tgt_start, tgt_pos))
+    return offsets
+
+
+def _read_corpus_range(corpus_path, start, end):
+    """ Read the bytes [start, end) of a corpus as an iterator of lines. """
+    with open(corpus_path, 'rb') as corpus:
+        corpus.seek(start)
+        data = corpus.read(end - start)
+    return io.TextIOWrapper(io.BytesIO(data), encoding="utf-8")
+
+
+def _build_save_shard(args):
+    """
+    Build and save a single shard. Runs inside a worker process, so
+    the (unpicklable) fields are rebuilt from the vocab, if it is already
+    built, or from the number of features.
+
+    Returns:
+        The path of the saved shard (or None when `save` is False), and
+        its token counters (or None when `count_vocab` is False).
+    """
+    (index, offsets, src_corpus, tgt_corpus, nfeats, vocab,
+     corpus_type, count_vocab, save, opt) = args
+    src_start, src_end, tgt_start, tgt_end = offsets
+
+    if vocab:
+        fields = inputters.load_fields_from_vocab(vocab, opt.data_type)
+    else:
+        fields = inputters.get_fields(opt.data_type, *nfeats)
+
+    src_examples_iter, num_src_feats = \
+        inputters.TextDataset.make_text_examples_nfeats_tpl(
+            _read_corpus_range(src_corpus, src_start, src_end), None,
+            opt.src_seq_length_trunc, "src")
+    tgt_examples_iter, num_tgt_feats = \
+        inputters.TextDataset.make_text_examples_nfeats_tpl(
+            _read_corpus_range(tgt_corpus, tgt_start, tgt_end), None,
+            opt.tgt_seq_length_trunc, "tgt")
+
+    dataset = inputters.TextDataset(
+        fields, src_examples_iter, tgt_examples_iter,
+        num_src_feats, num_tgt_feats,
+        src_seq_length=opt.src_seq_length,
+        tgt_seq_length=opt.tgt_seq_length,
+        dynamic_dict=opt.dynamic_dict)
+
+    counters = None
+    if count_vocab:
+        counters = inputters.update_vocab_counters({}, dataset, fields)
+    if not save:
+        return None, counters
+
+    pt_file = "{:s}.{:s}.{:d}.pt".format(
+        opt.save_data, corpus_type, index)
+    logger.info(" * saving %s data shard to %s."
+                % (corpus_type, pt_file))
+    save_dataset(dataset, fields, pt_file, opt)
+
+    return pt_file, counters
+
+
+def build_save_in_shards_using_pool(src_corpus, tgt_corpus, fields,
+                                    corpus_type, opt, counters=None,
+                                    save=True):
+    """
+    Same as `build_save_in_shards`, but the corpus is first split into
+    line-aligned byte ranges, which are then built and saved by a pool
+    of `opt.num_workers` processes.
+
+    Shard numbers are assigned from the position of the byte range in
+    the corpus, not from the order in which workers finish, so the
+    resulting `.N.pt` files are the same whatever the number of workers.
+    Token counters of the workers are merged into `counters`, if given.
+    """
+    offsets = compute_shard_offsets(src_corpus, tgt_corpus,
+                                    opt.max_shard_size)
+    logger.info(' * building %d shards with %d workers.'
+                % (len(offsets), opt.num_workers))
+
+    nfeats = (len(inputters.collect_features(fields, 'src')),
+              len(inputters.collect_features(fields, 'tgt')))
+    vocab = inputters.save_fields_to_vocab(fields)
+    shards = [(index, shard_offsets, src_corpus, tgt_corpus,
+               nfeats, vocab, corpus_type, counters is not None, save, opt)
+              for index, shard_offsets in enumerate(offsets, 1)]
+
+    ret_list = []
+    pool = Pool(opt.num_workers)
+    try:
+        for pt_file, shard_counters in pool.imap(_build_save_shard, shards):
+            if counters is not None:
+                inputters.merge_vocab_counters(counters, shard_counters)
+            if save:
+                ret_list.append(pt_file)
+    finally:
+        pool.close()
+        pool.join()
+
+    return ret_list
+
+
+def build_save_dataset(corpus_type, fields, opt, counters=None, save=True):
+    """ Building and saving the dataset.
+
+    If `counters` is a dict, the vocabulary tokens of the dataset are
+    counted into it as a by-product, to be given to `build_save_vocab`.
+    If `save` is False (text only), the dataset is only counted.
+    """
     assert corpus_type in ['train', 'valid']
 
     if corpus_type == 'train':
@@ -135,7 +301,7 @@ def build_save_dataset(corpus_type, fields, opt):
     if opt.data_type == 'text':
         return build_save_in_shards(
             src_corpus, tgt_corpus, fields,
-            corpus_type, opt)
+            corpus_type, opt, counters, save)
 
     # For data_type == 'img' or 'audio', currently we don't do
     # preprocess sharding. We only build a monolithic dataset.
@@ -156,6 +322,9 @@ def build_save_dataset(corpus_type, fields, opt):
         window_stride=opt.window_stride,
         window=opt.window)
 
+    if counters is not None:
+        inputters.update_vocab_counters(counters, dataset, fields)
+
     # We save fields in vocab.pt seperately, so make it empty.
     dataset.fields = []
 
@@ -166,8 +335,12 @@ def build_save_dataset(corpus_type, fields, opt):
     return [pt_file]
 
 
-def build_save_vocab(train_dataset, fields, opt):
-    """ Building and saving the vocab """
+def build_save_vocab(train_dataset, fields, opt, counters=None):
+    """ Building and saving the vocab.
+
+    When `counters` were filled by `build_save_dataset`, the training
+    shards in `train_dataset` are not reloaded.
+    """
     fields = inputters.build_vocab(train_dataset, fields, opt.data_type,
                                    opt.share_vocab,
                                    opt.src_vocab,
@@ -175,13 +348,23 @@ def build_save_vocab(train_dataset, fields, opt):
                                    opt.src_words_min_frequency,
                                    opt.tgt_vocab,
                                    opt.tgt_vocab_size,
-                                   opt.tgt_words_min_frequency)
+                                   opt.tgt_words_min_frequency,
+                                   counters=counters)
 
     # Can't save fields, so remove/reconstruct at training time.
     vocab_file = opt.save_data + '.vocab.pt'
     torch.save(inputters.save_fields_to_vocab(fields), vocab_file)
 
 
+def build_save_metadata(counters, opt):
+    """ Saving the token counts of the training data, used by the
+    language pair sampling of `train.py` (see `-pair_sampling`).
+    """
+    metadata = {side + '_tokens': sum(counters[side].values())
+                for side in ['src', 'tgt'] if side in counters}
+    torch.save(metadata, opt.save_data + '.meta.pt')
+
+
 def main():
     opt = parse_args()
     init_logger(opt.log_file)
@@ -197,11 +380,26 @@ def main():
     logger.info("Building `Fields` object...")
     fields = inputters.get_fields(opt.data_type, src_nfeats, tgt_nfeats)
 
-    logger.info("Building & saving training data...")
-    train_dataset_files = build_save_dataset('train', fields, opt)
+    counters = {}
+    if opt.numericalize:
+        # The shards can only be numericalized once the vocab is built:
+        # count the tokens first, and build the shards again afterwards
+        # rather than saving them twice.
+        logger.info("Counting the tokens of the training data...")
+        train_dataset_files = build_save_dataset('train', fields, opt,
+                                                 counters, save=False)
+    else:
+        logger.info("Building & saving training data...")
+        train_dataset_files = build_save_dataset('train', fields, opt,
+                                                 counters)
 
     logger.info("Building & saving vocabulary...")
-    build_save_vocab(train_dataset_files, fields, opt)
+    build_save_vocab(train_dataset_files, fields, opt, counters)
+    build_save_metadata(counters, opt)
+
+    if opt.numericalize:
+        logger.info("Building & saving numericalized training data...")
+        build_save_dataset('train', fields, opt)
 
     logger.info("Building & saving validation data...")
     build_save_dataset('valid', fields, opt)
@@ -1,45 +1,116 @@
 #!/usr/bin/env python
+"""
+Average the weights of checkpoints of a multi-task model (files, sharded
+or tensor checkpoints), either their mean or their exponential moving
+average. The checkpoints are memory-mapped and averaged tensor by
+tensor: writing a tensor checkpoint, only the average of one tensor is
+in memory at a time.
+"""
 import argparse
+import copy
 import torch
 
+from onmt.models.sharded_checkpoint import load_checkpoint
+from onmt.models.tensor_checkpoint import save_tensor_checkpoint
 
-def average_models(model_files):
-    vocab = None
-    opt = None
-    avg_model = None
-    avg_generator = None
+# The contents of the newest checkpoint kept in the averaged one. The
+# vocabs and module ids of a checkpoint file are those of its model.
+_CHECKPOINT_KEYS = ['model', 'whole_model', 'vocab', 'opt', 'src_vocabs',
+                    'tgt_vocabs', 'encoder_ids', 'decoder_ids']
 
-    for i, model_file in enumerate(model_files):
-        m = torch.load(model_file)
-        model_weights = m['model']
-        generator_weights = m['generator']
 
-        if i == 0:
-            vocab, opt = m['vocab'], m['opt']
-            avg_model = model_weights
-            avg_generator = generator_weights
+def average_tensor(tensors, decay=None):
+    """
+    The mean of `tensors`, or with `decay`, their exponential moving
+    average from the first (the oldest) to the last. Tensors which are
+    not floating point ones are those of the last.
+    """
+    last = tensors[-1]
+    if not last.is_floating_point():
+        return last
+    avg = tensors[0].float().clone()
+    for tensor in tensors[1:]:
+        if decay is None:
+            avg.add_(tensor.float())
         else:
-            for (k, v) in avg_model.items():
-                avg_model[k].mul_(i).add_(model_weights[k]).div_(i + 1)
+            avg.mul_(decay).add_(tensor.float(), alpha=1 - decay)
+    if decay is None:
+        avg.div_(len(tensors))
+    return avg.to(last.dtype)
 
-            for (k, v) in avg_generator.items():
-                avg_generator[k].mul_(i).add_(generator_weights[k]).div_(i + 1)
 
-    final = {"vocab": vocab, "opt": opt, "optim": None,
-             "generator": avg_generator, "model": avg_model}
-    return final
+def average_models(model_files, output, decay=None, output_format='tensors'):
+    """
+    Average the checkpoints `model_files`, from the oldest to the newest,
+    into the checkpoint `output`, which has the options and vocabs of
+    the newest and no optimizer.
+
+    Args:
+        model_files (list): the checkpoints.
+        output (str): the averaged checkpoint.
+        decay (float): the decay of an exponential moving average, or
+            None for the mean.
+        output_format (str): 'tensors' for a tensor checkpoint, or
+            'file' for a checkpoint file, which takes the model of the
+            newest checkpoint (a file too), with all the averages.
+    """
+    checkpoints = [load_checkpoint(path, mmap=True) for path in model_files]
+    newest = checkpoints[-1]
+    for path, checkpoint in zip(model_files, checkpoints):
+        if set(checkpoint['model']) != set(newest['model']):
+            raise ValueError('%s is not a checkpoint of the model of %s'
+                             % (path, model_files[-1]))
+
+    def average(key):
+        return average_tensor([checkpoint['model'][key]
+                               for checkpoint in checkpoints], decay)
+
+    # Not the manifest of a sharded checkpoint, nor the optimizer.
+    final = {k: newest[k] for k in _CHECKPOINT_KEYS if k in newest}
+    final['optim'] = None
+    if output_format == 'tensors':
+        save_tensor_checkpoint(
+            final, output,
+            transform=lambda name, tensor: (
+                average(name[len('model/'):])
+                if name.startswith('model/') else tensor))
+    else:
+        model = newest.get('whole_model')
+        if model is None:
+            raise ValueError('%s has no model to save in a checkpoint file, '
+                             'use -format tensors' % model_files[-1])
+        # The averages are all computed before any is loaded: the model
+        # shares its tensors with the checkpoint, and its tied weights
+        # are under several keys.
+        averages = {key: average(key) for key in model.state_dict()}
+        model = copy.deepcopy(model)
+        model.load_state_dict(averages)
+        final['model'] = model.state_dict()
+        final['whole_model'] = model
+        torch.save(final, output)
 
 
 def main():
     parser = argparse.ArgumentParser(description="")
     parser.add_argument("-models", "-m", nargs="+", required=True,
-                        help="List of models")
+                        help="List of models, from the oldest to the newest")
     parser.add_argument("-output", "-o", required=True,
                         help="Output file")
+    parser.add_argument("-last", "-n", type=int, default=0,
+                        help="Only average the last N models (0: all)")
+    parser.add_argument("-ema_decay", type=float, default=None,
+                        help="""Exponential moving average of the models
+                        with this decay, rather than their mean""")
+    parser.add_argument("-format", "-f", default="tensors",
+                        choices=["tensors", "file"],
+                        help="""Output a tensor checkpoint, written tensor
+                        by tensor, or a checkpoint file, which holds the
+                        whole averaged model in memory""")
     opt = parser.parse_args()
 
-    final = average_models(opt.models)
-    torch.save(final, opt.output)
+    models = opt.models[-opt.last:] if opt.last > 0 else opt.models
+    average_models(models, opt.output, decay=opt.ema_decay,
+                   output_format=opt.format)
 
 
 if __name__ == "__main__":
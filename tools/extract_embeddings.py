@@ -6,6 +6,7 @@ import onmt.model_builder
 import onmt.inputters
 import onmt.opts
 
+from onmt.models.sharded_checkpoint import load_checkpoint
 from onmt.utils.misc import use_gpu
 from onmt.utils.logging import init_logger, logger
 
@@ -38,8 +39,7 @@ def main():
         torch.cuda.set_device(opt.gpu)
 
     # Add in default model arguments, possibly added since training.
-    checkpoint = torch.load(opt.model,
-                            map_location=lambda storage, loc: storage)
+    checkpoint = load_checkpoint(opt.model)
     model_opt = checkpoint['opt']
 
     src_dict, tgt_dict = None, None
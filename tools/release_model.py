@@ -2,6 +2,8 @@
 import argparse
 import torch
 
+from onmt.models.tensor_checkpoint import save_tensor_checkpoint
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Removes the optim data of PyTorch models")
@@ -9,8 +11,15 @@ if __name__ == "__main__":
                         help="The model filename (*.pt)", required=True)
     parser.add_argument("--output", "-o",
                         help="The output filename (*.pt)", required=True)
+    parser.add_argument("--format", "-f", default="file",
+                        choices=["file", "tensors"],
+                        help="""Output a checkpoint file, or a file of raw
+                        tensors, memory-mapped when loaded""")
     opt = parser.parse_args()
 
     model = torch.load(opt.model)
     model['optim'] = None
-    torch.save(model, opt.output)
+    if opt.format == "tensors":
+        save_tensor_checkpoint(model, opt.output)
+    else:
+        torch.save(model, opt.output)